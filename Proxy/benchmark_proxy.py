@@ -0,0 +1,290 @@
+"""
+Benchmark suite for the proxy handler against the local provider stub (provider_stub.py).
+
+Drives lambda_handler / lambda_streaming_handler in-process with realistic events and reports,
+per scenario: throughput, p50/p99 handler latency, p50/p99 handler overhead (handler time minus the
+stub's own service time), plus peak RSS and cold import time of lambda_function.
+
+    python benchmark_proxy.py                              # all scenarios, stub with zero latency
+    python benchmark_proxy.py --iterations 200 --output bench.json
+    python benchmark_proxy.py --baseline bench.json --max-regression 0.25   # exit 1 on regression
+
+Standard library only. Run from the Proxy folder (or anywhere; the script adds its own folder to sys.path).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable, Optional
+
+PROXY_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROXY_DIR)
+
+from provider_stub import start_stub_server  # noqa: E402
+
+OPENAI_KEY = 'sk-bench-0000000000000000'
+ANTHROPIC_KEY = 'sk-ant-REDACTED'
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percentile * (len(ordered) - 1)))))
+    return ordered[index]
+
+def _file_content(lines: int) -> str:
+    body = '\n'.join(
+        f'    public void Method{i}() {{ transform.position += Vector3.up * {i} * Time.deltaTime; }}'
+        for i in range(lines)
+    )
+    return f'Current File Content (Assets/Scripts/PlayerController.cs):\n```csharp\npublic class PlayerController : MonoBehaviour\n{{\n{body}\n}}\n```'
+
+def _event(provider: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    key = ANTHROPIC_KEY if provider == 'Claude' else OPENAI_KEY
+    return {
+        'httpMethod': 'POST',
+        'path': '/suggest',
+        'headers': {'Authorization': f'Bearer {key}', 'Content-Type': 'application/json', 'X-Provider': provider},
+        'body': json.dumps(body),
+        'isBase64Encoded': False
+    }
+
+def _model(provider: str) -> str:
+    return 'claude-sonnet-4-20250514' if provider == 'Claude' else 'gpt-4o-mini'
+
+def small_chat(provider: str) -> Dict[str, Any]:
+    return _event(provider, {
+        'model': _model(provider),
+        'system': 'You are a Unity assistant.',
+        'messages': [{'role': 'user', 'content': 'How do I rotate a GameObject towards the camera?'}],
+        'stream': False
+    })
+
+def agent_file_content(provider: str) -> Dict[str, Any]:
+    return _event(provider, {
+        'model': _model(provider),
+        'system': 'You are a Unity editor agent. Respond with JSON actions only. ' * 40,
+        'messages': [
+            {'role': 'user', 'content': _file_content(2500) + '\n\nRefactor the movement methods into one.'}
+        ],
+        'max_tokens': 4096,
+        'stream': False
+    })
+
+def long_history(provider: str) -> Dict[str, Any]:
+    messages = []
+    for turn in range(120):
+        messages.append({'role': 'user', 'content': f'Step {turn}: adjust the light intensity and report the change. ' * 8})
+        messages.append({'role': 'assistant', 'content': f'Done with step {turn}; intensity updated as requested. ' * 8})
+    messages.append({'role': 'user', 'content': 'Summarize everything we changed.'})
+    return _event(provider, {'model': _model(provider), 'system': 'You are a Unity assistant.', 'messages': messages, 'stream': False})
+
+def streaming_chat(provider: str) -> Dict[str, Any]:
+    event = small_chat(provider)
+    body = json.loads(event['body'])
+    body['stream'] = True
+    event['body'] = json.dumps(body)
+    return event
+
+SCENARIOS: Dict[str, Callable[[str], Dict[str, Any]]] = {
+    'small_chat': small_chat,
+    'agent_file_content': agent_file_content,
+    'long_history': long_history,
+    'streaming_chat': streaming_chat
+}
+
+def _invoke(lf: Any, event: Dict[str, Any], streaming: bool) -> int:
+    if streaming:
+        result = lf.lambda_streaming_handler(event, None)
+        body = result.get('body')
+        if not isinstance(body, (str, bytes)):
+            for _ in body:
+                pass
+    else:
+        result = lf.lambda_handler(event, None)
+    return result.get('statusCode', 0)
+
+def run_scenario(lf: Any, stub: Any, name: str, provider: str, iterations: int, warmup: int, concurrency: int) -> Dict[str, Any]:
+    event = SCENARIOS[name](provider)
+    streaming = name.startswith('streaming')
+    for _ in range(warmup):
+        _invoke(lf, event, streaming)
+
+    # Sequential pass: latency and overhead (stub service times line up one-to-one with invocations)
+    latencies: List[float] = []
+    overheads: List[float] = []
+    errors = 0
+    for _ in range(iterations):
+        served_before = len(stub.service_seconds())
+        started = time.perf_counter()
+        status = _invoke(lf, event, streaming)
+        elapsed = time.perf_counter() - started
+        served = stub.service_seconds()[served_before:]
+        latencies.append(elapsed)
+        overheads.append(max(0.0, elapsed - sum(served)))
+        if status != 200:
+            errors += 1
+
+    # Concurrent pass: throughput
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(lambda _: _invoke(lf, event, streaming), range(iterations)))
+    wall = time.perf_counter() - started
+    errors += sum(1 for status in statuses if status != 200)
+
+    return {
+        'scenario': name,
+        'provider': provider,
+        'iterations': iterations,
+        'request_bytes': len(event['body']),
+        'errors': errors,
+        'throughput_rps': round(iterations / wall, 1) if wall > 0 else 0.0,
+        'latency_p50_ms': round(_percentile(latencies, 0.5) * 1000, 3),
+        'latency_p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+        'overhead_p50_ms': round(_percentile(overheads, 0.5) * 1000, 3),
+        'overhead_p99_ms': round(_percentile(overheads, 0.99) * 1000, 3)
+    }
+
+def _session_turn(lf: Any, provider: str, session_id: str, text: str, reset: bool, max_tokens: int) -> Dict[str, Any]:
+    event = _event(provider, {
+        'model': _model(provider),
+        'messages': [{'role': 'user', 'content': text}],
+        'max_tokens': max_tokens,
+        'stream': True
+    })
+    event['headers'].update({'X-Proxy-Session': session_id, 'X-Proxy-Session-Reset': 'true' if reset else 'false'})
+    result = lf.lambda_streaming_handler(event, None)
+    body = result.get('body')
+    if not isinstance(body, (str, bytes)):
+        body = b''.join(body)
+    return {'status': result.get('statusCode', 0), 'session': (result.get('headers') or {}).get('X-Proxy-Session'), 'body': body}
+
+def check_session_streams(lf: Any, stub: Any) -> List[str]:
+    """
+    Streamed session turns must be saved however the upstream frames its events. The stub packs every
+    event into one HTTP chunk (one network read holds the whole stream) and the OpenAI reply is cut off at
+    max_output_tokens (response.incomplete); the next turn must find the session.
+    """
+    failures = []
+    previous = dict(stub.config)
+    stub.update_config({'events_per_chunk': 1000, 'chunk_interval_ms': 0})
+    try:
+        for provider in ('OpenAI', 'Claude'):
+            session_id = f'bench-session-{provider.lower()}-{int(time.time() * 1000)}'
+            first = _session_turn(lf, provider, session_id, 'Add a jump to the player.', True, 16)
+            second = _session_turn(lf, provider, session_id, 'Now make it a double jump.', False, 4096)
+            if first['status'] != 200 or second['status'] != 200:
+                failures.append(f"session/{provider}: turn statuses {first['status']}, {second['status']} "
+                                f"(session {second['session']})")
+    finally:
+        stub.update_config(previous)
+    return failures
+
+def cold_import_seconds(runs: int) -> float:
+    """Median wall time of 'import lambda_function' in a fresh interpreter."""
+    code = 'import time; t = time.perf_counter(); import lambda_function; print(time.perf_counter() - t)'
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=PROXY_DIR, capture_output=True, text=True, check=True)
+        samples.append(float(output.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Regressions of p99 overhead (per scenario) and cold import time beyond max_regression (fraction)."""
+    regressions = []
+    previous = {(r['scenario'], r['provider']): r for r in baseline.get('scenarios', [])}
+    for current in results['scenarios']:
+        before = previous.get((current['scenario'], current['provider']))
+        # Ignore sub-millisecond noise
+        if before and current['overhead_p99_ms'] > max(before['overhead_p99_ms'] * (1 + max_regression), before['overhead_p99_ms'] + 1.0):
+            regressions.append(f"{current['scenario']}/{current['provider']}: p99 overhead "
+                               f"{before['overhead_p99_ms']}ms -> {current['overhead_p99_ms']}ms")
+    before_import = baseline.get('cold_import_ms')
+    if before_import and results['cold_import_ms'] > before_import * (1 + max_regression):
+        regressions.append(f"cold import {before_import}ms -> {results['cold_import_ms']}ms")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the proxy handler against the local provider stub')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated scenario names')
+    parser.add_argument('--providers', default='OpenAI,Claude')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--import-runs', type=int, default=5)
+    parser.add_argument('--stub-latency-ms', type=int, default=0)
+    parser.add_argument('--stub-ttfb-ms', type=int, default=0)
+    parser.add_argument('--stub-chunk-interval-ms', type=int, default=0)
+    parser.add_argument('--stub-output-chars', type=int, default=400)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare against a previous --output file')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Allowed slowdown vs baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    stub = start_stub_server(config={
+        'latency_ms': args.stub_latency_ms,
+        'ttfb_ms': args.stub_ttfb_ms,
+        'chunk_interval_ms': args.stub_chunk_interval_ms,
+        'output_chars': args.stub_output_chars
+    })
+    # Must be set before lambda_function is imported; logging off so it doesn't skew timings
+    os.environ['PROXY_OPENAI_API_BASE'] = stub.base_url
+    os.environ['PROXY_ANTHROPIC_API_BASE'] = stub.base_url
+    os.environ.setdefault('PROXY_DIAGNOSTICS', 'off')
+    os.environ.setdefault('PROXY_COMPRESS_MIN_BYTES', str(1 << 30))
+
+    results: Dict[str, Any] = {'python': sys.version.split()[0], 'cold_import_ms': round(cold_import_seconds(args.import_runs) * 1000, 1)}
+    import lambda_function as lf
+
+    failures = check_session_streams(lf, stub)
+    print('session streams: ' + ('; '.join(failures) if failures else 'ok'))
+
+    scenario_results = []
+    for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario: {name} (available: {", ".join(SCENARIOS)})')
+        for provider in [p.strip() for p in args.providers.split(',') if p.strip()]:
+            result = run_scenario(lf, stub, name, provider, args.iterations, args.warmup, args.concurrency)
+            scenario_results.append(result)
+            print(f"{name:<20} {provider:<7} {result['throughput_rps']:>8} rps  "
+                  f"latency p50 {result['latency_p50_ms']:>8}ms p99 {result['latency_p99_ms']:>8}ms  "
+                  f"overhead p50 {result['overhead_p50_ms']:>8}ms p99 {result['overhead_p99_ms']:>8}ms  errors {result['errors']}")
+    stub.shutdown()
+
+    results['scenarios'] = scenario_results
+    results['peak_rss_mb'] = peak_rss_mb()
+    print(f"cold import {results['cold_import_ms']}ms, peak RSS {results['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if failures:
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.max_regression)
+        if regressions:
+            print('REGRESSIONS:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('No regressions against baseline')
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,229 @@ Routes requests to OpenAI (Responses API) or Anthropic (Messages API) and perfor
 - Extracts system instructions for OpenAI Responses
 - Translates token limit fields (max_output_tokens vs max_tokens)
 - Buffers streaming responses for API Gateway compatibility
+- Streams SSE responses incrementally for Function URLs in RESPONSE_STREAM mode (lambda_streaming_handler)
+
+Cold start: keep module-level work to constants and imports the request path needs anyway;
+anything used by rare paths (retries, compression, batch, blob backends, NumPy) is imported where it is used.
 """
 
+import time
+# Measured from here to the end of the module; reported once as 'init_ms' on the first invocation
+_MODULE_LOAD_STARTED = time.perf_counter()
+
+import hashlib
+import http.client
+import io
 import json
 import os
 import re
-from typing import Dict, Any, Tuple, List, Optional
-import urllib.request
+import select
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, Tuple, List, Optional, Iterator, Iterable, AsyncIterable, AsyncIterator
+import urllib.error
 import urllib.parse
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+# Diagnostics level:
+# - 'off': no logging except the Lambda platform's own REPORT lines
+# - 'summary' (default): one structured JSON record per invocation, plus warnings/errors
+# - 'debug': verbose step-by-step logging and extra response validation passes
+DIAGNOSTICS_LEVEL = (os.environ.get('PROXY_DIAGNOSTICS') or 'summary').strip().lower()
+DEBUG_DIAGNOSTICS = DIAGNOSTICS_LEVEL == 'debug'
+
+def _log(message: str) -> None:
+    """Warnings and errors; printed unless diagnostics are off."""
+    if DIAGNOSTICS_LEVEL != 'off':
+        print(message)
+
+def _debug_log(message: str) -> None:
+    """Verbose step-by-step logging; printed only at debug level."""
+    if DEBUG_DIAGNOSTICS:
+        print(message)
+
+# Per-phase latency breakdown: returned in a Server-Timing response header (PROXY_SERVER_TIMING) and, in the
+# invocation record, as CloudWatch Embedded Metric Format metrics with provider/model dimensions (PROXY_EMF_METRICS).
+SERVER_TIMING_ENABLED = (os.environ.get('PROXY_SERVER_TIMING') or 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+EMF_METRICS_ENABLED = (os.environ.get('PROXY_EMF_METRICS') or 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+EMF_NAMESPACE = os.environ.get('PROXY_EMF_NAMESPACE') or 'AiEditorAgent/Proxy'
+
+# Opt-in traffic capture for replay_traffic.py: a PROXY_CAPTURE_RATE fraction (0-1) of /suggest invocations is
+# recorded as a redacted request shape (sizes and counts, never content or keys) plus upstream timing.
+# PROXY_CAPTURE_PATH is a JSONL file (rotated to '<path>.1' at PROXY_CAPTURE_MAX_BYTES) or 'log' for one
+# {"msg": "capture"} log line per record (CloudWatch on Lambda, where /tmp doesn't outlive the instance).
+CAPTURE_RATE = float(os.environ.get('PROXY_CAPTURE_RATE') or 0)
+CAPTURE_PATH = os.environ.get('PROXY_CAPTURE_PATH') or 'log'
+CAPTURE_MAX_BYTES = _env_int('PROXY_CAPTURE_MAX_BYTES', 64 * 1024 * 1024)
+
+def _phase_done(telemetry: Optional[Dict[str, Any]], name: str, since: float) -> float:
+    """Add the time since 'since' (perf_counter) to phase 'name' of this invocation; returns now for chaining."""
+    now = time.perf_counter()
+    if telemetry is not None:
+        phases = telemetry.setdefault('phases', {})
+        phases[name] = phases.get(name, 0.0) + (now - since) * 1000
+    return now
+
+# Provider endpoints. Overridable so the proxy can be pointed at a local stub (provider_stub.py) or a gateway.
+OPENAI_API_BASE = (os.environ.get('PROXY_OPENAI_API_BASE') or 'https://api.openai.com').rstrip('/')
+ANTHROPIC_API_BASE = (os.environ.get('PROXY_ANTHROPIC_API_BASE') or 'https://api.anthropic.com').rstrip('/')
+
+# Per-provider endpoint and defaults, resolved once at cold start
+PROVIDER_CONFIG: Dict[str, Dict[str, str]] = {
+    'OpenAI': {'api_url': f'{OPENAI_API_BASE}/v1/responses', 'default_model': 'gpt-4'},
+    'Claude': {'api_url': f'{ANTHROPIC_API_BASE}/v1/messages', 'default_model': 'claude-sonnet-4-20250514'}
+}
+
+# Hedged requests (opt-in per request with a 'hedge' body field). A backup candidate is launched when the
+# primary has produced no first byte after the PROXY_HEDGE_PERCENTILE latency observed for its model
+# (PROXY_HEDGE_DEFAULT_DELAY_SECONDS until enough latencies are known).
+HEDGE_MAX_CANDIDATES = _env_int('PROXY_HEDGE_MAX_CANDIDATES', 3)
+HEDGE_PERCENTILE = float(os.environ.get('PROXY_HEDGE_PERCENTILE') or 0.95)
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('PROXY_HEDGE_DEFAULT_DELAY_SECONDS') or 5)
+HEDGE_MIN_DELAY_SECONDS = 0.1
+
+# Warmup events (EventBridge schedule or {"warmup": true}) pre-open this many connections per provider.
+# PROXY_WARMUP_ON_INIT also does it during the init phase, e.g. for provisioned concurrency.
+WARMUP_CONNECTIONS_PER_HOST = _env_int('PROXY_WARMUP_CONNECTIONS_PER_HOST', 1)
+WARMUP_TIMEOUT_SECONDS = _env_int('PROXY_WARMUP_TIMEOUT_SECONDS', 5)
+WARMUP_ON_INIT = (os.environ.get('PROXY_WARMUP_ON_INIT') or '').strip().lower() in ('1', 'true', 'on', 'yes')
+
+# Streaming passthrough tuning (RESPONSE_STREAM mode).
+# Upstream is read in small chunks and re-framed on SSE event boundaries; the buffer is
+# bounded so a misbehaving upstream that never sends a blank line can't grow memory unbounded.
+STREAM_READ_CHUNK_BYTES = _env_int('PROXY_STREAM_READ_CHUNK_BYTES', 4096)
+STREAM_MAX_BUFFER_BYTES = _env_int('PROXY_STREAM_MAX_BUFFER_BYTES', 64 * 1024)
+# Non-streaming upstream bodies are read in fixed-size chunks into one owned buffer. Past RESPONSE_SPILL_BYTES the
+# buffer moves to a temporary file (RESPONSE_SPILL_DIR, default the system temp dir: /tmp on Lambda); spilled
+# bodies skip the in-memory JSON parse and, in RESPONSE_STREAM mode, are sent back from the file chunk by chunk.
+RESPONSE_READ_CHUNK_BYTES = _env_int('PROXY_RESPONSE_READ_CHUNK_BYTES', 64 * 1024)
+RESPONSE_SPILL_BYTES = _env_int('PROXY_RESPONSE_SPILL_BYTES', 4 * 1024 * 1024)
+RESPONSE_SPILL_DIR = os.environ.get('PROXY_RESPONSE_SPILL_DIR') or None
+# Buffered streaming (API Gateway): default for coalescing the SSE body ('merge' or 'final'; per request
+# with X-Proxy-Coalesce). Off by default because the body then no longer has one event per provider delta.
+BUFFERED_COALESCE = (os.environ.get('PROXY_BUFFERED_COALESCE') or '').strip().lower()
+
+# Body compression. Requests may arrive gzip/zstd-compressed (Content-Encoding); responses are compressed
+# when the client sends Accept-Encoding and the body is at least COMPRESS_MIN_BYTES.
+# zstd needs the optional 'zstandard' package; without it only gzip is offered/accepted.
+COMPRESS_MIN_BYTES = _env_int('PROXY_COMPRESS_MIN_BYTES', 1024)
+MAX_REQUEST_BODY_BYTES = _env_int('PROXY_MAX_REQUEST_BODY_BYTES', 32 * 1024 * 1024)
+
+# Upstream keep-alive pool. Lives at module level so warm invocations reuse TCP/TLS sessions.
+POOL_MAX_CONNECTIONS_PER_HOST = _env_int('PROXY_POOL_MAX_CONNECTIONS_PER_HOST', 4)
+POOL_MAX_IDLE_SECONDS = _env_int('PROXY_POOL_MAX_IDLE_SECONDS', 60)
+
+# Response cache for non-streaming requests (opt-in per request via X-Proxy-Cache header or 'proxy_cache' body field).
+CACHE_TTL_SECONDS = _env_int('PROXY_CACHE_TTL_SECONDS', 600)
+CACHE_MEMORY_MAX_BYTES = _env_int('PROXY_CACHE_MEMORY_MAX_BYTES', 16 * 1024 * 1024)
+CACHE_DISK_MAX_BYTES = _env_int('PROXY_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024)
+CACHE_DIR = os.environ.get('PROXY_CACHE_DIR', '/tmp/aieditoragent-proxy-cache')
+
+# Provider prompt caching: Anthropic cache_control breakpoints and OpenAI prompt_cache_key.
+# Disabled with PROXY_PROMPT_CACHE=off (or per request with X-Proxy-Prompt-Cache: off).
+# Prefixes shorter than PROMPT_CACHE_MIN_CHARS (~1024 tokens, the provider minimum) are not marked.
+PROMPT_CACHE_ENABLED = (os.environ.get('PROXY_PROMPT_CACHE') or 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+PROMPT_CACHE_MIN_CHARS = _env_int('PROXY_PROMPT_CACHE_MIN_CHARS', 4096)
+
+# Upstream timeouts and retries.
+# Base timeouts come from the model catalog (defaults below, extended/overridden by PROXY_MODEL_CATALOG:
+# inline JSON or a path to a JSON file, loaded once at cold start). Once a model has enough observed
+# latencies, its timeout is derived from the observed p99 instead.
+TIMEOUT_MIN_SECONDS = _env_int('PROXY_TIMEOUT_MIN_SECONDS', 30)
+TIMEOUT_MAX_SECONDS = _env_int('PROXY_TIMEOUT_MAX_SECONDS', 290)
+TIMEOUT_P99_MULTIPLIER = float(os.environ.get('PROXY_TIMEOUT_P99_MULTIPLIER') or 2.0)
+TIMEOUT_MIN_SAMPLES = _env_int('PROXY_TIMEOUT_MIN_SAMPLES', 20)
+RETRY_MAX_ATTEMPTS = _env_int('PROXY_RETRY_MAX_ATTEMPTS', 3)
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get('PROXY_RETRY_BASE_DELAY_SECONDS') or 0.5)
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('PROXY_RETRY_MAX_DELAY_SECONDS') or 20)
+# Time kept back from the Lambda deadline to build and return the response
+LAMBDA_DEADLINE_MARGIN_SECONDS = 2.0
+
+# Pre-flight context budgeting: estimated input tokens above the budget get older turns trimmed.
+# The budget defaults to the catalog context window minus the requested output tokens, times the ratio
+# (headroom for estimation error); PROXY_CONTEXT_BUDGET_TOKENS or 'context_budget_tokens' override it.
+CONTEXT_TRIM_ENABLED = os.environ.get('PROXY_CONTEXT_TRIM', 'on').strip().lower() not in ('off', '0', 'false', 'no')
+CONTEXT_BUDGET_TOKENS = _env_int('PROXY_CONTEXT_BUDGET_TOKENS', 0)
+CONTEXT_BUDGET_RATIO = float(os.environ.get('PROXY_CONTEXT_BUDGET_RATIO') or 0.9)
+CONTEXT_KEEP_TURNS = _env_int('PROXY_CONTEXT_KEEP_TURNS', 6)
+
+# Structured output: response_format maps to Responses text.format (OpenAI) or a forced tool (Anthropic), and the
+# JSON output is validated incrementally so output that can no longer be valid fails as soon as it goes wrong.
+# Non-streaming structured requests are streamed from the provider and reassembled, so the abort can happen
+# mid-generation; PROXY_STRUCTURED_OUTPUT_EARLY_ABORT=off sends them as plain non-streaming calls instead.
+STRUCTURED_OUTPUT_VALIDATE = (os.environ.get('PROXY_STRUCTURED_OUTPUT_VALIDATE') or 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+STRUCTURED_OUTPUT_EARLY_ABORT = (os.environ.get('PROXY_STRUCTURED_OUTPUT_EARLY_ABORT') or 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+STRUCTURED_OUTPUT_TOOL_NAME = 'structured_output'
+
+# /suggest/batch: independent requests fanned out on a bounded thread pool within one invocation.
+BATCH_MAX_ITEMS = _env_int('PROXY_BATCH_MAX_ITEMS', 32)
+BATCH_MAX_WORKERS = _env_int('PROXY_BATCH_MAX_WORKERS', 8)
+BATCH_ITEM_TIMEOUT_SECONDS = _env_int('PROXY_BATCH_ITEM_TIMEOUT_SECONDS', 120)
+
+# /jobs: bulk jobs on the provider batch APIs (OpenAI Batch, Anthropic Message Batches). Jobs are split into
+# provider batches of PROXY_JOB_BATCH_REQUESTS so results can be fetched batch by batch as they end. Job
+# records live in a store selected like PROXY_BLOB_STORE ('memory': written through to PROXY_JOB_DIR).
+JOB_STORE_BACKEND = os.environ.get('PROXY_JOB_STORE', 'memory')
+JOB_MEMORY_MAX_BYTES = _env_int('PROXY_JOB_MEMORY_MAX_BYTES', 8 * 1024 * 1024)
+JOB_DISK_MAX_BYTES = _env_int('PROXY_JOB_DISK_MAX_BYTES', 64 * 1024 * 1024)
+JOB_DIR = os.environ.get('PROXY_JOB_DIR', '/tmp/aieditoragent-proxy-jobs')
+JOB_MAX_REQUESTS = _env_int('PROXY_JOB_MAX_REQUESTS', 10000)
+JOB_BATCH_REQUESTS = _env_int('PROXY_JOB_BATCH_REQUESTS', 500)
+JOB_TIMEOUT_SECONDS = _env_int('PROXY_JOB_TIMEOUT_SECONDS', 60)
+
+# /embed: OpenAI embeddings (Anthropic has no embeddings API) sent in batches and cached by content hash, so an
+# unchanged text is never embedded twice. The cache store is selected like PROXY_BLOB_STORE.
+EMBED_STORE_BACKEND = os.environ.get('PROXY_EMBED_STORE', 'memory')
+EMBED_MEMORY_MAX_BYTES = _env_int('PROXY_EMBED_MEMORY_MAX_BYTES', 32 * 1024 * 1024)
+EMBED_DISK_MAX_BYTES = _env_int('PROXY_EMBED_DISK_MAX_BYTES', 256 * 1024 * 1024)
+EMBED_DIR = os.environ.get('PROXY_EMBED_DIR', '/tmp/aieditoragent-proxy-embeddings')
+EMBED_DEFAULT_MODEL = os.environ.get('PROXY_EMBED_MODEL') or 'text-embedding-3-small'
+EMBED_MAX_TEXTS = _env_int('PROXY_EMBED_MAX_TEXTS', 2048)
+# Per upstream call; OpenAI allows 2048 inputs and 300k tokens per request
+EMBED_BATCH_TEXTS = _env_int('PROXY_EMBED_BATCH_TEXTS', 512)
+EMBED_BATCH_CHARS = _env_int('PROXY_EMBED_BATCH_CHARS', 600000)
+EMBED_TIMEOUT_SECONDS = _env_int('PROXY_EMBED_TIMEOUT_SECONDS', 60)
+
+# /search: per-project vector indexes under PROXY_SEARCH_DIR (local to the instance). Vectors are unit-length
+# float32 rows of a memory-mapped matrix; top-k cosine queries use NumPy when it is installed, pure Python otherwise.
+SEARCH_DIR = os.environ.get('PROXY_SEARCH_DIR', '/tmp/aieditoragent-proxy-search')
+SEARCH_MAX_ROWS = _env_int('PROXY_SEARCH_MAX_ROWS', 100000)
+SEARCH_MAX_TOP_K = _env_int('PROXY_SEARCH_MAX_TOP_K', 100)
+SEARCH_OPEN_INDEXES = _env_int('PROXY_SEARCH_OPEN_INDEXES', 8)
+SEARCH_INITIAL_ROWS = 256
+
+# Admission control in front of the upstream call, per hashed API key: token buckets for requests/min and
+# estimated tokens/min (0 disables a bucket), with a bounded, fair (round-robin per client) wait queue.
+# Backend: 'memory' (per instance), 'sqlite:<path>' (shared by processes on one host) or 'module:ClassName'.
+RATE_LIMIT_RPM = _env_int('PROXY_RATE_LIMIT_RPM', 0)
+RATE_LIMIT_TPM = _env_int('PROXY_RATE_LIMIT_TPM', 0)
+RATE_LIMIT_BACKEND = os.environ.get('PROXY_RATE_LIMIT_BACKEND', 'memory')
+ADMISSION_MAX_QUEUE = _env_int('PROXY_ADMISSION_MAX_QUEUE', 32)
+ADMISSION_MAX_WAIT_SECONDS = _env_int('PROXY_ADMISSION_MAX_WAIT_SECONDS', 10)
+
+# Content-addressed blob store ({"blob_ref": "<sha256>"} placeholders in messages).
+# PROXY_BLOB_STORE selects the backend: 'memory' (in-memory LRU with /tmp spill) or 'package.module:ClassName'.
+BLOB_STORE_BACKEND = os.environ.get('PROXY_BLOB_STORE', 'memory')
+BLOB_MEMORY_MAX_BYTES = _env_int('PROXY_BLOB_MEMORY_MAX_BYTES', 32 * 1024 * 1024)
+BLOB_DISK_MAX_BYTES = _env_int('PROXY_BLOB_DISK_MAX_BYTES', 256 * 1024 * 1024)
+BLOB_DIR = os.environ.get('PROXY_BLOB_DIR', '/tmp/aieditoragent-proxy-blobs')
+
+# Session mode (X-Proxy-Session): the client sends only the new turn. OpenAI turns are chained with
+# previous_response_id; other turns are rebuilt from the stored history. PROXY_SESSION_STORE selects the
+# backend like PROXY_BLOB_STORE ('memory' or 'package.module:ClassName' implementing BlobStore); a shared
+# backend lets sessions survive across Lambda instances.
+SESSION_STORE_BACKEND = os.environ.get('PROXY_SESSION_STORE', 'memory')
+SESSION_TTL_SECONDS = _env_int('PROXY_SESSION_TTL_SECONDS', 3600)
+SESSION_MEMORY_MAX_BYTES = _env_int('PROXY_SESSION_MEMORY_MAX_BYTES', 32 * 1024 * 1024)
+SESSION_DISK_MAX_BYTES = _env_int('PROXY_SESSION_DISK_MAX_BYTES', 256 * 1024 * 1024)
+SESSION_DIR = os.environ.get('PROXY_SESSION_DIR', '/tmp/aieditoragent-proxy-sessions')
+
 def _extract_system_instructions_and_non_system_messages(request_data: Dict[str, Any]) -> Tuple[Optional[str], List[Dict[str, Any]]]:
     """
     For OpenAI Responses API:
@@ -29,117 +243,4106 @@ def _extract_system_instructions_and_non_system_messages(request_data: Dict[str,
     if isinstance(system_field, str) and system_field.strip():
         instructions_parts.append(system_field.strip())
 
-    non_system: List[Dict[str, Any]] = []
-    for msg in request_data.get('messages', []) or []:
-        role = (msg.get('role') or '').strip().lower()
-        content = msg.get('content', '')
-        if role == 'system':
-            if isinstance(content, str) and content.strip():
-                instructions_parts.append(content.strip())
-            continue
-        non_system.append(msg)
+    non_system: List[Dict[str, Any]] = []
+    for msg in request_data.get('messages', []) or []:
+        role = (msg.get('role') or '').strip().lower()
+        content = msg.get('content', '')
+        if role == 'system':
+            if isinstance(content, str) and content.strip():
+                instructions_parts.append(content.strip())
+            continue
+        non_system.append(msg)
+
+    instructions = "\n\n".join([p for p in instructions_parts if p])
+    return (instructions if instructions else None), non_system
+
+def _openai_messages_to_responses_input(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Convert chat-completions style messages into Responses API 'input' items.
+    This uses the canonical content-part format for compatibility.
+    """
+    items: List[Dict[str, Any]] = []
+    for msg in messages or []:
+        role = (msg.get('role') or '').strip().lower() or 'user'
+        content = msg.get('content', '')
+        if content is None:
+            content = ""
+        if not isinstance(content, str):
+            content = str(content)
+
+        # Use content parts; keep roles to preserve conversation shape.
+        # For Responses API, 'input' should use input_* parts even for assistant history items.
+        part_type = 'input_text'
+
+        items.append({
+            'role': role,
+            'content': [
+                {'type': part_type, 'text': content}
+            ]
+        })
+    return items
+
+def _safe_len(x: Any) -> int:
+    try:
+        return len(x)
+    except Exception:
+        return 0
+
+def _log_request_summary(provider_name: str, api_request: Dict[str, Any], is_streaming_request: bool) -> None:
+    model = api_request.get('model', '')
+    if provider_name == 'Claude':
+        msg_count = _safe_len(api_request.get('messages', []))
+        _debug_log(f"[Lambda] Request to Claude - stream: {is_streaming_request}, model: {model}, messages: {msg_count}")
+        return
+
+    # OpenAI Responses: log using 'input' (not 'messages').
+    input_items = api_request.get('input', [])
+    input_count = _safe_len(input_items) if isinstance(input_items, list) else 0
+    _debug_log(f"[Lambda] Request to OpenAI - stream: {is_streaming_request}, model: {model}, input_items: {input_count}")
+
+def _log_user_message_sizes(provider_name: str, api_request: Dict[str, Any]) -> None:
+    """
+    Best-effort logging of user message text sizes without assuming a specific schema.
+    """
+    if provider_name == 'Claude':
+        for i, msg in enumerate(api_request.get('messages', []) or []):
+            if msg.get('role') == 'user':
+                content_length = len(msg.get('content', '') or '')
+                _debug_log(f"[Lambda] User message {i+1} content length: {content_length} chars")
+        return
+
+    # OpenAI Responses: iterate 'input' items and sum text lengths from content parts.
+    input_items = api_request.get('input', []) or []
+    if not isinstance(input_items, list):
+        return
+
+    user_idx = 0
+    for item in input_items:
+        if not isinstance(item, dict):
+            continue
+        if (item.get('role') or '').strip().lower() != 'user':
+            continue
+
+        user_idx += 1
+        parts = item.get('content', [])
+        total = 0
+        if isinstance(parts, list):
+            for part in parts:
+                if isinstance(part, dict):
+                    total += len(part.get('text', '') or '')
+        else:
+            total = len(str(parts))
+        _debug_log(f"[Lambda] User input item {user_idx} content length: {total} chars")
+
+def normalize_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalize event format to support both API Gateway and Lambda Function URLs.
+    Function URLs use a different event structure than API Gateway.
+    """
+    # Check if this is a Function URL event (has requestContext.http)
+    if 'requestContext' in event and 'http' in event.get('requestContext', {}):
+        # Lambda Function URL event format
+        http_context = event['requestContext']['http']
+        normalized = {
+            'httpMethod': http_context.get('method', 'POST'),
+            'path': http_context.get('path', '/'),
+            'headers': event.get('headers', {}) or {},
+            'body': event.get('body', '{}'),
+            'isBase64Encoded': event.get('isBase64Encoded', False),
+            'sourceIp': http_context.get('sourceIp')
+        }
+        return normalized
+    else:
+        # API Gateway event format (already normalized)
+        return event
+
+# (scheme, host, port) -> idle connections as (connection, last_used_monotonic)
+_connection_pool: Dict[Tuple[str, str, int], List[Tuple[http.client.HTTPConnection, float]]] = {}
+_connection_pool_lock = threading.Lock()
+_ssl_context = None
+
+# Errors that mean a reused keep-alive connection was closed by the server while idle.
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                            http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+class _RequestSentError(urllib.error.URLError):
+    """The connection failed after the request was sent; the provider may already be generating, so never retry."""
+
+def _get_ssl_context() -> Any:
+    global _ssl_context
+    if _ssl_context is None:
+        import ssl
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+def _is_connection_healthy(conn: http.client.HTTPConnection, last_used: float) -> bool:
+    """
+    An idle keep-alive connection is reusable if it is recent and the server hasn't closed it.
+    A readable idle socket means EOF (or unexpected data), so it is treated as stale.
+    """
+    if conn.sock is None or time.monotonic() - last_used > POOL_MAX_IDLE_SECONDS:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+def _acquire_connection(key: Tuple[str, str, int], timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+    """Return (connection, reused). Stale idle connections are closed and discarded."""
+    with _connection_pool_lock:
+        idle = _connection_pool.get(key, [])
+        while idle:
+            conn, last_used = idle.pop()
+            if _is_connection_healthy(conn, last_used):
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+
+    scheme, host, port = key
+    if scheme == 'https':
+        conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=_get_ssl_context())
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    return conn, False
+
+def _release_connection(key: Tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+    with _connection_pool_lock:
+        idle = _connection_pool.setdefault(key, [])
+        if conn.sock is not None and len(idle) < POOL_MAX_CONNECTIONS_PER_HOST:
+            idle.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+class _PooledResponse:
+    """
+    File-like wrapper around http.client.HTTPResponse (same surface the handler used from urlopen).
+    Closing a fully-read response returns its connection to the pool; otherwise the connection is dropped.
+    """
+
+    def __init__(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection, response: http.client.HTTPResponse):
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        # Upstream is asked for gzip; decode incrementally so streamed events aren't held back.
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        self._decoder = zlib.decompressobj(zlib.MAX_WBITS | 32) if encoding in ('gzip', 'deflate') else None
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        if self._decoder is None:
+            return self._response.read(amt)
+        if amt is not None:
+            return self.read1(amt)
+        return self._decoder.decompress(self._response.read()) + self._decoder.flush()
+
+    def read1(self, amt: int = -1) -> bytes:
+        if self._decoder is None:
+            return self._response.read1(amt)
+        while True:
+            raw = self._response.read1(amt)
+            if not raw:
+                return self._decoder.flush()
+            decoded = self._decoder.decompress(raw)
+            if decoded:
+                return decoded
+
+    def getheader(self, name: str, default: Any = None) -> Any:
+        return self._response.getheader(name, default)
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        if reusable:
+            _release_connection(self._key, conn)
+        else:
+            conn.close()
+
+    def __enter__(self) -> '_PooledResponse':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+# url -> ((scheme, host, port), path); provider endpoints are fixed, so each is parsed once
+# (batch job URLs carry ids and are only cached up to the cap)
+_upstream_targets: Dict[str, Tuple[Tuple[str, str, int], str]] = {}
+_UPSTREAM_TARGETS_MAX = 64
+
+def _upstream_target(url: str) -> Tuple[Tuple[str, str, int], str]:
+    target = _upstream_targets.get(url)
+    if target is None:
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'https'
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        target = ((scheme, parsed.hostname or '', parsed.port or (443 if scheme == 'https' else 80)), path)
+        if len(_upstream_targets) < _UPSTREAM_TARGETS_MAX:
+            _upstream_targets[url] = target
+    return target
+
+def _pooled_urlopen(url: str, data: Optional[bytes], headers: Dict[str, str], timeout: float,
+                    telemetry: Optional[Dict[str, Any]] = None, method: str = 'POST') -> _PooledResponse:
+    """
+    POST (or 'method') over a pooled keep-alive connection. Mirrors urllib.request.urlopen error semantics:
+    non-2xx statuses raise urllib.error.HTTPError and connection failures raise urllib.error.URLError,
+    so the handler's existing error handling applies unchanged.
+    A reused connection that turns out to be stale is retried once on a fresh connection.
+    Records the 'connect' (new connections: DNS/TCP/TLS) and 'ttfb' (until response headers) phases.
+    """
+    key, path = _upstream_target(url)
+
+    if not any(name.lower() == 'accept-encoding' for name in headers):
+        headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+
+    scope = _current_cancel_scope()
+    while True:
+        phase_started = time.perf_counter()
+        conn, reused = _acquire_connection(key, timeout)
+        if scope is not None:
+            scope.register(conn)
+        try:
+            if conn.sock is None:
+                conn.connect()
+                phase_started = _phase_done(telemetry, 'connect', phase_started)
+        except OSError as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+            _phase_done(telemetry, 'ttfb', phase_started)
+        except _STALE_CONNECTION_ERRORS as e:
+            conn.close()
+            if reused:
+                # A kept-alive connection the server had already closed: the request never reached it
+                _debug_log(f"[Lambda] Pooled connection to {key[1]} was stale ({type(e).__name__}), reconnecting")
+                continue
+            raise _RequestSentError(e)
+        except OSError as e:
+            conn.close()
+            raise _RequestSentError(e)
+        break
+
+    if reused:
+        _debug_log(f"[Lambda] Reused pooled connection to {key[1]}")
+
+    pooled = _PooledResponse(key, conn, response)
+    if response.status >= 400:
+        with pooled:
+            error_body = pooled.read()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+    return pooled
+
+class _CancelScope:
+    """
+    Lets another thread abort the upstream calls made by one hedged candidate or batch item: connections opened
+    while the scope is active on a thread are registered, and cancel() shuts their sockets down, which unblocks
+    any pending read with an error. Hedged candidates fail over instead of retrying (allow_retries=False).
+    """
+
+    def __init__(self, allow_retries: bool = False):
+        self._lock = threading.Lock()
+        self._connections: List[http.client.HTTPConnection] = []
+        self.cancelled = False
+        self.allow_retries = allow_retries
+
+    def register(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._connections.append(conn)
+                return
+        conn.close()
+        raise urllib.error.URLError('cancelled')
+
+    def release(self) -> None:
+        """The candidate has finished with its calls; its connections may be pooled and reused by others."""
+        with self._lock:
+            self._connections = []
+
+    def cancel(self) -> None:
+        import socket
+        with self._lock:
+            self.cancelled = True
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                if conn.sock is not None:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+_hedge_local = threading.local()
+# upstream_opener of the lambda_streaming_handler call running on this thread
+_upstream_local = threading.local()
+
+def _current_cancel_scope() -> Optional[_CancelScope]:
+    return getattr(_hedge_local, 'scope', None)
+
+def _preconnect(key: Tuple[str, str, int], timeout: float) -> Dict[str, Any]:
+    """Resolve DNS and complete the TCP/TLS handshake for one pooled connection, without sending a request."""
+    started = time.monotonic()
+    conn, reused = _acquire_connection(key, timeout)
+    if reused:
+        _release_connection(key, conn)
+        return {'ok': True, 'reused': True, 'ms': 0.0}
+    try:
+        conn.connect()
+    except OSError as e:
+        conn.close()
+        return {'ok': False, 'error': f'{type(e).__name__}: {str(e)}', 'ms': round((time.monotonic() - started) * 1000, 1)}
+    _release_connection(key, conn)
+    return {'ok': True, 'reused': False, 'ms': round((time.monotonic() - started) * 1000, 1)}
+
+def warm_upstream_connections(timeout: float = WARMUP_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    """
+    Pre-open WARMUP_CONNECTIONS_PER_HOST pooled connections to every provider endpoint in parallel.
+    Returns {host: [per-connection result, ...]}. Failures are reported, never raised.
+    """
+    keys = []
+    for config in PROVIDER_CONFIG.values():
+        key = _upstream_target(config['api_url'])[0]
+        if key not in keys:
+            keys.append(key)
+    count = max(1, min(WARMUP_CONNECTIONS_PER_HOST, POOL_MAX_CONNECTIONS_PER_HOST))
+    results: Dict[str, List[Dict[str, Any]]] = {f'{key[1]}:{key[2]}': [] for key in keys}
+    results_lock = threading.Lock()
+
+    def connect(key: Tuple[str, str, int]) -> None:
+        result = _preconnect(key, timeout)
+        with results_lock:
+            results[f'{key[1]}:{key[2]}'].append(result)
+
+    threads = [threading.Thread(target=connect, args=(key,), daemon=True) for key in keys for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout + 1)
+    return results
+
+def _is_warmup_event(event: Any) -> bool:
+    """Scheduler pings (EventBridge 'Scheduled Event' or a custom {"warmup": true} payload), never HTTP requests."""
+    if not isinstance(event, dict) or 'headers' in event or 'requestContext' in event:
+        return False
+    if event.get('warmup') is True:
+        return True
+    return event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'
+
+def _handle_warmup(telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    telemetry['warmup'] = True
+    connections = warm_upstream_connections()
+    telemetry['warm_connections'] = sum(1 for host in connections.values() for r in host if r['ok'])
+    return _json_response(200, {'warmup': True, 'connections': connections})
+
+def _get_header(headers: Dict[str, Any], name: str) -> str:
+    """Case-insensitive header lookup (API Gateway preserves client casing, Function URLs lowercase)."""
+    value = headers.get(name)
+    if value is None:
+        lowered = name.lower()
+        for key, candidate in headers.items():
+            if key.lower() == lowered:
+                value = candidate
+                break
+    return value.strip() if isinstance(value, str) else ''
+
+# key -> (stored_at_epoch, body). OrderedDict order is LRU order (most recently used last).
+_memory_cache: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+_memory_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+def _response_cache_mode(headers: Dict[str, Any], request_data: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns None (cache not requested), 'on' (cache deterministic requests only)
+    or 'force' (cache even when temperature > 0).
+    """
+    value = _get_header(headers, 'X-Proxy-Cache') or request_data.get('proxy_cache')
+    if value is True:
+        return 'on'
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    if value == 'force':
+        return 'force'
+    if value in ('1', 'true', 'on', 'yes'):
+        return 'on'
+    return None
+
+def _is_deterministic_request(api_request: Dict[str, Any]) -> bool:
+    # Both providers sample at temperature 1.0 when it's omitted; only an explicit temperature <= 0 is deterministic.
+    temperature = api_request.get('temperature')
+    if temperature is None:
+        return False
+    try:
+        return float(temperature) <= 0
+    except (TypeError, ValueError):
+        return False
+
+def _response_cache_key(api_url: str, api_key: str, api_request: Dict[str, Any]) -> str:
+    """
+    Canonical hash of the translated provider request. The API key hash is included so
+    one key can never read responses cached for another.
+    """
+    canonical = json.dumps(api_request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256()
+    digest.update(api_url.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(hashlib.sha256(api_key.encode('utf-8')).digest())
+    digest.update(b'\0')
+    digest.update(canonical.encode('utf-8'))
+    return digest.hexdigest()
+
+def _memory_cache_put(key: str, stored_at: float, body: str) -> None:
+    global _memory_cache_bytes
+    size = len(body)
+    if size > CACHE_MEMORY_MAX_BYTES:
+        return
+    with _cache_lock:
+        previous = _memory_cache.pop(key, None)
+        if previous is not None:
+            _memory_cache_bytes -= len(previous[1])
+        _memory_cache[key] = (stored_at, body)
+        _memory_cache_bytes += size
+        while _memory_cache_bytes > CACHE_MEMORY_MAX_BYTES and _memory_cache:
+            _, (_, evicted) = _memory_cache.popitem(last=False)
+            _memory_cache_bytes -= len(evicted)
+
+def _disk_cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f'{key}.json')
+
+def _evict_disk_cache() -> None:
+    """Drop expired entries, then oldest entries until the cache directory fits CACHE_DISK_MAX_BYTES."""
+    try:
+        entries = []
+        for name in os.listdir(CACHE_DIR):
+            path = os.path.join(CACHE_DIR, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    except OSError:
+        return
+    entries.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total <= CACHE_DISK_MAX_BYTES and now - mtime <= CACHE_TTL_SECONDS:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def _response_cache_get(key: str) -> Tuple[Optional[str], Optional[str]]:
+    """Returns (body, tier) where tier is 'memory' or 'disk', or (None, None) on a miss."""
+    now = time.time()
+    with _cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is not None:
+            if now - entry[0] <= CACHE_TTL_SECONDS:
+                _memory_cache.move_to_end(key)
+                return entry[1], 'memory'
+    path = _disk_cache_path(key)
+    try:
+        stored_at = os.path.getmtime(path)
+        if now - stored_at > CACHE_TTL_SECONDS:
+            os.remove(path)
+            return None, None
+        with open(path, 'r', encoding='utf-8') as f:
+            body = f.read()
+    except OSError:
+        return None, None
+    # Promote to the memory tier for the rest of this warm container's life.
+    _memory_cache_put(key, stored_at, body)
+    return body, 'disk'
+
+def _response_cache_put(key: str, body: str) -> None:
+    now = time.time()
+    _memory_cache_put(key, now, body)
+    if len(body) > CACHE_DISK_MAX_BYTES:
+        return
+    path = _disk_cache_path(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _log(f"[Lambda] WARNING: Could not write response cache entry: {str(e)}")
+        return
+    _evict_disk_cache()
+
+# Model prefix -> base timeouts (longest matching prefix wins; '*' is the fallback).
+_DEFAULT_MODEL_CATALOG: Dict[str, Dict[str, Any]] = {
+    '*': {'timeout_seconds': 90, 'file_content_timeout_seconds': 180, 'stream_timeout_seconds': 290,
+          'context_tokens': 128000},
+    # GPT-5 models are slower and need more time
+    'gpt-5': {'timeout_seconds': 120, 'context_tokens': 400000},
+    'gpt-4.1': {'context_tokens': 1000000},
+    'o1': {'timeout_seconds': 120, 'context_tokens': 200000},
+    'o3': {'timeout_seconds': 120, 'context_tokens': 200000},
+    'o4': {'timeout_seconds': 120, 'context_tokens': 200000},
+    'claude': {'context_tokens': 200000},
+    'claude-opus': {'timeout_seconds': 120}
+}
+
+def _load_model_catalog() -> Dict[str, Dict[str, Any]]:
+    catalog = {prefix: dict(entry) for prefix, entry in _DEFAULT_MODEL_CATALOG.items()}
+    source = (os.environ.get('PROXY_MODEL_CATALOG') or '').strip()
+    if not source:
+        return catalog
+    try:
+        if source.startswith('{'):
+            overrides = json.loads(source)
+        else:
+            with open(source, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+        for prefix, entry in overrides.items():
+            if isinstance(entry, dict):
+                catalog.setdefault(prefix, {}).update(entry)
+    except (OSError, ValueError) as e:
+        _log(f"[Lambda] WARNING: Could not load PROXY_MODEL_CATALOG: {str(e)}")
+    return catalog
+
+MODEL_CATALOG = _load_model_catalog()
+
+def _catalog_value(model: str, field: str) -> Any:
+    best_prefix = None
+    for prefix, entry in MODEL_CATALOG.items():
+        if prefix != '*' and field in entry and model.startswith(prefix):
+            if best_prefix is None or len(prefix) > len(best_prefix):
+                best_prefix = prefix
+    return MODEL_CATALOG[best_prefix or '*'].get(field, _DEFAULT_MODEL_CATALOG['*'][field])
+
+# Log-spaced latency buckets (seconds). Each histogram key counts observations per bucket.
+_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120, 180, 240, 300, float('inf'))
+_LATENCY_MAX_SAMPLES = 1000
+_latency_histograms: Dict[Tuple[str, str], List[int]] = {}
+_latency_lock = threading.Lock()
+
+def _latency_kind(is_streaming: bool, has_file_content: bool) -> str:
+    # Streaming timeouts guard time-to-first-byte; non-streaming ones the whole generation.
+    if is_streaming:
+        return 'ttfb'
+    return 'file' if has_file_content else 'full'
+
+def _record_latency(model: str, kind: str, seconds: float) -> None:
+    with _latency_lock:
+        counts = _latency_histograms.setdefault((model, kind), [0] * len(_LATENCY_BUCKETS))
+        for i, bound in enumerate(_LATENCY_BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        # Halve old counts so the histogram tracks recent behaviour
+        if sum(counts) > _LATENCY_MAX_SAMPLES:
+            counts[:] = [c // 2 for c in counts]
+
+def _latency_percentile(model: str, kind: str, percentile: float) -> Optional[float]:
+    """Upper bucket bound at the given percentile, or None until TIMEOUT_MIN_SAMPLES observations exist."""
+    with _latency_lock:
+        counts = list(_latency_histograms.get((model, kind), ()))
+    total = sum(counts)
+    if total < TIMEOUT_MIN_SAMPLES:
+        return None
+    threshold = total * percentile
+    running = 0
+    for bound, count in zip(_LATENCY_BUCKETS, counts):
+        running += count
+        if running >= threshold:
+            return bound
+    return None
+
+def _select_timeout(model: str, is_streaming: bool, has_file_content: bool) -> Tuple[float, str]:
+    """
+    Returns (timeout_seconds, source) where source is 'catalog' or 'adaptive'. The observed p99 can only raise
+    the timeout above the catalog value for the kind: a history of short replies says nothing about how long
+    the next long one needs.
+    """
+    if is_streaming:
+        catalog_timeout = _catalog_value(model, 'stream_timeout_seconds')
+    elif has_file_content:
+        catalog_timeout = _catalog_value(model, 'file_content_timeout_seconds')
+    else:
+        catalog_timeout = _catalog_value(model, 'timeout_seconds')
+    p99 = _latency_percentile(model, _latency_kind(is_streaming, has_file_content), 0.99)
+    if p99 is not None and p99 != float('inf') and p99 * TIMEOUT_P99_MULTIPLIER > catalog_timeout:
+        return min(max(p99 * TIMEOUT_P99_MULTIPLIER, TIMEOUT_MIN_SECONDS), TIMEOUT_MAX_SECONDS), 'adaptive'
+    return catalog_timeout, 'catalog'
+
+_RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504, 529)
+
+def _parse_duration_seconds(value: str) -> Optional[float]:
+    """Parse '1.5', '20ms', '6m0s', '1h2m3.5s' style durations (OpenAI x-ratelimit-reset-* headers)."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r'([0-9]*\.?[0-9]+)(ms|h|m|s)', value):
+        matched = True
+        total += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total if matched else None
+
+def _retry_after_seconds(headers: Any) -> Optional[float]:
+    """
+    Server-requested delay from Retry-After / retry-after-ms, or the rate-limit reset headers
+    (OpenAI x-ratelimit-reset-*, Anthropic anthropic-ratelimit-*-reset timestamps).
+    """
+    if headers is None:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        seconds = _parse_duration_seconds(retry_after)
+        if seconds is not None:
+            return seconds
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    hints = []
+    for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        if headers.get(name):
+            seconds = _parse_duration_seconds(headers.get(name))
+            if seconds is not None:
+                hints.append(seconds)
+    for name in ('anthropic-ratelimit-requests-reset', 'anthropic-ratelimit-tokens-reset',
+                 'anthropic-ratelimit-input-tokens-reset', 'anthropic-ratelimit-output-tokens-reset'):
+        if headers.get(name):
+            try:
+                from datetime import datetime
+                reset_at = datetime.fromisoformat(headers.get(name).replace('Z', '+00:00')).timestamp()
+                hints.append(max(0.0, reset_at - time.time()))
+            except ValueError:
+                pass
+    # Only wait for the limits that are actually exhausted; the smallest hint is the earliest reset
+    return min(hints) if hints else None
+
+def _urlopen_with_retries(url: str, data: Optional[bytes], headers: Dict[str, str], timeout: float,
+                          deadline: Optional[float], telemetry: Dict[str, Any], method: str = 'POST',
+                          urlopen: Any = None) -> _PooledResponse:
+    """
+    _pooled_urlopen (or an opener with the same contract, see lambda_streaming_handler) with retries for 429/5xx/529 responses and connect-phase failures. Timeouts and failures
+    after the request was sent (_RequestSentError) are not retried: the provider may already be generating.
+    Delays use full jitter exponential backoff, or the provider's Retry-After / rate-limit reset hint when
+    given. A retry is only attempted if the wait plus the request timeout still fits before 'deadline'
+    (time.monotonic() based); otherwise the last error is raised for the handler to report.
+    """
+    # Hedged candidates fail over to the next candidate instead of retrying; cancelled calls are never retried
+    scope = _current_cancel_scope()
+    max_attempts = 1 if scope is not None and not scope.allow_retries else RETRY_MAX_ATTEMPTS
+    urlopen = urlopen or _pooled_urlopen
+    attempt = 1
+    while True:
+        try:
+            return urlopen(url, data, headers, timeout, telemetry, method)
+        except urllib.error.HTTPError as e:
+            if e.code not in _RETRIABLE_STATUS_CODES or attempt >= max_attempts or (scope is not None and scope.cancelled):
+                raise
+            hinted = _retry_after_seconds(e.headers)
+            error = e
+        except urllib.error.URLError as e:
+            if (isinstance(e, _RequestSentError) or 'timed out' in str(e).lower() or attempt >= max_attempts
+                    or (scope is not None and scope.cancelled)):
+                raise
+            hinted = None
+            error = e
+
+        import random
+        backoff = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt)))
+        delay = hinted if hinted is not None else backoff
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if delay + min(timeout, TIMEOUT_MIN_SECONDS) > remaining:
+                _debug_log(f"[Lambda] Not retrying: {delay:.1f}s wait doesn't fit the remaining {remaining:.1f}s")
+                raise error
+            timeout = min(timeout, remaining - delay)
+        _log(f"[Lambda] Upstream attempt {attempt} failed ({getattr(error, 'code', type(error).__name__)}), retrying in {delay:.2f}s")
+        telemetry['retries'] = attempt
+        sleep_started = time.perf_counter()
+        time.sleep(delay)
+        _phase_done(telemetry, 'retry_wait', sleep_started)
+        attempt += 1
+
+# Offline token estimation. Characters per token for mostly-ASCII text (prose and code) per
+# provider family; non-ASCII characters are counted as roughly one token each.
+_CHARS_PER_TOKEN = {'openai': 3.8, 'anthropic': 3.4}
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_REQUEST = 3
+_FILE_CONTENT_MARKER = 'Current File Content'
+# Observed actual/estimated ratio per family, updated from provider usage on warm instances
+_token_calibration: Dict[str, float] = {}
+_token_calibration_lock = threading.Lock()
+
+def _estimate_text_tokens(text: str, family: str) -> int:
+    if not text:
+        return 0
+    if text.isascii():
+        estimate = len(text) / _CHARS_PER_TOKEN[family]
+    else:
+        non_ascii = sum(1 for c in text if ord(c) > 127)
+        estimate = (len(text) - non_ascii) / _CHARS_PER_TOKEN[family] + non_ascii
+    return int(estimate) + 1
+
+def _estimate_content_tokens(content: Any, family: str) -> int:
+    """Tokens of a message 'content' or 'system' value (string or list of content blocks)."""
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return _estimate_text_tokens(content, family)
+    if isinstance(content, list):
+        total = 0
+        for block in content:
+            if isinstance(block, dict) and isinstance(block.get('text'), str):
+                total += _estimate_text_tokens(block['text'], family)
+            else:
+                total += _estimate_text_tokens(json.dumps(block), family)
+        return total
+    return _estimate_text_tokens(str(content), family)
+
+def _estimate_message_tokens(message: Dict[str, Any], family: str) -> int:
+    return _TOKENS_PER_MESSAGE + _estimate_content_tokens(message.get('content'), family)
+
+def _calibrated(estimate: int, family: str) -> int:
+    with _token_calibration_lock:
+        factor = _token_calibration.get(family, 1.0)
+    return int(estimate * factor)
+
+def _record_token_calibration(family: str, estimated: int, actual: int) -> None:
+    """Fold an (estimated, actual) input-token pair into the family's correction factor."""
+    if estimated < 100 or actual <= 0:
+        return
+    with _token_calibration_lock:
+        raw_estimate = estimated / _token_calibration.get(family, 1.0)
+        ratio = min(max(actual / raw_estimate, 0.5), 2.0)
+        previous = _token_calibration.get(family)
+        _token_calibration[family] = ratio if previous is None else previous * 0.8 + ratio * 0.2
+
+def _actual_input_tokens(provider: str, usage: Any) -> Optional[int]:
+    """Total input tokens billed by the provider, including prompt-cache reads/writes."""
+    if not isinstance(usage, dict) or not isinstance(usage.get('input_tokens'), int):
+        return None
+    if provider == 'Claude':
+        return (usage['input_tokens'] + (usage.get('cache_read_input_tokens') or 0)
+                + (usage.get('cache_creation_input_tokens') or 0))
+    return usage['input_tokens']
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get('content')
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') for block in content if isinstance(block, dict) and isinstance(block.get('text'), str))
+    return ''
+
+def _context_budget_tokens(headers: Dict[str, Any], request_data: Dict[str, Any], model: str, max_output_tokens: int) -> int:
+    """Input token budget for this request; 0 disables trimming."""
+    if not CONTEXT_TRIM_ENABLED or (_get_header(headers, 'X-Proxy-Context-Trim') or '').strip().lower() == 'off':
+        return 0
+    requested = request_data.get('context_budget_tokens')
+    if isinstance(requested, int) and not isinstance(requested, bool) and requested > 0:
+        return requested
+    if CONTEXT_BUDGET_TOKENS > 0:
+        return CONTEXT_BUDGET_TOKENS
+    return max(0, int((_catalog_value(model, 'context_tokens') - max_output_tokens) * CONTEXT_BUDGET_RATIO))
+
+def _fit_context_budget(request_data: Dict[str, Any], family: str, budget: int) -> Tuple[int, int, int]:
+    """
+    Estimate the input tokens of request_data and, when they exceed 'budget', shrink request_data['messages']
+    in place. Policy: system messages, the last CONTEXT_KEEP_TURNS turns and the latest file content message
+    are always kept. Older file content snapshots are compacted first, then the oldest turns are dropped until
+    the estimate fits. Returns (estimated_tokens, dropped_messages, compacted_messages).
+    """
+    messages = list(request_data.get('messages') or [])
+    fixed = _TOKENS_PER_REQUEST + _estimate_content_tokens(request_data.get('system'), family)
+    costs = [_calibrated(_estimate_message_tokens(m, family), family) for m in messages]
+    total = _calibrated(fixed, family) + sum(costs)
+    if budget <= 0 or total <= budget:
+        return total, 0, 0
+
+    def role(i: int) -> str:
+        return (messages[i].get('role') or '').strip().lower()
+
+    turns = [i for i in range(len(messages)) if role(i) != 'system']
+    protected = set(turns[-CONTEXT_KEEP_TURNS:]) if CONTEXT_KEEP_TURNS > 0 else set()
+    file_turns = [i for i in turns if _FILE_CONTENT_MARKER in _message_text(messages[i])]
+    if file_turns:
+        protected.add(file_turns[-1])
+
+    compacted = 0
+    for i in file_turns:
+        if total <= budget:
+            break
+        if i in protected:
+            continue
+        messages[i] = {'role': messages[i].get('role'), 'content': '[Earlier file content omitted to fit the context budget]'}
+        new_cost = _calibrated(_estimate_message_tokens(messages[i], family), family)
+        total -= costs[i] - new_cost
+        costs[i] = new_cost
+        compacted += 1
+
+    dropped = set()
+    for i in turns:
+        if total <= budget:
+            break
+        if i not in protected:
+            dropped.add(i)
+            total -= costs[i]
+    # Conversations must still open with a user turn after older turns are dropped
+    if dropped:
+        remaining = [i for i in turns if i not in dropped]
+        while len(remaining) > 1 and role(remaining[0]) == 'assistant':
+            dropped.add(remaining[0])
+            total -= costs[remaining.pop(0)]
+
+    request_data['messages'] = [m for i, m in enumerate(messages) if i not in dropped]
+    return total, len(dropped), compacted
+
+ANTHROPIC_MAX_CACHE_BREAKPOINTS = 4
+
+# '<namespace>:<model>' -> last system prompt seen; used to learn which prefix of the system prompt is stable.
+_system_prompt_history: 'OrderedDict[str, str]' = OrderedDict()
+_SYSTEM_PROMPT_HISTORY_MAX = 256
+_system_prompt_lock = threading.Lock()
+
+def _prompt_cache_enabled(headers: Dict[str, Any]) -> bool:
+    override = _get_header(headers, 'X-Proxy-Prompt-Cache').lower()
+    if override:
+        return override not in ('0', 'off', 'false', 'no')
+    return PROMPT_CACHE_ENABLED
+
+def _split_stable_system_prompt(history_key: str, system: str) -> List[str]:
+    """
+    Split the system prompt into [stable prefix, volatile tail] at a paragraph boundary, using the
+    common prefix with the previous system prompt from the same caller/model. The Unity client puts
+    fixed instructions first and per-turn context (knowledge base, current file) after them.
+    """
+    with _system_prompt_lock:
+        previous = _system_prompt_history.pop(history_key, None)
+        _system_prompt_history[history_key] = system
+        while len(_system_prompt_history) > _SYSTEM_PROMPT_HISTORY_MAX:
+            _system_prompt_history.popitem(last=False)
+    if not previous or previous == system:
+        return [system]
+    common = os.path.commonprefix([previous, system])
+    cut = common.rfind('\n\n')
+    if cut < PROMPT_CACHE_MIN_CHARS:
+        return [system]
+    return [system[:cut + 2], system[cut + 2:]]
+
+def _text_block(text: str, cache: bool) -> Dict[str, Any]:
+    block: Dict[str, Any] = {'type': 'text', 'text': text}
+    if cache:
+        block['cache_control'] = {'type': 'ephemeral'}
+    return block
+
+def _with_cache_breakpoint(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a Claude message with a cache breakpoint on its last content block."""
+    content = msg.get('content', '')
+    if isinstance(content, str):
+        blocks = [_text_block(content, True)]
+    elif isinstance(content, list) and content and isinstance(content[-1], dict):
+        blocks = list(content[:-1]) + [dict(content[-1], cache_control={'type': 'ephemeral'})]
+    else:
+        return msg
+    return dict(msg, content=blocks)
+
+def _message_text_length(msg: Dict[str, Any]) -> int:
+    content = msg.get('content', '')
+    if isinstance(content, list):
+        return sum(len(str(part.get('text', ''))) if isinstance(part, dict) else len(str(part)) for part in content)
+    return len(str(content))
+
+def _apply_anthropic_prompt_cache(claude_request: Dict[str, Any], history_key: str) -> None:
+    """
+    Place cache_control breakpoints (max 4): the stable part of the system prompt, the end of the
+    previous turn (cache read on this request) and the last message (cache write for the next turn).
+    """
+    breakpoints = 0
+    prefix_chars = 0
+    system = claude_request.get('system')
+    if isinstance(system, str) and system:
+        parts = _split_stable_system_prompt(history_key, system)
+        blocks = []
+        for part in parts:
+            prefix_chars += len(part)
+            cache = breakpoints == 0 and prefix_chars >= PROMPT_CACHE_MIN_CHARS
+            breakpoints += 1 if cache else 0
+            blocks.append(_text_block(part, cache))
+        claude_request['system'] = blocks
+
+    messages = list(claude_request.get('messages') or [])
+    if not messages:
+        return
+    user_indexes = [i for i, msg in enumerate(messages) if isinstance(msg, dict) and msg.get('role') == 'user']
+    candidates = [len(messages) - 1]
+    if len(user_indexes) >= 2:
+        candidates.insert(0, user_indexes[-2])
+    running = prefix_chars
+    lengths = [_message_text_length(msg) if isinstance(msg, dict) else 0 for msg in messages]
+    for index in candidates:
+        if breakpoints >= ANTHROPIC_MAX_CACHE_BREAKPOINTS:
+            break
+        if running + sum(lengths[:index + 1]) < PROMPT_CACHE_MIN_CHARS:
+            continue
+        messages[index] = _with_cache_breakpoint(messages[index])
+        breakpoints += 1
+    claude_request['messages'] = messages
+
+def _openai_prompt_cache_key(namespace: str, model: str, instructions: Optional[str]) -> str:
+    """Stable routing key so requests sharing the same instructions land on warm prompt-cache shards."""
+    digest = hashlib.sha256(f'{namespace}\0{model}\0{instructions or ""}'.encode('utf-8')).hexdigest()
+    return f'aieditoragent-{digest[:32]}'
+
+def _prompt_cache_usage(provider: str, usage: Any) -> Dict[str, int]:
+    """Cache read/write token counts from a provider 'usage' object."""
+    if not isinstance(usage, dict):
+        return {}
+    if provider == 'Claude':
+        return {
+            'cache_read_tokens': usage.get('cache_read_input_tokens') or 0,
+            'cache_write_tokens': usage.get('cache_creation_input_tokens') or 0
+        }
+    details = usage.get('input_tokens_details') or {}
+    return {'cache_read_tokens': details.get('cached_tokens') or 0, 'cache_write_tokens': 0}
+
+class BlobStore:
+    """
+    Backend interface for the content-addressed blob store. Keys are '<namespace>/<sha256 hex>';
+    the namespace is derived from the caller's API key so blobs are never shared across keys.
+    Implementations must be safe to call from multiple threads.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def put(self, key: str, content: str) -> None:
+        raise NotImplementedError
+
+    def contains(self, key: str) -> bool:
+        return self.get(key) is not None
+
+class TieredBlobStore(BlobStore):
+    """
+    In-memory LRU; entries evicted from memory spill to a size-capped directory under /tmp.
+    Blobs are content-addressed, so a key never changes once written; stores of mutable records
+    (sessions) use write_through, which writes every put to disk so a spilled copy is never stale.
+    """
+
+    def __init__(self, memory_max_bytes: int = BLOB_MEMORY_MAX_BYTES, disk_max_bytes: int = BLOB_DISK_MAX_BYTES,
+                 directory: str = BLOB_DIR, write_through: bool = False):
+        self._memory: 'OrderedDict[str, str]' = OrderedDict()
+        self._memory_bytes = 0
+        self._memory_max_bytes = memory_max_bytes
+        self._disk_max_bytes = disk_max_bytes
+        self._directory = directory
+        self._write_through = write_through
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key.replace('/', '_'))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            content = self._memory.get(key)
+            if content is not None:
+                self._memory.move_to_end(key)
+                return content
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError:
+            return None
+        os.utime(self._path(key))
+        self._remember(key, content)
+        return content
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        return os.path.exists(self._path(key))
+
+    def put(self, key: str, content: str) -> None:
+        self._remember(key, content)
+        if self._write_through:
+            self._spill(key, content)
+
+    def _remember(self, key: str, content: str) -> None:
+        spilled = []
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = content
+            self._memory_bytes += len(content)
+            while self._memory_bytes > self._memory_max_bytes and len(self._memory) > 1:
+                evicted_key, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                spilled.append((evicted_key, evicted))
+        if self._write_through:
+            return  # Already on disk
+        for evicted_key, evicted in spilled:
+            self._spill(evicted_key, evicted)
+
+    def _spill(self, key: str, content: str) -> None:
+        path = self._path(key)
+        if not self._write_through and os.path.exists(path):
+            os.utime(path)
+            return
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            _log(f"[Lambda] WARNING: Could not spill blob to disk: {str(e)}")
+            return
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        try:
+            entries = []
+            for name in os.listdir(self._directory):
+                path = os.path.join(self._directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class RateLimitBackend:
+    """
+    Token bucket state for admission control. Each key has one bucket per dimension ('requests', 'tokens');
+    'rates' are refill rates per second and a bucket holds at most one minute of refill.
+    Implementations must be atomic across all callers sharing the state.
+    """
+
+    def wait_time(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        """Seconds until 'costs' would be available in every bucket (0 = now). Takes nothing."""
+        raise NotImplementedError
+
+    def take(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        """Take 'costs' from every bucket if all have enough and return 0; otherwise take nothing and return wait_time."""
+        raise NotImplementedError
+
+    def block(self, key: str, seconds: float) -> None:
+        """Hold the key back for 'seconds' (upstream asked us to back off)."""
+        raise NotImplementedError
+
+def _bucket_wait(levels: Dict[str, Tuple[float, float]], costs: Dict[str, float], rates: Dict[str, float],
+                 blocked_until: float, now: float) -> Tuple[float, Dict[str, float]]:
+    """
+    Shared token bucket math. 'levels' maps dimension -> (level, updated_at); missing buckets start full.
+    Returns (wait_seconds, refilled levels).
+    """
+    wait = max(0.0, blocked_until - now)
+    refilled = {}
+    for dim, rate in rates.items():
+        capacity = rate * 60
+        level, updated = levels.get(dim, (capacity, now))
+        level = min(capacity, level + (now - updated) * rate)
+        refilled[dim] = level
+        cost = min(costs.get(dim, 0.0), capacity)
+        if level < cost:
+            wait = max(wait, (cost - level) / rate)
+    return wait, refilled
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Per-instance buckets (warm Lambda instance or one self-hosted server process)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._levels: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        self._blocked_until: Dict[str, float] = {}
+
+    def wait_time(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        with self._lock:
+            return _bucket_wait(self._levels.get(key, {}), costs, rates, self._blocked_until.get(key, 0.0), time.time())[0]
+
+    def take(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        now = time.time()
+        with self._lock:
+            wait, refilled = _bucket_wait(self._levels.get(key, {}), costs, rates, self._blocked_until.get(key, 0.0), now)
+            if wait > 0:
+                return wait
+            self._levels[key] = {dim: (level - min(costs.get(dim, 0.0), rates[dim] * 60), now) for dim, level in refilled.items()}
+            return 0.0
+
+    def block(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until[key] = max(self._blocked_until.get(key, 0.0), time.time() + seconds)
+
+class SqliteRateLimitBackend(RateLimitBackend):
+    """Buckets in a SQLite file, shared by every proxy process on the host (e.g. several proxy_server.py workers)."""
+
+    def __init__(self, path: str):
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT, dim TEXT, level REAL, updated REAL, PRIMARY KEY (key, dim))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, until REAL)')
+
+    def _state(self, key: str) -> Tuple[Dict[str, Tuple[float, float]], float]:
+        levels = {dim: (level, updated) for dim, level, updated in
+                  self._db.execute('SELECT dim, level, updated FROM buckets WHERE key = ?', (key,))}
+        row = self._db.execute('SELECT until FROM blocks WHERE key = ?', (key,)).fetchone()
+        return levels, row[0] if row else 0.0
+
+    def wait_time(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        with self._lock:
+            levels, blocked_until = self._state(key)
+            return _bucket_wait(levels, costs, rates, blocked_until, time.time())[0]
+
+    def take(self, key: str, costs: Dict[str, float], rates: Dict[str, float]) -> float:
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                levels, blocked_until = self._state(key)
+                wait, refilled = _bucket_wait(levels, costs, rates, blocked_until, now)
+                if wait == 0:
+                    self._db.executemany('INSERT OR REPLACE INTO buckets (key, dim, level, updated) VALUES (?, ?, ?, ?)', [
+                        (key, dim, level - min(costs.get(dim, 0.0), rates[dim] * 60), now) for dim, level in refilled.items()
+                    ])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            return wait
+
+    def block(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._db.execute('INSERT INTO blocks (key, until) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET until = MAX(until, excluded.until)',
+                             (key, time.time() + seconds))
+
+_rate_limit_backend: Optional[RateLimitBackend] = None
+
+def set_rate_limit_backend(backend: RateLimitBackend) -> None:
+    global _rate_limit_backend
+    _rate_limit_backend = backend
+
+def get_rate_limit_backend() -> RateLimitBackend:
+    global _rate_limit_backend
+    if _rate_limit_backend is None:
+        if RATE_LIMIT_BACKEND in ('', 'memory'):
+            _rate_limit_backend = InMemoryRateLimitBackend()
+        elif RATE_LIMIT_BACKEND.startswith('sqlite:'):
+            _rate_limit_backend = SqliteRateLimitBackend(RATE_LIMIT_BACKEND[len('sqlite:'):])
+        else:
+            import importlib
+            module_name, _, class_name = RATE_LIMIT_BACKEND.partition(':')
+            _rate_limit_backend = getattr(importlib.import_module(module_name), class_name)()
+    return _rate_limit_backend
+
+def _rate_limit_rates() -> Dict[str, float]:
+    rates = {}
+    if RATE_LIMIT_RPM > 0:
+        rates['requests'] = RATE_LIMIT_RPM / 60.0
+    if RATE_LIMIT_TPM > 0:
+        rates['tokens'] = RATE_LIMIT_TPM / 60.0
+    return rates
+
+class _AdmissionQueue:
+    """
+    Bounded wait queue in front of the rate limit backend. Per key, waiting requests are grouped by client
+    and served round-robin, so one busy editor can't starve the others sharing an API key. Only the ticket
+    at the head of the fair order may take from the buckets; everyone else waits on the condition.
+    Backend calls (which may block, e.g. on a locked SQLite file) run outside the condition, which only
+    guards the queue bookkeeping; a per-key 'taking' mark keeps one take in flight per key.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # key -> client -> tickets (oldest first); dict order is the round-robin order of clients
+        self._waiting: Dict[str, 'OrderedDict[str, List[object]]'] = {}
+        self._queued_costs: Dict[str, Dict[str, float]] = {}
+        self._taking: set = set()
+        self.size = 0
+
+    def _head(self, key: str) -> Optional[object]:
+        clients = self._waiting.get(key)
+        if not clients:
+            return None
+        return next(iter(clients.values()))[0]
+
+    def _remove(self, key: str, client: str, ticket: object, costs: Dict[str, float], served: bool) -> None:
+        clients = self._waiting[key]
+        clients[client].remove(ticket)
+        if not clients[client]:
+            del clients[client]
+        elif served:
+            clients.move_to_end(client)
+        if not clients:
+            del self._waiting[key]
+        for dim, cost in costs.items():
+            self._queued_costs[key][dim] -= cost
+        self.size -= 1
+        self._cond.notify_all()
+
+    def _done_taking(self, key: str) -> None:
+        self._taking.discard(key)
+        self._cond.notify_all()
+
+    def admit(self, backend: RateLimitBackend, key: str, client: str, costs: Dict[str, float],
+              rates: Dict[str, float], max_wait: float) -> Tuple[bool, float, float]:
+        """Returns (admitted, waited_seconds, retry_after_seconds)."""
+        started = time.monotonic()
+        with self._cond:
+            fast_path = self._head(key) is None and key not in self._taking
+            if fast_path:
+                self._taking.add(key)
+            queued = dict(self._queued_costs.get(key, {}))
+        if fast_path:
+            try:
+                if backend.take(key, costs, rates) == 0:
+                    return True, 0.0, 0.0
+            finally:
+                with self._cond:
+                    self._done_taking(key)
+
+        # Everyone already queued for this key goes first, so Retry-After covers their costs too
+        ahead = {dim: queued.get(dim, 0.0) + costs.get(dim, 0.0) for dim in rates}
+        expected_wait = backend.wait_time(key, ahead, rates)
+        ticket = object()
+        with self._cond:
+            if self.size >= ADMISSION_MAX_QUEUE or expected_wait > max_wait:
+                return False, 0.0, expected_wait
+            self._waiting.setdefault(key, OrderedDict()).setdefault(client, []).append(ticket)
+            queued = self._queued_costs.setdefault(key, {})
+            for dim, cost in costs.items():
+                queued[dim] = queued.get(dim, 0.0) + cost
+            self.size += 1
+        deadline = started + max_wait
+
+        while True:
+            with self._cond:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._remove(key, client, ticket, costs, served=False)
+                        break
+                    if self._head(key) is ticket and key not in self._taking:
+                        self._taking.add(key)
+                        break
+                    self._cond.wait(remaining)
+            if remaining <= 0:
+                return False, time.monotonic() - started, backend.wait_time(key, costs, rates)
+            try:
+                wait = backend.take(key, costs, rates)
+            except Exception:
+                with self._cond:
+                    self._done_taking(key)
+                    self._remove(key, client, ticket, costs, served=False)
+                raise
+            with self._cond:
+                self._done_taking(key)
+                if wait == 0:
+                    self._remove(key, client, ticket, costs, served=True)
+                    return True, time.monotonic() - started, 0.0
+                # Still the head: sleep until the buckets refill (or the deadline), then take again
+                self._cond.wait(max(0.0, min(wait, deadline - time.monotonic())))
+
+_admission_queue = _AdmissionQueue()
+
+def _admission_client(event: Dict[str, Any], headers: Dict[str, Any]) -> str:
+    """Fairness identity: X-Proxy-Client-Id if the client sends one, otherwise the caller's IP."""
+    client = _get_header(headers, 'X-Proxy-Client-Id')
+    if client:
+        return client
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    return event.get('sourceIp') or identity.get('sourceIp') or 'anonymous'
+
+def _rate_limited_response(retry_after: float) -> Dict[str, Any]:
+    retry_after_header = str(max(1, int(retry_after + 0.999)))
+    return _json_response(429, {
+        'error': f'Rate limit reached for this API key. Retry after {retry_after_header}s.',
+        'error_type': 'rate_limited',
+        'retry_after_seconds': round(retry_after, 2)
+    }, {'Retry-After': retry_after_header})
+
+_blob_store: Optional[BlobStore] = None
+
+def set_blob_store(store: BlobStore) -> None:
+    """Install a custom blob store backend (e.g. one backed by a shared cache)."""
+    global _blob_store
+    _blob_store = store
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        if BLOB_STORE_BACKEND in ('', 'memory'):
+            _blob_store = TieredBlobStore()
+        else:
+            import importlib
+            module_name, _, class_name = BLOB_STORE_BACKEND.partition(':')
+            _blob_store = getattr(importlib.import_module(module_name), class_name)()
+    return _blob_store
+
+def _blob_namespace(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+def _is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and isinstance(value.get('blob_ref'), str)
+
+def _expand_blob_content(content: Any, namespace: str, missing: List[str]) -> Any:
+    """
+    Resolve blob placeholders in a message content value. A content of {"blob_ref": ...}
+    becomes the blob text; a list of strings / text parts / blob refs is joined into one string.
+    Unresolvable refs are appended to 'missing'.
+    """
+    if _is_blob_ref(content):
+        ref = content['blob_ref'].strip().lower()
+        text = get_blob_store().get(f'{namespace}/{ref}')
+        if text is None:
+            missing.append(ref)
+            return ''
+        return text
+    if isinstance(content, list) and any(_is_blob_ref(part) for part in content):
+        pieces = []
+        for part in content:
+            if _is_blob_ref(part):
+                pieces.append(_expand_blob_content(part, namespace, missing))
+            elif isinstance(part, dict):
+                pieces.append(str(part.get('text', '')))
+            else:
+                pieces.append(str(part))
+        return ''.join(pieces)
+    return content
+
+def _expand_blob_refs(request_data: Dict[str, Any], namespace: str) -> List[str]:
+    """Expand blob placeholders in 'system' and 'messages' in place. Returns the refs that were not found."""
+    missing: List[str] = []
+    if 'system' in request_data:
+        request_data['system'] = _expand_blob_content(request_data['system'], namespace, missing)
+    for msg in request_data.get('messages', []) or []:
+        if isinstance(msg, dict) and 'content' in msg:
+            msg['content'] = _expand_blob_content(msg['content'], namespace, missing)
+    return sorted(set(missing))
+
+def _handle_blob_upload(event: Dict[str, Any], telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    POST /blobs with {"content": "..."} or {"contents": ["...", ...]} (optionally "blob_ref"/"blob_refs"
+    with the expected hashes). Responds with the sha256 refs to use as {"blob_ref": ...} placeholders.
+    """
+    event = normalize_event(event)
+    headers = event.get('headers', {}) or {}
+    telemetry['route'] = 'blobs'
+    api_key, auth_header = _extract_api_key(headers)
+    if not api_key:
+        return _missing_api_key_response(headers, auth_header)
+    request_data, error_response = _parse_request_body(event, headers)
+    if error_response:
+        return error_response
+
+    contents = request_data.get('contents') if isinstance(request_data, dict) else None
+    if contents is None and isinstance(request_data, dict) and 'content' in request_data:
+        contents = [request_data['content']]
+    if not isinstance(contents, list) or not contents or not all(isinstance(c, str) for c in contents):
+        return _json_response(400, {'error': 'Expected "content" (string) or "contents" (array of strings) in request body'})
+
+    expected = request_data.get('blob_refs') or ([request_data['blob_ref']] if request_data.get('blob_ref') else [])
+    namespace = _blob_namespace(api_key)
+    store = get_blob_store()
+    refs = []
+    for i, content in enumerate(contents):
+        ref = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if i < len(expected) and isinstance(expected[i], str) and expected[i].strip().lower() != ref:
+            return _json_response(400, {'error': f'Content hash mismatch for item {i}', 'expected': expected[i], 'actual': ref})
+        store.put(f'{namespace}/{ref}', content)
+        refs.append({'blob_ref': ref, 'size': len(content)})
+    telemetry['blobs_stored'] = len(refs)
+    return _json_response(200, {'blobs': refs})
+
+_session_store: Optional[BlobStore] = None
+_SESSION_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+def set_session_store(store: BlobStore) -> None:
+    global _session_store
+    _session_store = store
+
+def get_session_store() -> BlobStore:
+    global _session_store
+    if _session_store is None:
+        if SESSION_STORE_BACKEND in ('', 'memory'):
+            _session_store = TieredBlobStore(SESSION_MEMORY_MAX_BYTES, SESSION_DISK_MAX_BYTES, SESSION_DIR, write_through=True)
+        else:
+            import importlib
+            module_name, _, class_name = SESSION_STORE_BACKEND.partition(':')
+            _session_store = getattr(importlib.import_module(module_name), class_name)()
+    return _session_store
+
+def _session_request(headers: Dict[str, Any], request_data: Dict[str, Any]) -> Tuple[Optional[str], bool, Optional[str]]:
+    """(session_id, reset, error) from X-Proxy-Session / 'session_id' and X-Proxy-Session-Reset / 'session_reset'."""
+    session_id = _get_header(headers, 'X-Proxy-Session') or request_data.get('session_id')
+    if not session_id:
+        return None, False, None
+    if not isinstance(session_id, str) or not _SESSION_ID.match(session_id.strip()):
+        return None, False, 'Session ids are 1-128 characters of letters, digits and ._:-'
+    reset = _get_header(headers, 'X-Proxy-Session-Reset') or request_data.get('session_reset')
+    return session_id.strip(), str(reset).strip().lower() in ('1', 'true', 'on', 'yes'), None
+
+def _session_key(api_key: str, session_id: str) -> str:
+    return f"{_blob_namespace(api_key)}/session-{hashlib.sha256(session_id.encode('utf-8')).hexdigest()}"
+
+def _load_session(key: str) -> Optional[Dict[str, Any]]:
+    """The stored session state, or None when it is unknown or older than SESSION_TTL_SECONDS."""
+    raw = get_session_store().get(key)
+    try:
+        record = json.loads(raw) if raw is not None else None
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or time.time() - (record.get('updated_at') or 0) > SESSION_TTL_SECONDS:
+        return None
+    return record
+
+def _is_system_message(msg: Any) -> bool:
+    return isinstance(msg, dict) and (msg.get('role') or '').strip().lower() == 'system'
+
+def _save_session(session: Dict[str, Any], reply_text: str, response_id: Optional[str]) -> None:
+    """Store the session with this turn and the assistant's reply appended to its history."""
+    record = {
+        'provider': session['provider'],
+        'model': session['model'],
+        'updated_at': time.time(),
+        'messages': session['messages'] + [{'role': 'assistant', 'content': reply_text}],
+        'previous_response_id': response_id
+    }
+    try:
+        get_session_store().put(session['key'], json.dumps(record, ensure_ascii=False))
+    except Exception as e:
+        _log(f"[Lambda] WARNING: Could not store session: {type(e).__name__}: {str(e)}")
+
+class _SessionStage:
+    """
+    Pass provider events through while collecting the reply text; the session is saved when the reply ends
+    (message_stop, response.completed, or response.incomplete for a reply cut short by max_output_tokens).
+    One framed chunk can hold several events, so each is split into its events before parsing.
+    """
+
+    def __init__(self, provider: str, session: Dict[str, Any]):
+        self._session = session
+        self._parts: List[str] = []
+
+    def feed(self, framed: bytes) -> List[bytes]:
+        for block in framed.replace(b'\r\n', b'\n').split(b'\n\n'):
+            if not block.strip():
+                continue
+            event_name, data, _ = _parse_sse_block(block)
+            if not isinstance(data, dict):
+                continue
+            kind = data.get('type') or event_name
+            if kind == 'content_block_delta' and (data.get('delta') or {}).get('type') == 'text_delta':
+                self._parts.append(data['delta'].get('text') or '')
+            elif kind == 'response.output_text.delta':
+                self._parts.append(data.get('delta') or '')
+            elif kind == 'message_stop':
+                _save_session(self._session, ''.join(self._parts), None)
+            elif kind in ('response.completed', 'response.incomplete'):
+                _save_session(self._session, ''.join(self._parts), (data.get('response') or {}).get('id'))
+        return [framed]
+
+def _iter_session_events(events: Iterable[bytes], provider: str, session: Dict[str, Any]) -> Iterator[bytes]:
+    stage = _SessionStage(provider, session)
+    for framed in events:
+        yield from stage.feed(framed)
+
+def _zstd_module() -> Any:
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+class _UnsupportedEncodingError(ValueError):
+    pass
+
+def _decompress_request_body(raw: bytes, content_encoding: str) -> bytes:
+    """
+    Decode a Content-Encoding'd request body, refusing to inflate past MAX_REQUEST_BODY_BYTES.
+    Raises _UnsupportedEncodingError for unknown encodings (or zstd without the zstandard package).
+    """
+    if content_encoding in ('', 'identity'):
+        return raw
+    if content_encoding in ('gzip', 'x-gzip', 'deflate'):
+        decoder = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        decoded = decoder.decompress(raw, MAX_REQUEST_BODY_BYTES + 1)
+    elif content_encoding == 'zstd':
+        zstandard = _zstd_module()
+        if zstandard is None:
+            raise _UnsupportedEncodingError('zstd request bodies require the zstandard package')
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw))
+        decoded = b''
+        while len(decoded) <= MAX_REQUEST_BODY_BYTES:
+            block = reader.read(MAX_REQUEST_BODY_BYTES + 1 - len(decoded))
+            if not block:
+                break
+            decoded += block
+    else:
+        raise _UnsupportedEncodingError(f'Unsupported Content-Encoding: {content_encoding}')
+    if len(decoded) > MAX_REQUEST_BODY_BYTES:
+        raise ValueError(f'Decompressed request body exceeds {MAX_REQUEST_BODY_BYTES} bytes')
+    return decoded
+
+def _negotiate_response_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick 'zstd' or 'gzip' from the client's Accept-Encoding (q=0 excluded), or None."""
+    accepted = set()
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip())
+    if 'zstd' in accepted and _zstd_module() is not None:
+        return 'zstd'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+def _stream_compressor(encoding: str) -> Tuple[Any, Tuple[Any, ...]]:
+    """(compressor, flush args) that flush after every chunk so each SSE event is decodable on arrival."""
+    if encoding == 'zstd':
+        zstandard = _zstd_module()
+        return zstandard.ZstdCompressor(level=3).compressobj(), (zstandard.COMPRESSOBJ_FLUSH_BLOCK,)
+    return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16), (zlib.Z_SYNC_FLUSH,)
+
+def _iter_compressed(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """Compress a streamed body, flushing after every chunk so each SSE event is decodable on arrival."""
+    compressor, flush_args = _stream_compressor(encoding)
+    for chunk in chunks:
+        out = compressor.compress(chunk) + compressor.flush(*flush_args)
+        if out:
+            yield out
+    tail = compressor.flush()
+    if tail:
+        yield tail
+
+async def _aclose(chunks: AsyncIterable[bytes]) -> None:
+    """Close an async body now (e.g. when the client went away) instead of whenever it is garbage collected."""
+    aclose = getattr(chunks, 'aclose', None)
+    if aclose is not None:
+        await aclose()
+
+async def _aiter_compressed(chunks: AsyncIterable[bytes], encoding: str) -> AsyncIterator[bytes]:
+    compressor, flush_args = _stream_compressor(encoding)
+    try:
+        async for chunk in chunks:
+            out = compressor.compress(chunk) + compressor.flush(*flush_args)
+            if out:
+                yield out
+        tail = compressor.flush()
+        if tail:
+            yield tail
+    finally:
+        await _aclose(chunks)
+
+def _compress_result(result: Dict[str, Any], accept_encoding: str) -> Dict[str, Any]:
+    """
+    Compress a handler result in place when the client accepts it.
+    Buffered bodies are base64-encoded (isBase64Encoded) as Lambda integrations require for binary data.
+    """
+    encoding = _negotiate_response_encoding(accept_encoding) if accept_encoding else None
+    body = result.get('body')
+    if encoding is None or body is None or result.get('isBase64Encoded'):
+        return result
+    headers = result.setdefault('headers', {})
+    if isinstance(body, str):
+        raw = body.encode('utf-8')
+        if len(raw) < COMPRESS_MIN_BYTES:
+            return result
+        if encoding == 'zstd':
+            compressed = _zstd_module().ZstdCompressor(level=3).compress(raw)
+        else:
+            import gzip
+            compressed = gzip.compress(raw, compresslevel=6)
+        import base64
+        result['body'] = base64.b64encode(compressed).decode('ascii')
+        result['isBase64Encoded'] = True
+    elif hasattr(body, '__aiter__'):
+        result['body'] = _aiter_compressed(body, encoding)
+    else:
+        result['body'] = _iter_compressed(body, encoding)
+    headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+    return result
+
+def _iter_upstream_chunks(response: Any, chunk_size: int = STREAM_READ_CHUNK_BYTES) -> Iterator[bytes]:
+    """
+    Yield raw bytes from the upstream response as soon as they are available.
+    read1() returns whatever is buffered (at most chunk_size) instead of blocking until chunk_size bytes arrive.
+    """
+    read = getattr(response, 'read1', None) or response.read
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+class _SpillBuffer:
+    """
+    The single owned copy of one upstream body: a bytearray up to spill_bytes, then an anonymous temporary
+    file. Read back once, either decoded (decode) or in fixed-size chunks (iter_chunks); both release it.
+    """
+
+    def __init__(self, spill_bytes: int = RESPONSE_SPILL_BYTES):
+        self._spill_bytes = spill_bytes
+        self._memory: Optional[bytearray] = bytearray()
+        self._file: Any = None
+        self.size = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self._file is None and self.size > self._spill_bytes:
+            import tempfile
+            self._file = tempfile.TemporaryFile(dir=RESPONSE_SPILL_DIR)
+            self._file.write(self._memory)
+            self._memory = None
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._memory += data
+
+    def head(self, length: int) -> bytes:
+        if self._file is None:
+            return bytes(self._memory[:length])
+        self._file.seek(0)
+        return self._file.read(length)
+
+    def tail(self, length: int) -> bytes:
+        if self._file is None:
+            return bytes(self._memory[-length:])
+        self._file.seek(max(0, self.size - length))
+        return self._file.read(length)
+
+    def decode(self) -> str:
+        try:
+            if self._file is None:
+                return self._memory.decode('utf-8')
+            self._file.seek(0)
+            return self._file.read().decode('utf-8')
+        finally:
+            self.close()
+
+    def iter_chunks(self, chunk_bytes: int = RESPONSE_READ_CHUNK_BYTES) -> Iterator[bytes]:
+        try:
+            if self._file is None:
+                for offset in range(0, self.size, chunk_bytes):
+                    yield bytes(self._memory[offset:offset + chunk_bytes])
+            else:
+                self._file.seek(0)
+                while True:
+                    chunk = self._file.read(chunk_bytes)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._memory = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def _read_upstream_body(response: Any) -> _SpillBuffer:
+    """Read a non-streaming body in RESPONSE_READ_CHUNK_BYTES pieces (decompressed as they arrive) into a _SpillBuffer."""
+    buffer = _SpillBuffer()
+    for chunk in _iter_upstream_chunks(response, RESPONSE_READ_CHUNK_BYTES):
+        buffer.write(chunk)
+    return buffer
+
+# Both APIs put 'usage' near the end of the body (after the output and the Responses request echo)
+_USAGE_TAIL_BYTES = 16 * 1024
+
+def _usage_from_tail(tail: bytes) -> Optional[Dict[str, Any]]:
+    """The last 'usage' object in the tail of a provider body, without parsing the whole body."""
+    start = tail.rfind(b'"usage"')
+    start = tail.find(b'{', start) if start != -1 else -1
+    if start == -1:
+        return None
+    depth = 0
+    for end in range(start, len(tail)):
+        if tail[end] == 0x7B:
+            depth += 1
+        elif tail[end] == 0x7D:
+            depth -= 1
+            if depth == 0:
+                try:
+                    usage = json.loads(tail[start:end + 1])
+                except ValueError:
+                    return None
+                return usage if isinstance(usage, dict) else None
+    return None
+
+class _SseReframer:
+    """
+    Re-frame raw chunks on SSE event boundaries (blank line) so the client never sees half an event.
+    If the pending buffer grows past max_buffer_bytes without a boundary, it is flushed as-is.
+    """
+
+    def __init__(self, max_buffer_bytes: int = STREAM_MAX_BUFFER_BYTES):
+        self._max_buffer_bytes = max_buffer_bytes
+        self._buffer = b''
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        framed = []
+        buffer = self._buffer + chunk
+        # End of the last complete event (accept both LF and CRLF framing); 0 if none yet.
+        lf = buffer.rfind(b'\n\n')
+        crlf = buffer.rfind(b'\r\n\r\n')
+        boundary = max(lf + 2 if lf != -1 else 0, crlf + 4 if crlf != -1 else 0)
+        if boundary:
+            framed.append(buffer[:boundary])
+            buffer = buffer[boundary:]
+        if len(buffer) > self._max_buffer_bytes:
+            framed.append(buffer)
+            buffer = b''
+        self._buffer = buffer
+        return framed
+
+    def finish(self) -> List[bytes]:
+        buffer, self._buffer = self._buffer, b''
+        return [buffer] if buffer else []
+
+def _iter_sse_events(chunks: Iterable[bytes], max_buffer_bytes: int = STREAM_MAX_BUFFER_BYTES) -> Iterator[bytes]:
+    reframer = _SseReframer(max_buffer_bytes)
+    for chunk in chunks:
+        yield from reframer.feed(chunk)
+    yield from reframer.finish()
+
+def _sse_error_event(message: str, error_type: str, stream_format: str = 'raw') -> bytes:
+    if stream_format == 'compact':
+        return _compact_event({'type': 'error', 'message': message, 'error_type': error_type})
+    payload = json.dumps({'error': message, 'error_type': error_type})
+    return f"event: error\ndata: {payload}\n\n".encode('utf-8')
+
+def _stream_format(headers: Dict[str, Any], request_data: Dict[str, Any]) -> str:
+    """'compact' when the client opted in to the unified event schema, otherwise 'raw' (provider SSE passthrough)."""
+    value = _get_header(headers, 'X-Proxy-Stream-Format') or request_data.get('stream_format') or ''
+    return 'compact' if isinstance(value, str) and value.strip().lower() == 'compact' else 'raw'
+
+def _compact_event(payload: Dict[str, Any]) -> bytes:
+    return b'data: ' + json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n\n'
+
+def _parse_sse_block(block: bytes) -> Tuple[Optional[str], Optional[Dict[str, Any]], bool]:
+    """One SSE event (LF framing, no trailing blank line) -> (event name, parsed JSON data, has data lines)."""
+    event_name = None
+    data_lines = []
+    for line in block.split(b'\n'):
+        if line.startswith(b'event:'):
+            event_name = line[6:].strip().decode('utf-8', 'replace')
+        elif line.startswith(b'data:'):
+            data_lines.append(line[5:].strip())
+    if not data_lines:
+        return event_name, None, False
+    try:
+        data = json.loads(b'\n'.join(data_lines))
+    except ValueError:
+        data = None
+    return event_name, (data if isinstance(data, dict) else None), True
+
+def _iter_sse_payloads(events: Iterable[bytes]) -> Iterator[Tuple[Optional[str], Optional[Dict[str, Any]]]]:
+    """Split framed SSE bytes into (event name, parsed JSON data). Non-JSON data (e.g. '[DONE]') yields None."""
+    for framed in events:
+        for block in framed.replace(b'\r\n', b'\n').split(b'\n\n'):
+            if not block.strip():
+                continue
+            event_name, data, has_data = _parse_sse_block(block)
+            if has_data:
+                yield event_name, data
+
+class _CompactStage:
+    """
+    Translate OpenAI Responses / Anthropic Messages SSE into one minimal schema, event by event:
+      {"type":"text","delta":...}      {"type":"reasoning","delta":...}
+      {"type":"usage","input_tokens":...,"output_tokens":...}
+      {"type":"done","stop_reason":...}   {"type":"error","message":...}
+    Everything else (envelopes, item bookkeeping, pings) is dropped.
+    """
+
+    def __init__(self, provider: str):
+        self._provider = provider
+        self._usage: Dict[str, int] = {}
+        self._stop_reason = None
+
+    def feed(self, framed: bytes) -> List[bytes]:
+        out = []
+        provider = self._provider
+        usage = self._usage
+        for event_name, data in _iter_sse_payloads((framed,)):
+            if data is None:
+                continue
+            event_type = data.get('type') or event_name or ''
+
+            if provider == 'Claude':
+                if event_type == 'content_block_delta':
+                    delta = data.get('delta') or {}
+                    if delta.get('type') == 'text_delta' and delta.get('text'):
+                        out.append(_compact_event({'type': 'text', 'delta': delta['text']}))
+                    elif delta.get('type') == 'thinking_delta' and delta.get('thinking'):
+                        out.append(_compact_event({'type': 'reasoning', 'delta': delta['thinking']}))
+                elif event_type == 'message_start':
+                    message_usage = (data.get('message') or {}).get('usage') or {}
+                    usage['input_tokens'] = message_usage.get('input_tokens', 0)
+                    usage['output_tokens'] = message_usage.get('output_tokens', 0)
+                    usage.update(_prompt_cache_usage(provider, message_usage))
+                elif event_type == 'message_delta':
+                    self._stop_reason = (data.get('delta') or {}).get('stop_reason') or self._stop_reason
+                    if 'output_tokens' in (data.get('usage') or {}):
+                        usage['output_tokens'] = data['usage']['output_tokens']
+                elif event_type == 'message_stop':
+                    out.append(_compact_event(dict({'type': 'usage'}, **usage)))
+                    out.append(_compact_event({'type': 'done', 'stop_reason': self._stop_reason}))
+                elif event_type == 'error':
+                    error = data.get('error') or {}
+                    out.append(_compact_event({'type': 'error', 'message': error.get('message', ''), 'error_type': error.get('type', 'error')}))
+                continue
+
+            if event_type == 'response.output_text.delta':
+                if data.get('delta'):
+                    out.append(_compact_event({'type': 'text', 'delta': data['delta']}))
+            elif event_type in ('response.reasoning_summary_text.delta', 'response.reasoning_text.delta'):
+                if data.get('delta'):
+                    out.append(_compact_event({'type': 'reasoning', 'delta': data['delta']}))
+            elif event_type in ('response.completed', 'response.incomplete'):
+                final = data.get('response') or {}
+                final_usage = final.get('usage') or {}
+                out.append(_compact_event(dict({
+                    'type': 'usage',
+                    'input_tokens': final_usage.get('input_tokens', 0),
+                    'output_tokens': final_usage.get('output_tokens', 0)
+                }, **_prompt_cache_usage(provider, final_usage))))
+                reason = (final.get('incomplete_details') or {}).get('reason') or final.get('status') or 'completed'
+                out.append(_compact_event({'type': 'done', 'stop_reason': reason}))
+            elif event_type in ('response.failed', 'error'):
+                error = (data.get('response') or {}).get('error') or data.get('error') or data
+                out.append(_compact_event({'type': 'error', 'message': error.get('message', ''), 'error_type': error.get('code') or error.get('type') or 'error'}))
+        return out
+
+def _iter_compact_events(events: Iterable[bytes], provider: str) -> Iterator[bytes]:
+    stage = _CompactStage(provider)
+    for framed in events:
+        yield from stage.feed(framed)
+
+def _coalesce_mode(headers: Dict[str, Any], request_data: Dict[str, Any]) -> Optional[str]:
+    """
+    Buffered streaming only (X-Proxy-Coalesce header, 'coalesce' body field, PROXY_BUFFERED_COALESCE default):
+    None, 'merge' (consecutive deltas of a block merged into one event) or 'final' (assembled result).
+    """
+    value = _get_header(headers, 'X-Proxy-Coalesce') or request_data.get('coalesce') or BUFFERED_COALESCE
+    if value is True:
+        return 'merge'
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    if value == 'final':
+        return 'final'
+    if value in ('1', 'true', 'on', 'yes', 'merge'):
+        return 'merge'
+    return None
+
+_CLAUDE_DELTA_TEXT_FIELDS = {'text_delta': 'text', 'thinking_delta': 'thinking', 'input_json_delta': 'partial_json'}
+_OPENAI_FINAL_EVENTS = ('response.completed', 'response.incomplete', 'response.failed', 'error')
+
+def _delta_event(event_name: Optional[str], data: Dict[str, Any]) -> bytes:
+    payload = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return (f'event: {event_name}\n'.encode('utf-8') if event_name else b'') + b'data: ' + payload + b'\n\n'
+
+def _iter_coalesced_events(events: Iterable[bytes], provider: str, stream_format: str, mode: str) -> Iterator[bytes]:
+    """
+    Coalesce a buffered SSE stream (raw provider events or the compact schema) into a handful of events.
+    'merge': consecutive deltas of the same block become one delta event (envelope of the first), Anthropic
+    pings are dropped, everything else is kept in order. 'final': compact streams collapse to one reasoning
+    event, one text event, then usage/done; raw OpenAI streams keep only the terminal event (response.completed
+    carries the output, usage and status); raw Anthropic streams have no such event, so they are merged.
+    """
+    pending_key: Any = None
+    pending: Optional[Tuple[Optional[str], Dict[str, Any]]] = None
+    pending_parts: List[str] = []
+    final_text: Dict[str, List[str]] = {'reasoning': [], 'text': []}
+
+    def merged() -> bytes:
+        event_name, data = pending
+        text = ''.join(pending_parts)
+        if stream_format == 'compact' or provider != 'Claude':
+            return _delta_event(event_name, dict(data, delta=text))
+        delta = data['delta']
+        return _delta_event(event_name, dict(data, delta=dict(delta, **{_CLAUDE_DELTA_TEXT_FIELDS[delta['type']]: text})))
+
+    for framed in events:
+        for block in framed.replace(b'\r\n', b'\n').split(b'\n\n'):
+            if not block.strip():
+                continue
+            event_name, data, _ = _parse_sse_block(block) if b'delta' in block or b'ping' in block or mode == 'final' else (None, None, False)
+            key = None
+            text = None
+            if data is not None:
+                event_type = data.get('type') or event_name or ''
+                if stream_format == 'compact':
+                    if event_type in ('text', 'reasoning'):
+                        key, text = event_type, data.get('delta') or ''
+                        if mode == 'final':
+                            final_text[event_type].append(text)
+                            continue
+                    elif mode == 'final':
+                        for kind in ('reasoning', 'text'):
+                            if final_text[kind]:
+                                yield _compact_event({'type': kind, 'delta': ''.join(final_text[kind])})
+                                final_text[kind] = []
+                elif provider == 'Claude':
+                    if event_type == 'ping':
+                        continue
+                    delta = data.get('delta') or {}
+                    field = _CLAUDE_DELTA_TEXT_FIELDS.get(delta.get('type'))
+                    if event_type == 'content_block_delta' and field:
+                        key, text = (data.get('index'), delta['type']), delta.get(field) or ''
+                else:
+                    if mode == 'final':
+                        if event_type in _OPENAI_FINAL_EVENTS:
+                            yield block + b'\n\n'
+                        continue
+                    if event_type.endswith('.delta') and isinstance(data.get('delta'), str):
+                        key = (event_type, data.get('item_id'), data.get('output_index'), data.get('content_index'), data.get('summary_index'))
+                        text = data['delta']
+            elif mode == 'final' and stream_format != 'compact' and provider != 'Claude':
+                continue
+            if key is not None and key == pending_key:
+                pending_parts.append(text)
+                continue
+            if pending is not None:
+                yield merged()
+                pending_key, pending, pending_parts = None, None, []
+            if key is not None:
+                pending_key, pending, pending_parts = key, (event_name, data), [text]
+                continue
+            yield block + b'\n\n'
+    if pending is not None:
+        yield merged()
+    for kind in ('reasoning', 'text'):
+        if final_text[kind]:
+            yield _compact_event({'type': kind, 'delta': ''.join(final_text[kind])})
+
+class StructuredOutputError(ValueError):
+    """Model output that can no longer become valid JSON; raised at the first offending character."""
+    def __init__(self, message: str, position: int, preview: str = ''):
+        super().__init__(message)
+        self.position = position
+        self.preview = preview
+
+_JSON_STRING_RUN = re.compile(r'[^"\\\x00-\x1f]+')
+_JSON_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_JSON_NUMBER_CHARS = frozenset('0123456789+-.eE')
+_JSON_WHITESPACE = frozenset(' \t\n\r')
+_JSON_LITERALS = {'t': 'rue', 'f': 'alse', 'n': 'ull'}
+_JSON_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_JSON_EXPECTED = {
+    'value': 'a value', 'value_or_end': "a value or ']'", 'key': 'a quoted key', 'key_or_end': "a quoted key or '}'",
+    'colon': "':'", 'comma_or_end': "',' or a closing bracket", 'done': 'end of output'
+}
+
+class _IncrementalJsonValidator:
+    """
+    Push-style JSON syntax check over streamed text: feed() raises StructuredOutputError at the first character
+    after which no continuation could be valid JSON, finish() raises if the document is incomplete.
+    Checks syntax (and an object at the top level when require_object), not the schema; the provider enforces that.
+    """
+
+    def __init__(self, require_object: bool = True):
+        self.require_object = require_object
+        self.position = 0
+        self._stack: List[str] = []
+        self._expect = 'value'
+        self._in_string = False
+        self._string_is_key = False
+        self._escape = 0  # -1 right after a backslash, 1-4 while reading \uXXXX digits
+        self._literal = ''
+        self._number = ''
+        self._tail = ''
+
+    def _fail(self, message: str, offset: int) -> None:
+        raise StructuredOutputError(f'Model output is not valid JSON at character {self.position + offset}: {message}',
+                                    self.position + offset, self._tail[-200:])
+
+    def _value_done(self) -> None:
+        self._expect = 'comma_or_end' if self._stack else 'done'
+
+    def _end_number(self, offset: int) -> None:
+        if not _JSON_NUMBER.fullmatch(self._number):
+            self._fail(f'invalid number {self._number!r}', offset)
+        self._number = ''
+        self._value_done()
+
+    def feed(self, text: str) -> None:
+        if not text:
+            return
+        self._tail = (self._tail + text)[-200:]
+        i = 0
+        n = len(text)
+        while i < n:
+            if self._in_string:
+                if self._escape:
+                    ch = text[i]
+                    if self._escape == -1:
+                        if ch == 'u':
+                            self._escape = 4
+                        elif ch in '"\\/bfnrt':
+                            self._escape = 0
+                        else:
+                            self._fail(f'invalid escape \\{ch}', i)
+                    elif ch in _JSON_HEX_DIGITS:
+                        self._escape -= 1
+                    else:
+                        self._fail(f'invalid \\u escape digit {ch!r}', i)
+                    i += 1
+                    continue
+                run = _JSON_STRING_RUN.match(text, i)
+                if run:
+                    i = run.end()
+                    continue
+                ch = text[i]
+                if ch == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._expect = 'colon'
+                    else:
+                        self._value_done()
+                elif ch == '\\':
+                    self._escape = -1
+                else:
+                    self._fail('unescaped control character in string', i)
+                i += 1
+                continue
+
+            ch = text[i]
+            if self._literal:
+                if ch != self._literal[0]:
+                    self._fail(f'unexpected {ch!r} in literal', i)
+                self._literal = self._literal[1:]
+                if not self._literal:
+                    self._value_done()
+                i += 1
+                continue
+            if self._number:
+                if ch in _JSON_NUMBER_CHARS:
+                    self._number += ch
+                    i += 1
+                    continue
+                self._end_number(i)  # The terminating character is handled below
+            if ch in _JSON_WHITESPACE:
+                i += 1
+                continue
+
+            expect = self._expect
+            if expect in ('value', 'value_or_end'):
+                if expect == 'value_or_end' and ch == ']':
+                    self._stack.pop()
+                    self._value_done()
+                elif self.require_object and not self._stack and ch != '{':
+                    self._fail(f"expected a JSON object, got {ch!r}", i)
+                elif ch == '{':
+                    self._stack.append('{')
+                    self._expect = 'key_or_end'
+                elif ch == '[':
+                    self._stack.append('[')
+                    self._expect = 'value_or_end'
+                elif ch == '"':
+                    self._in_string = True
+                    self._string_is_key = False
+                elif ch == '-' or '0' <= ch <= '9':
+                    self._number = ch
+                elif ch in _JSON_LITERALS:
+                    self._literal = _JSON_LITERALS[ch]
+                else:
+                    self._fail(f'unexpected {ch!r}, expected {_JSON_EXPECTED[expect]}', i)
+            elif expect in ('key', 'key_or_end'):
+                if ch == '"':
+                    self._in_string = True
+                    self._string_is_key = True
+                elif expect == 'key_or_end' and ch == '}':
+                    self._stack.pop()
+                    self._value_done()
+                else:
+                    self._fail(f'unexpected {ch!r}, expected {_JSON_EXPECTED[expect]}', i)
+            elif expect == 'colon':
+                if ch != ':':
+                    self._fail(f"unexpected {ch!r}, expected ':'", i)
+                self._expect = 'value'
+            elif expect == 'comma_or_end':
+                container = self._stack[-1]
+                if ch == ',':
+                    self._expect = 'key' if container == '{' else 'value'
+                elif ch == ('}' if container == '{' else ']'):
+                    self._stack.pop()
+                    self._value_done()
+                else:
+                    self._fail(f'unexpected {ch!r}, expected {_JSON_EXPECTED[expect]}', i)
+            else:
+                self._fail(f'unexpected {ch!r} after the end of the JSON document', i)
+            i += 1
+        self.position += n
+
+    def finish(self) -> None:
+        if self._number and not self._stack and not self._in_string:
+            self._end_number(0)
+        if self._expect != 'done' or self._in_string or self._literal:
+            self._fail('output ended before the JSON document was complete', 0)
+
+def _structured_output_format(request_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Normalize a Chat Completions style response_format (json_schema nested under 'json_schema') or the flat
+    Responses shape into {'type': 'json_object'} or {'type': 'json_schema', 'name', 'schema'[, 'strict']}.
+    None for plain text.
+    """
+    response_format = request_data.get('response_format')
+    if isinstance(response_format, str):
+        response_format = {'type': response_format}
+    if not isinstance(response_format, dict):
+        return None
+    format_type = response_format.get('type')
+    if format_type == 'json_object':
+        return {'type': 'json_object'}
+    if format_type != 'json_schema':
+        return None
+    spec = response_format.get('json_schema') if isinstance(response_format.get('json_schema'), dict) else response_format
+    if not isinstance(spec.get('schema'), dict):
+        return {'type': 'json_object'}
+    name = spec.get('name')
+    structured_format = {
+        'type': 'json_schema',
+        'name': name if isinstance(name, str) and re.fullmatch(r'[A-Za-z0-9_-]{1,64}', name) else STRUCTURED_OUTPUT_TOOL_NAME,
+        'schema': spec['schema']
+    }
+    if spec.get('strict') is not None:
+        structured_format['strict'] = bool(spec['strict'])
+    return structured_format
+
+def _apply_anthropic_structured_output(claude_request: Dict[str, Any], structured_format: Dict[str, Any]) -> Optional[str]:
+    """
+    Anthropic has no response_format: force a single tool whose input schema is the requested schema, so the
+    tool input is the JSON output. Returns the tool name, or None when the schema can't be a tool input
+    (tool inputs must be objects) and the request relies on its instructions instead.
+    """
+    schema = structured_format.get('schema') or {'type': 'object'}
+    if schema.get('type', 'object') != 'object':
+        return None
+    name = structured_format.get('name') or STRUCTURED_OUTPUT_TOOL_NAME
+    claude_request['tools'] = list(claude_request.get('tools') or []) + [{
+        'name': name,
+        'description': 'Respond by calling this tool. Its input is the complete response.',
+        'input_schema': schema
+    }]
+    claude_request['tool_choice'] = {'type': 'tool', 'name': name}
+    return name
+
+def _structured_output_validator(structured: Dict[str, Any]) -> Optional[_IncrementalJsonValidator]:
+    if not STRUCTURED_OUTPUT_VALIDATE:
+        return None
+    structured_format = structured['format']
+    require_object = structured_format['type'] == 'json_object' or (structured_format.get('schema') or {}).get('type') == 'object'
+    return _IncrementalJsonValidator(require_object=require_object)
+
+class _StructuredStage:
+    """
+    Structured-output stage over framed provider SSE (before any compact translation). Output text deltas go
+    through the incremental validator; as soon as the JSON can't be valid, feed() returns the events before the
+    offending one and sets 'error' (StructuredOutputError) for the caller to raise.
+    For Anthropic, the forced tool's tool_use block is rewritten into an ordinary text block (input_json_delta
+    -> text_delta) so clients read the JSON exactly as they read text output.
+    """
+
+    def __init__(self, provider: str, structured: Dict[str, Any]):
+        self._provider = provider
+        self._validator = _structured_output_validator(structured)
+        self._tool_name = structured.get('tool_name')
+        self._tool_blocks = set()
+        self.error: Optional[StructuredOutputError] = None
+
+    def feed(self, framed: bytes) -> List[bytes]:
+        provider = self._provider
+        validator = self._validator
+        tool_name = self._tool_name
+        tool_blocks = self._tool_blocks
+        output = []
+        try:
+            for block in framed.replace(b'\r\n', b'\n').split(b'\n\n'):
+                if not block.strip():
+                    continue
+                # Only parse the events this stage acts on; everything else passes through byte for byte
+                if provider == 'Claude':
+                    relevant = b'_delta' in block or b'content_block_start' in block or b'message_stop' in block
+                else:
+                    relevant = b'output_text.delta' in block or b'response.completed' in block or b'response.incomplete' in block
+                if not relevant:
+                    output.append(block)
+                    continue
+                event_name, data, _ = _parse_sse_block(block)
+                if data is None:
+                    output.append(block)
+                    continue
+                event_type = data.get('type') or event_name or ''
+                rewritten = None
+                if provider == 'Claude':
+                    if event_type == 'content_block_start':
+                        content_block = data.get('content_block') or {}
+                        if tool_name and content_block.get('type') == 'tool_use' and content_block.get('name') == tool_name:
+                            tool_blocks.add(data.get('index'))
+                            rewritten = {'type': 'content_block_start', 'index': data.get('index'), 'content_block': {'type': 'text', 'text': ''}}
+                    elif event_type == 'content_block_delta':
+                        delta = data.get('delta') or {}
+                        if delta.get('type') == 'input_json_delta' and data.get('index') in tool_blocks:
+                            text = delta.get('partial_json') or ''
+                            rewritten = {'type': 'content_block_delta', 'index': data.get('index'), 'delta': {'type': 'text_delta', 'text': text}}
+                            if validator:
+                                validator.feed(text)
+                        elif delta.get('type') == 'text_delta' and not tool_name and validator:
+                            validator.feed(delta.get('text') or '')
+                    elif event_type == 'message_delta':
+                        if tool_name and (data.get('delta') or {}).get('stop_reason') == 'tool_use':
+                            rewritten = dict(data, delta=dict(data['delta'], stop_reason='end_turn'))
+                    elif event_type == 'message_stop' and validator:
+                        validator.finish()
+                elif event_type == 'response.output_text.delta':
+                    if validator:
+                        validator.feed(data.get('delta') or '')
+                elif event_type in ('response.completed', 'response.incomplete') and validator:
+                    validator.finish()
+                if rewritten is None:
+                    output.append(block)
+                else:
+                    payload = json.dumps(rewritten, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+                    output.append((f'event: {event_name}\n'.encode('utf-8') if event_name else b'') + b'data: ' + payload)
+        except StructuredOutputError as e:
+            # Deliver what was valid up to the offending event
+            self.error = e
+        return [b'\n\n'.join(output) + b'\n\n'] if output else []
+
+def _iter_structured_events(events: Iterable[bytes], provider: str, structured: Dict[str, Any]) -> Iterator[bytes]:
+    """Raises StructuredOutputError after yielding the output that was valid up to the offending event."""
+    stage = _StructuredStage(provider, structured)
+    for framed in events:
+        yield from stage.feed(framed)
+        if stage.error is not None:
+            raise stage.error
+
+def _anthropic_tool_output_to_text(message: Dict[str, Any], tool_name: str) -> Dict[str, Any]:
+    """Non-streaming counterpart of the tool_use -> text rewrite in _iter_structured_events."""
+    content = []
+    for block in message.get('content') or []:
+        if isinstance(block, dict) and block.get('type') == 'tool_use' and block.get('name') == tool_name:
+            content.append({'type': 'text', 'text': json.dumps(block.get('input'), ensure_ascii=False)})
+        else:
+            content.append(block)
+    message['content'] = content
+    if message.get('stop_reason') == 'tool_use':
+        message['stop_reason'] = 'end_turn'
+    return message
+
+def _response_output_text(provider: str, body: Dict[str, Any]) -> str:
+    """Concatenated text output of a non-streaming Responses / Messages body."""
+    if provider == 'Claude':
+        return ''.join(block.get('text', '') for block in body.get('content') or []
+                       if isinstance(block, dict) and block.get('type') == 'text')
+    parts = []
+    for item in body.get('output') or []:
+        if isinstance(item, dict) and item.get('type') == 'message':
+            parts.extend(part.get('text', '') for part in item.get('content') or []
+                         if isinstance(part, dict) and part.get('type') == 'output_text')
+    return ''.join(parts)
+
+_RESPONSE_FIELDS = ('id', 'model', 'text', 'reasoning', 'tool_calls', 'usage', 'stop_reason')
+_COMPACT_RESPONSE_FIELDS = ('text', 'tool_calls', 'usage', 'stop_reason')
+
+def _response_fields(headers: Dict[str, Any], request_data: Dict[str, Any]) -> Tuple[Optional[Tuple[str, ...]], Optional[str]]:
+    """
+    Opt-in projection of non-streaming bodies (X-Proxy-Response-Fields header or 'response_fields' body field):
+    a comma-separated string or list of _RESPONSE_FIELDS, 'compact' for the common set.
+    Returns (fields, error); (None, None) forwards the provider body unchanged.
+    """
+    value = _get_header(headers, 'X-Proxy-Response-Fields') or request_data.get('response_fields')
+    if not value:
+        return None, None
+    names = value.split(',') if isinstance(value, str) else value if isinstance(value, list) else []
+    fields: List[str] = []
+    for name in names:
+        name = str(name).strip().lower()
+        expanded = _COMPACT_RESPONSE_FIELDS if name == 'compact' else (name,) if name else ()
+        for field in expanded:
+            if field not in _RESPONSE_FIELDS:
+                return None, f"Unknown response field '{field}' (available: compact, {', '.join(_RESPONSE_FIELDS)})"
+            if field not in fields:
+                fields.append(field)
+    return (tuple(fields) or None), None
+
+def _project_response(provider: str, body: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """
+    Reduce a non-streaming Responses / Messages body to the requested fields, in the vocabulary of the compact
+    stream format: text, reasoning, tool_calls ([{id, name, arguments (JSON text)}]), usage, stop_reason.
+    """
+    text_parts: List[str] = []
+    reasoning_parts: List[str] = []
+    tool_calls: List[Dict[str, Any]] = []
+    if provider == 'Claude':
+        for block in body.get('content') or []:
+            if not isinstance(block, dict):
+                continue
+            block_type = block.get('type')
+            if block_type == 'text':
+                text_parts.append(block.get('text', ''))
+            elif block_type == 'thinking':
+                reasoning_parts.append(block.get('thinking', ''))
+            elif block_type == 'tool_use':
+                tool_calls.append({'id': block.get('id'), 'name': block.get('name'),
+                                   'arguments': json.dumps(block.get('input'), ensure_ascii=False)})
+        stop_reason = body.get('stop_reason')
+    else:
+        for item in body.get('output') or []:
+            if not isinstance(item, dict):
+                continue
+            item_type = item.get('type')
+            if item_type == 'message':
+                text_parts.extend(part.get('text', '') for part in item.get('content') or []
+                                  if isinstance(part, dict) and part.get('type') == 'output_text')
+            elif item_type == 'reasoning':
+                reasoning_parts.extend(part.get('text', '') for part in item.get('summary') or [] if isinstance(part, dict))
+            elif item_type == 'function_call':
+                tool_calls.append({'id': item.get('call_id'), 'name': item.get('name'), 'arguments': item.get('arguments', '')})
+        stop_reason = (body.get('incomplete_details') or {}).get('reason') or body.get('status')
+
+    usage = body.get('usage') if isinstance(body.get('usage'), dict) else {}
+    values = {
+        'id': body.get('id'),
+        'model': body.get('model'),
+        'text': ''.join(text_parts),
+        'reasoning': '\n'.join(reasoning_parts),
+        'tool_calls': tool_calls,
+        'usage': dict({'input_tokens': usage.get('input_tokens', 0), 'output_tokens': usage.get('output_tokens', 0)},
+                      **_prompt_cache_usage(provider, usage)),
+        'stop_reason': stop_reason
+    }
+    return {field: values[field] for field in fields}
+
+def _collect_structured_stream(response: Any, provider: str, structured: Dict[str, Any]) -> str:
+    """
+    Reassemble a streamed structured response into the provider's non-streaming JSON body, validating the output
+    as it arrives. Non-streaming structured requests go through here so invalid output aborts mid-generation
+    (StructuredOutputError; the caller closes the upstream) instead of after the full response.
+    """
+    events = _iter_structured_events(_iter_sse_events(_iter_upstream_chunks(response)), provider, structured)
+    message: Optional[Dict[str, Any]] = None
+    for event_name, data in _iter_sse_payloads(events):
+        if data is None:
+            continue
+        event_type = data.get('type') or event_name or ''
+        if event_type in ('error', 'response.failed'):
+            error = (data.get('response') or {}).get('error') or data.get('error') or data
+            raise RuntimeError(f"{provider} stream failed: {error.get('message', '') if isinstance(error, dict) else error}")
+        if provider != 'Claude':
+            if event_type in ('response.completed', 'response.incomplete'):
+                return json.dumps(data.get('response') or {})
+            continue
+        if event_type == 'message_start':
+            message = dict(data.get('message') or {}, content=[])
+        elif message is None:
+            continue
+        elif event_type == 'content_block_start':
+            message['content'].append(dict(data.get('content_block') or {}))
+        elif event_type == 'content_block_delta' and message['content']:
+            block = message['content'][-1]
+            delta = data.get('delta') or {}
+            if delta.get('type') == 'text_delta':
+                block['text'] = block.get('text', '') + delta.get('text', '')
+            elif delta.get('type') == 'thinking_delta':
+                block['thinking'] = block.get('thinking', '') + delta.get('thinking', '')
+            elif delta.get('type') == 'signature_delta':
+                block['signature'] = delta.get('signature', '')
+        elif event_type == 'message_delta':
+            message.update({k: v for k, v in (data.get('delta') or {}).items() if k in ('stop_reason', 'stop_sequence')})
+            message['usage'] = dict(message.get('usage') or {}, **(data.get('usage') or {}))
+        elif event_type == 'message_stop':
+            return json.dumps(message)
+    raise RuntimeError(f'{provider} stream ended before the response was complete')
+
+class _StreamPipeline:
+    """
+    The RESPONSE_STREAM body stages in push form: raw upstream bytes go in through feed(), client bytes come out.
+    _stream_upstream_response drives it from a blocking response, _astream_upstream_response from one read on an
+    event loop (proxy_server). Errors after the status line has been sent can't change the HTTP status, so they
+    are reported in-band as an SSE 'error' event that ends the stream ('closed'). For structured output, JSON that
+    can no longer be valid ends the stream early with an 'invalid_json' error event.
+    """
+
+    def __init__(self, provider: str, stream_format: str = 'raw', structured: Optional[Dict[str, Any]] = None,
+                 telemetry: Optional[Dict[str, Any]] = None, session: Optional[Dict[str, Any]] = None):
+        self.provider = provider
+        self.stream_format = stream_format
+        self.telemetry = telemetry
+        self.closed = False
+        self.total_bytes = 0
+        self._reframer = _SseReframer()
+        self._structured = _StructuredStage(provider, structured) if structured else None
+        self._stages = [self._structured] if structured else []
+        if session:
+            self._stages.append(_SessionStage(provider, session))
+        if stream_format == 'compact':
+            self._stages.append(_CompactStage(provider))
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        return self._run(self._reframer.feed(chunk))
+
+    def finish(self) -> List[bytes]:
+        out = self._run(self._reframer.finish())
+        self.closed = True
+        return out
+
+    def fail(self, e: Exception) -> List[bytes]:
+        """Report an error reading the upstream response as the last event of the stream."""
+        if self.closed:
+            return []
+        out = [self._error_event(e)]
+        self.total_bytes += len(out[0])
+        return out
+
+    def _run(self, frames: List[bytes]) -> List[bytes]:
+        out: List[bytes] = []
+        if self.closed:
+            return out
+        try:
+            for framed in frames:
+                events = [framed]
+                for stage in self._stages:
+                    events = [produced for event in events for produced in stage.feed(event)]
+                out.extend(events)
+                if self._structured is not None and self._structured.error is not None:
+                    raise self._structured.error
+        except StructuredOutputError as e:
+            _log(f"[Lambda] WARNING: Aborting {self.provider} stream: {str(e)}")
+            if self.telemetry is not None:
+                self.telemetry['structured_output'] = 'invalid'
+            out.append(_sse_error_event(str(e), 'invalid_json', self.stream_format))
+            self.closed = True
+        except Exception as e:
+            out.append(self._error_event(e))
+        self.total_bytes += sum(len(event) for event in out)
+        return out
+
+    def _error_event(self, e: Exception) -> bytes:
+        self.closed = True
+        _log(f"[Lambda] ERROR while streaming {self.provider} response: {type(e).__name__}: {str(e)}")
+        return _sse_error_event(f'{self.provider} stream interrupted: {str(e)}', type(e).__name__, self.stream_format)
+
+def _stream_upstream_response(response: Any, provider: str, stream_format: str = 'raw',
+                              structured: Optional[Dict[str, Any]] = None,
+                              telemetry: Optional[Dict[str, Any]] = None,
+                              coalesce: Optional[str] = None,
+                              session: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """
+    Generator body for RESPONSE_STREAM mode: _StreamPipeline over a blocking upstream response,
+    which it owns (and closes; early, when the pipeline ends the stream, which stops the generation upstream).
+    """
+    pipeline = _StreamPipeline(provider, stream_format, structured, telemetry, session)
+
+    def events() -> Iterator[bytes]:
+        try:
+            for chunk in _iter_upstream_chunks(response):
+                yield from pipeline.feed(chunk)
+                if pipeline.closed:
+                    return
+        except Exception as e:
+            yield from pipeline.fail(e)
+            return
+        yield from pipeline.finish()
+
+    try:
+        yield from (_iter_coalesced_events(events(), provider, stream_format, coalesce) if coalesce else events())
+    finally:
+        response.close()
+        _debug_log(f"[Lambda] Streamed {pipeline.total_bytes} bytes from {provider}")
+
+async def _astream_upstream_response(response: Any, provider: str, stream_format: str = 'raw',
+                                     structured: Optional[Dict[str, Any]] = None,
+                                     telemetry: Optional[Dict[str, Any]] = None,
+                                     session: Optional[Dict[str, Any]] = None) -> AsyncIterator[bytes]:
+    """
+    _stream_upstream_response for a response from an event loop upstream opener (see lambda_streaming_handler):
+    the body is read with 'async for', so an open stream holds no thread.
+    """
+    pipeline = _StreamPipeline(provider, stream_format, structured, telemetry, session)
+    try:
+        try:
+            async for chunk in response:
+                for event_bytes in pipeline.feed(chunk):
+                    yield event_bytes
+                if pipeline.closed:
+                    return
+        except Exception as e:
+            events = pipeline.fail(e)
+        else:
+            events = pipeline.finish()
+        for event_bytes in events:
+            yield event_bytes
+    finally:
+        response.close()
+        _debug_log(f"[Lambda] Streamed {pipeline.total_bytes} bytes from {provider}")
+
+def encode_http_integration_stream(result: Dict[str, Any]) -> Iterator[bytes]:
+    """
+    Encode a handler result in the Function URL streaming format:
+    JSON prelude (statusCode/headers), 8 NUL delimiter bytes, then the body chunks.
+    """
+    prelude = {
+        'statusCode': result.get('statusCode', 200),
+        'headers': result.get('headers', {}) or {}
+    }
+    yield json.dumps(prelude).encode('utf-8') + b'\x00' * 8
+    body = result.get('body', '')
+    if isinstance(body, str):
+        body = [body.encode('utf-8')]
+    elif isinstance(body, bytes):
+        body = [body]
+    for chunk in body:
+        if chunk:
+            yield chunk
+
+class _RuntimeContext:
+    """Subset of the Lambda context object used by the handler when running under run_streaming_runtime."""
+
+    def __init__(self, aws_request_id: str, deadline_ms: int):
+        self.aws_request_id = aws_request_id
+        self._deadline_ms = deadline_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, self._deadline_ms - int(time.time() * 1000))
+
+def _runtime_error_payload(e: BaseException) -> bytes:
+    """Runtime API error document ({errorMessage, errorType, stackTrace}) for a failed invocation."""
+    import traceback
+    return json.dumps({
+        'errorMessage': str(e),
+        'errorType': type(e).__name__,
+        'stackTrace': traceback.format_exception(type(e), e, e.__traceback__)
+    }).encode('utf-8')
+
+def run_streaming_runtime(handler: Any = None) -> None:
+    """
+    Minimal Lambda Runtime API loop with response streaming enabled.
+    The managed Python runtime buffers handler results, so RESPONSE_STREAM Function URLs need this
+    loop (custom runtime / container image: `python lambda_function.py`) to forward chunks as they arrive.
+    A handler that raises before streaming is reported on the invocation's /error endpoint; a failure
+    mid-stream ends the chunked body with the Lambda-Runtime-Function-Error-Type/-Body trailers.
+    Either way the loop moves on to the next invocation.
+    """
+    import base64
+    handler = handler or lambda_streaming_handler
+    host, _, port = os.environ['AWS_LAMBDA_RUNTIME_API'].partition(':')
+    conn = http.client.HTTPConnection(host, int(port or 80))
+    while True:
+        conn.request('GET', '/2018-06-01/runtime/invocation/next')
+        next_response = conn.getresponse()
+        request_id = next_response.getheader('Lambda-Runtime-Aws-Request-Id', '')
+        deadline_ms = int(next_response.getheader('Lambda-Runtime-Deadline-Ms') or 0)
+        raw_event = next_response.read()
+
+        try:
+            event = json.loads(raw_event or b'{}')
+            result = handler(event, _RuntimeContext(request_id, deadline_ms))
+        except Exception as e:
+            _log(f"[Lambda] ERROR: Invocation {request_id} failed: {type(e).__name__}: {str(e)}")
+            conn.request('POST', f'/2018-06-01/runtime/invocation/{request_id}/error', body=_runtime_error_payload(e),
+                         headers={'Lambda-Runtime-Function-Error-Type': f'Unhandled.{type(e).__name__}',
+                                  'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            continue
+
+        conn.putrequest('POST', f'/2018-06-01/runtime/invocation/{request_id}/response')
+        conn.putheader('Lambda-Runtime-Function-Response-Mode', 'streaming')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.putheader('Content-Type', 'application/vnd.awslambda.http-integration-response')
+        conn.putheader('Trailer', 'Lambda-Runtime-Function-Error-Type, Lambda-Runtime-Function-Error-Body')
+        conn.endheaders()
+        trailers = b''
+        try:
+            for chunk in encode_http_integration_stream(result):
+                conn.send(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        except Exception as e:
+            _log(f"[Lambda] ERROR: Invocation {request_id} failed mid-stream: {type(e).__name__}: {str(e)}")
+            _close_result_body(result)
+            trailers = (f'Lambda-Runtime-Function-Error-Type: Unhandled.{type(e).__name__}\r\n'.encode('utf-8') +
+                        b'Lambda-Runtime-Function-Error-Body: ' + base64.b64encode(_runtime_error_payload(e)) + b'\r\n')
+        conn.send(b'0\r\n' + trailers + b'\r\n')
+        conn.getresponse().read()
+
+def _json_response(status_code: int, payload: Any, extra_headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if extra_headers:
+        headers.update(extra_headers)
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def _extract_api_key(headers: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    Returns (api_key, auth_header). Authorization: Bearer is preferred; X-API-Key is the fallback
+    because API Gateway may block the Authorization header if AWS_IAM auth is enabled.
+    """
+    # Try Authorization header first
+    auth_header = headers.get('Authorization') or headers.get('authorization', '')
+    
+    # Fallback to custom header if Authorization is blocked by API Gateway
+    api_key = None
+    if auth_header:
+        if auth_header.startswith('Bearer '):
+            api_key = auth_header.replace('Bearer ', '').strip()
+        else:
+            # If Authorization header exists but doesn't start with Bearer, it might be malformed
+            # Try to extract anyway, or check if it's already just the key
+            api_key = auth_header.strip()
+    
+    # Fallback to X-API-Key header
+    if not api_key:
+        api_key = (
+            headers.get('X-API-Key') or 
+            headers.get('x-api-key') or 
+            headers.get('X-Api-Key') or
+            ''
+        ).strip()
+    return api_key, auth_header
+
+def _missing_api_key_response(headers: Dict[str, Any], auth_header: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 401,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'error': 'Missing API key. Provide either Authorization: Bearer {key} or X-API-Key header',
+            'debug': {
+                'headers_available': list(headers.keys()),
+                'auth_header_present': bool(auth_header)
+            }
+        })
+    }
+
+def _parse_request_body(event: Dict[str, Any], headers: Dict[str, Any]) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    """
+    Returns (request_data, error_response). Handles base64 encoded bodies (API Gateway sometimes
+    sends this) and Content-Encoding compressed bodies.
+    """
+    body = event.get('body', '{}')
+    if not isinstance(body, str):
+        return body, None
+
+    # Check if body is base64 encoded
+    if event.get('isBase64Encoded', False):
+        import base64
+        raw_body = base64.b64decode(body)
+        # Compressed bodies are binary, so they always arrive base64 encoded
+        content_encoding = _get_header(headers, 'Content-Encoding').lower()
+        try:
+            raw_body = _decompress_request_body(raw_body, content_encoding)
+        except _UnsupportedEncodingError as enc_e:
+            return None, {
+                'statusCode': 415,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'error': str(enc_e), 'supported_encodings': ['gzip', 'zstd'] if _zstd_module() else ['gzip']})
+            }
+        except (zlib.error, ValueError) as enc_e:
+            return None, {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'error': f'Could not decode {content_encoding} request body: {str(enc_e)}'})
+            }
+        body = raw_body.decode('utf-8')
+    try:
+        return json.loads(body), None
+    except json.JSONDecodeError as e:
+        return None, {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({
+                'error': f'Invalid JSON in request body: {str(e)}',
+                'body_preview': body[:200] if len(body) > 200 else body
+            })
+        }
+
+def _debug_validate_result(result: Dict[str, Any], is_streaming: bool) -> None:
+    """
+    Debug-level only: re-check the response shape API Gateway expects and log a body preview.
+    At summary level these passes are skipped; the upstream body was already validated once.
+    """
+    if not is_streaming:
+        try:
+            json.loads(result['body'])
+            print("[Lambda] Response body is valid JSON")
+        except json.JSONDecodeError as je:
+            print(f"[Lambda] WARNING: Response body is not valid JSON: {str(je)}")
+
+    # API Gateway requires an int status, string header values and a string body
+    if not isinstance(result['statusCode'], int):
+        raise ValueError(f"statusCode must be int, got {type(result['statusCode'])}")
+    if not isinstance(result['body'], str):
+        raise ValueError(f"body must be str, got {type(result['body'])}")
+    for key, value in result['headers'].items():
+        if not isinstance(value, str):
+            raise ValueError(f"Header '{key}' value must be str, got {type(value)}")
+
+    print(f"[Lambda] Returning response with statusCode: {result['statusCode']}, body type: {type(result['body'])}, body length: {len(result['body'])}")
+    print(f"[Lambda] Response headers: {list(result['headers'].keys())}")
+
+    try:
+        json.dumps(result, default=str)
+        print("[Lambda] Response serializes correctly")
+    except Exception as ser_e:
+        print(f"[Lambda] WARNING: Response serialization test failed: {str(ser_e)}")
+
+    body_preview = result['body'][:200] if len(result['body']) > 200 else result['body']
+    print(f"[Lambda] Response body preview: {body_preview}")
+
+def _add_server_timing(result: Dict[str, Any], telemetry: Dict[str, Any], started: float) -> None:
+    """Server-Timing header with the phases recorded so far plus the total ('dur' in milliseconds)."""
+    if not SERVER_TIMING_ENABLED or not telemetry.get('phases'):
+        return
+    entries = [f'{name};dur={ms:.1f}' for name, ms in telemetry['phases'].items()]
+    entries.append(f'total;dur={(time.monotonic() - started) * 1000:.1f}')
+    headers = result.setdefault('headers', {})
+    headers['Server-Timing'] = ', '.join(entries)
+    expose = headers.get('Access-Control-Expose-Headers')
+    headers['Access-Control-Expose-Headers'] = f'{expose}, Server-Timing' if expose else 'Server-Timing'
+
+def _log_invocation(telemetry: Dict[str, Any], status_code: int, response_bytes: int, started: float) -> None:
+    """
+    Emit the single structured record for this invocation (summary and debug levels).
+    Phases are flattened to '<phase>_ms' fields; for /suggest requests the record doubles as a CloudWatch
+    Embedded Metric Format document, so the phases become metrics with provider/model dimensions.
+    """
+    if DIAGNOSTICS_LEVEL == 'off':
+        return
+    record = {'msg': 'invocation', 'status': status_code, 'response_bytes': response_bytes,
+              'duration_ms': round((time.monotonic() - started) * 1000, 1)}
+    record.update(telemetry)
+    phases = record.pop('phases', None) or {}
+    for name, ms in phases.items():
+        record[f'{name}_ms'] = round(ms, 2)
+    if EMF_METRICS_ENABLED and phases and isinstance(record.get('provider'), str) and isinstance(record.get('model'), str):
+        metric_names = ['duration_ms'] + [f'{name}_ms' for name in phases]
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': EMF_NAMESPACE,
+                'Dimensions': [['provider', 'model']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metric_names]
+            }]
+        }
+    print(json.dumps(record, separators=(',', ':'), default=str))
+
+def _log_invocation_after_stream(body: Iterable[bytes], telemetry: Dict[str, Any], status_code: int, started: float,
+                                 capture_event: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    total_bytes = 0
+    chunks = 0
+    transfer_started = time.perf_counter()
+    try:
+        for chunk in body:
+            total_bytes += len(chunk)
+            chunks += 1
+            yield chunk
+    finally:
+        _log_stream_done(telemetry, status_code, started, transfer_started, total_bytes, chunks, capture_event)
+
+async def _alog_invocation_after_stream(body: AsyncIterable[bytes], telemetry: Dict[str, Any], status_code: int,
+                                        started: float, capture_event: Optional[Dict[str, Any]] = None) -> AsyncIterator[bytes]:
+    total_bytes = 0
+    chunks = 0
+    transfer_started = time.perf_counter()
+    try:
+        async for chunk in body:
+            total_bytes += len(chunk)
+            chunks += 1
+            yield chunk
+    finally:
+        await _aclose(body)
+        _log_stream_done(telemetry, status_code, started, transfer_started, total_bytes, chunks, capture_event)
+
+def _log_stream_done(telemetry: Dict[str, Any], status_code: int, started: float, transfer_started: float,
+                     total_bytes: int, chunks: int, capture_event: Optional[Dict[str, Any]]) -> None:
+    _phase_done(telemetry, 'transfer', transfer_started)
+    _log_invocation(telemetry, status_code, total_bytes, started)
+    if capture_event is not None:
+        _capture_invocation(capture_event, telemetry, status_code, total_bytes, started, 'streaming', chunks)
+
+_capture_lock = threading.Lock()
+_CAPTURE_TELEMETRY_FIELDS = ('stream_format', 'coalesce', 'structured_output', 'session', 'cache', 'retries',
+                             'input_tokens', 'output_tokens', 'error_type', 'upstream_status')
+
+def _capture_sampled() -> bool:
+    if CAPTURE_RATE <= 0:
+        return False
+    import random
+    return random.random() < CAPTURE_RATE
+
+def _capture_shape(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Redacted shape of a /suggest request: role initials ('uaua...') and character counts of the messages, system
+    prompt and file content sizes and max tokens. Message content, keys and ids are never recorded. None if the
+    body doesn't parse.
+    """
+    event = normalize_event(event)
+    request_data, error_response = _parse_request_body(event, event.get('headers', {}) or {})
+    if error_response or not isinstance(request_data, dict):
+        return None
+    roles = []
+    message_chars = []
+    file_content_chars = 0
+    for msg in request_data.get('messages') or []:
+        if not isinstance(msg, dict):
+            continue
+        text = _message_text(msg)
+        roles.append(str(msg.get('role') or '?')[:1])
+        message_chars.append(len(text))
+        if _FILE_CONTENT_MARKER in text:
+            file_content_chars += len(text)
+    system = request_data.get('system')
+    max_tokens = (request_data.get('max_output_tokens') or request_data.get('max_completion_tokens') or
+                  request_data.get('max_tokens'))
+    return {
+        'body_bytes': len(event.get('body') or ''),
+        'system_chars': len(system) if isinstance(system, str) else 0,
+        'roles': ''.join(roles),
+        'message_chars': message_chars,
+        'file_content_chars': file_content_chars,
+        'max_tokens': max_tokens if isinstance(max_tokens, int) else None
+    }
+
+def _capture_invocation(event: Dict[str, Any], telemetry: Dict[str, Any], status_code: int, response_bytes: int,
+                        started: float, handler: str, chunks: Optional[int] = None) -> None:
+    """
+    Write the capture record of a sampled /suggest invocation. Called after the response was produced, so the
+    second parse of the body for its shape doesn't count towards the recorded timing.
+    """
+    if telemetry.get('route', 'suggest') != 'suggest':
+        return
+    try:
+        shape = _capture_shape(event)
+        if shape is None:
+            return
+        duration_ms = (time.monotonic() - started) * 1000
+        record: Dict[str, Any] = {
+            'msg': 'capture', 'v': 1, 'ts': round(time.time() - duration_ms / 1000, 3), 'handler': handler,
+            'status': status_code, 'provider': telemetry.get('provider'), 'model': telemetry.get('model'),
+            'stream': telemetry.get('stream'), 'duration_ms': round(duration_ms, 1), 'response_bytes': response_bytes
+        }
+        if chunks is not None:
+            record['chunks'] = chunks
+        phases = telemetry.get('phases') or {}
+        for name in ('connect', 'ttfb', 'transfer'):
+            if name in phases:
+                record[f'{name}_ms'] = round(phases[name], 1)
+        record.update({name: telemetry[name] for name in _CAPTURE_TELEMETRY_FIELDS if name in telemetry})
+        record.update(shape)
+        if CAPTURE_PATH == 'log':
+            print(json.dumps(record, separators=(',', ':'), default=str))
+            return
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with _capture_lock:
+            try:
+                if os.path.getsize(CAPTURE_PATH) + len(line) > CAPTURE_MAX_BYTES:
+                    os.replace(CAPTURE_PATH, CAPTURE_PATH + '.1')
+            except OSError:
+                pass
+            with open(CAPTURE_PATH, 'a', encoding='utf-8') as f:
+                f.write(line)
+    except Exception as e:
+        _log(f"[Lambda] WARNING: Could not write capture record: {type(e).__name__}: {str(e)}")
+
+def _batch_item_result(index: int, result: Dict[str, Any]) -> Dict[str, Any]:
+    body = result.get('body', '')
+    content_type = (result.get('headers') or {}).get('Content-Type', '')
+    if isinstance(body, str) and content_type.startswith('application/json'):
+        try:
+            body = json.loads(body)
+        except json.JSONDecodeError:
+            pass
+    return {'index': index, 'status': result.get('statusCode', 500), 'body': body}
+
+def _handle_suggest_batch(event: Dict[str, Any], context: Any, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    POST /suggest/batch with {"requests": [<suggest body>, ...]} (or a bare JSON array).
+    Items run concurrently, each with its own timeout from the moment a worker starts it, and results come
+    back in request order with a per-item status. Item failures and timeouts never fail the whole batch.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    event = normalize_event(event)
+    headers = event.get('headers', {}) or {}
+    telemetry['route'] = 'batch'
+    api_key, auth_header = _extract_api_key(headers)
+    if not api_key:
+        return _missing_api_key_response(headers, auth_header)
+    request_data, error_response = _parse_request_body(event, headers)
+    if error_response:
+        return error_response
+
+    items = request_data if isinstance(request_data, list) else (request_data or {}).get('requests')
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return _json_response(400, {'error': 'Expected a non-empty "requests" array of request bodies'})
+    if len(items) > BATCH_MAX_ITEMS:
+        return _json_response(413, {'error': f'Batch has {len(items)} requests; the maximum is {BATCH_MAX_ITEMS}'})
+
+    item_timeout = BATCH_ITEM_TIMEOUT_SECONDS
+    if isinstance(request_data, dict) and isinstance(request_data.get('item_timeout_seconds'), (int, float)):
+        item_timeout = max(1, min(item_timeout, request_data['item_timeout_seconds']))
+    # Items queued behind the workers still have to finish before the Lambda does; leave a little of the
+    # budget to serialize the response
+    batch_deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        batch_deadline = time.monotonic() + max(1, context.get_remaining_time_in_millis() / 1000.0 - 2)
+
+    # Items inherit auth/provider headers; the body is re-encoded, so encoding headers don't apply
+    item_headers = {k: v for k, v in headers.items() if k.lower() not in ('content-encoding', 'accept-encoding', 'content-length')}
+    # Each item's timeout starts when a worker picks it up; an item past its deadline is cancelled, which
+    # shuts its upstream connection down so it stops generating and frees its worker for the queue
+    scopes = [_CancelScope(allow_retries=True) for _ in items]
+    started: Dict[int, float] = {}
+    timed_out = set()
+
+    def run_item(index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        started[index] = time.monotonic()
+        _hedge_local.scope = scopes[index]
+        item_event = {'httpMethod': 'POST', 'path': '/suggest', 'headers': item_headers,
+                      'body': json.dumps(item), 'isBase64Encoded': False}
+        try:
+            return _handle_suggest(item_event, context, False, {}, max_timeout_seconds=item_timeout)
+        finally:
+            _hedge_local.scope = None
+            scopes[index].release()
+
+    executor = ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(items)))
+    try:
+        futures = [executor.submit(run_item, index, item) for index, item in enumerate(items)]
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            for index, future in enumerate(futures):
+                if future not in pending or index in timed_out:
+                    continue
+                expired = batch_deadline is not None and now >= batch_deadline
+                if index in started and now >= started[index] + item_timeout:
+                    expired = True
+                if expired:
+                    timed_out.add(index)
+                    pending.discard(future)
+                    if not future.cancel():
+                        scopes[index].cancel()
+            if not pending:
+                break
+            # Items starting from now on can't expire before now + item_timeout
+            wake_at = min([started[i] + item_timeout for i, f in enumerate(futures) if f in pending and i in started] +
+                          [now + item_timeout] + ([batch_deadline] if batch_deadline is not None else []))
+            done, _ = wait(pending, timeout=max(0.0, wake_at - now) + 0.01, return_when=FIRST_COMPLETED)
+            pending -= done
+    finally:
+        for index in timed_out:
+            scopes[index].cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for index, future in enumerate(futures):
+        if index in timed_out:
+            message = (f'Batch item timed out after {item_timeout:.0f}s' if index in started
+                       else 'Batch item did not start before the batch ran out of time')
+            results.append({'index': index, 'status': 504, 'body': {'error': message, 'error_type': 'timeout'}})
+        elif future.exception() is not None:
+            exc = future.exception()
+            results.append({'index': index, 'status': 500,
+                            'body': {'error': f'Proxy error: {str(exc)}', 'error_type': type(exc).__name__}})
+        else:
+            results.append(_batch_item_result(index, future.result()))
+
+    failed = sum(1 for r in results if r['status'] >= 400)
+    telemetry.update({'batch_items': len(results), 'batch_failed': failed})
+    return _json_response(200, {'results': results, 'succeeded': len(results) - failed, 'failed': failed})
+
+_job_store: Optional[BlobStore] = None
+_JOB_PATH = re.compile(r'/jobs(?:/([^/]+)(?:/(results|cancel))?)?$')
+_JOB_ID = re.compile(r'^job_[0-9a-f]{32}$')
+_OPENAI_BATCH_STATUS = {'validating': 'in_progress', 'in_progress': 'in_progress', 'finalizing': 'in_progress',
+                        'cancelling': 'canceling', 'completed': 'ended', 'expired': 'ended', 'cancelled': 'ended',
+                        'failed': 'failed'}
+
+def set_job_store(store: BlobStore) -> None:
+    global _job_store
+    _job_store = store
+
+def get_job_store() -> BlobStore:
+    global _job_store
+    if _job_store is None:
+        if JOB_STORE_BACKEND in ('', 'memory'):
+            _job_store = TieredBlobStore(JOB_MEMORY_MAX_BYTES, JOB_DISK_MAX_BYTES, JOB_DIR, write_through=True)
+        else:
+            import importlib
+            module_name, _, class_name = JOB_STORE_BACKEND.partition(':')
+            _job_store = getattr(importlib.import_module(module_name), class_name)()
+    return _job_store
+
+def _job_key(api_key: str, job_id: str) -> str:
+    return f'{_blob_namespace(api_key)}/{job_id}'
+
+def _save_job(api_key: str, job: Dict[str, Any]) -> None:
+    get_job_store().put(_job_key(api_key, job['id']), json.dumps(job, ensure_ascii=False))
+
+def _job_upstream(method: str, url: str, provider: str, api_key: str, telemetry: Dict[str, Any],
+                  data: Optional[bytes] = None, content_type: str = 'application/json') -> _PooledResponse:
+    headers = dict(_provider_request_headers(provider, api_key), **{'Content-Type': content_type})
+    return _urlopen_with_retries(url, data, headers, JOB_TIMEOUT_SECONDS, None, telemetry, method)
+
+def _job_upstream_json(method: str, url: str, provider: str, api_key: str, telemetry: Dict[str, Any],
+                       payload: Any = None) -> Dict[str, Any]:
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    with _job_upstream(method, url, provider, api_key, telemetry, data) as response:
+        return json.loads(response.read())
+
+def _submit_provider_batch(provider: str, api_key: str, requests: List[Tuple[str, Dict[str, Any]]],
+                           telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """Create one provider batch from (custom_id, provider request body) pairs; returns the provider's batch object."""
+    if provider == 'Claude':
+        return _job_upstream_json('POST', f'{ANTHROPIC_API_BASE}/v1/messages/batches', provider, api_key, telemetry,
+                                  {'requests': [{'custom_id': custom_id, 'params': body} for custom_id, body in requests]})
+    # OpenAI: upload the requests as a JSONL file, then create the batch from it
+    lines = b''.join(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/responses', 'body': body},
+                                ensure_ascii=False).encode('utf-8') + b'\n' for custom_id, body in requests)
+    boundary = f'----AiEditorAgent{hashlib.sha256(lines).hexdigest()[:24]}'
+    form = (f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="batch.jsonl"\r\n'
+            f'Content-Type: application/jsonl\r\n\r\n').encode('utf-8') + lines + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    with _job_upstream('POST', f'{OPENAI_API_BASE}/v1/files', provider, api_key, telemetry, form,
+                       f'multipart/form-data; boundary={boundary}') as response:
+        input_file = json.loads(response.read())
+    return _job_upstream_json('POST', f'{OPENAI_API_BASE}/v1/batches', provider, api_key, telemetry, {
+        'input_file_id': input_file['id'], 'endpoint': '/v1/responses', 'completion_window': '24h'})
+
+def _job_batch_state(provider: str, batch: Dict[str, Any], provider_batch: Dict[str, Any]) -> None:
+    """Update a job's batch entry from the provider's batch object (statuses and counts normalized across providers)."""
+    counts = provider_batch.get('request_counts') or {}
+    if provider == 'Claude':
+        batch['status'] = 'ended' if provider_batch.get('processing_status') == 'ended' else (
+            'canceling' if provider_batch.get('processing_status') == 'canceling' else 'in_progress')
+        batch['request_counts'] = {name: counts.get(name) or 0 for name in ('processing', 'succeeded', 'errored', 'canceled', 'expired')}
+        return
+    provider_status = provider_batch.get('status') or ''
+    batch['status'] = _OPENAI_BATCH_STATUS.get(provider_status, 'in_progress')
+    succeeded, errored = counts.get('completed') or 0, counts.get('failed') or 0
+    remaining = max(0, batch['requests'] - succeeded - errored)
+    batch['request_counts'] = {
+        'processing': remaining if batch['status'] in ('in_progress', 'canceling') else 0,
+        'succeeded': succeeded,
+        'errored': errored + (remaining if provider_status == 'failed' else 0),
+        'canceled': remaining if provider_status == 'cancelled' else 0,
+        'expired': remaining if provider_status == 'expired' else 0
+    }
+    batch['output_file_id'] = provider_batch.get('output_file_id')
+    batch['error_file_id'] = provider_batch.get('error_file_id')
+
+def _refresh_job(job: Dict[str, Any], api_key: str, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """Poll the provider for every batch that hasn't ended yet."""
+    provider = job['provider']
+    for batch in job['batches']:
+        if batch['status'] in ('ended', 'failed'):
+            continue
+        url = (f"{ANTHROPIC_API_BASE}/v1/messages/batches/{batch['id']}" if provider == 'Claude'
+               else f"{OPENAI_API_BASE}/v1/batches/{batch['id']}")
+        _job_batch_state(provider, batch, _job_upstream_json('GET', url, provider, api_key, telemetry))
+    return job
+
+def _job_summary(job: Dict[str, Any]) -> Dict[str, Any]:
+    counts: Dict[str, int] = {}
+    for batch in job['batches']:
+        for name, value in batch['request_counts'].items():
+            counts[name] = counts.get(name, 0) + value
+    statuses = {batch['status'] for batch in job['batches']}
+    status = next((s for s in ('canceling', 'in_progress') if s in statuses), 'ended')
+    return {
+        'job_id': job['id'], 'provider': job['provider'], 'model': job['model'], 'status': status,
+        'created_at': job['created_at'], 'request_count': len(job['custom_ids']), 'request_counts': counts,
+        'batches': [{'id': b['id'], 'status': b['status'], 'request_counts': b['request_counts']} for b in job['batches']]
+    }
+
+def _iter_job_result_lines(response: Any) -> Iterator[bytes]:
+    """JSONL lines of a provider results stream, read in fixed-size chunks (the response is closed at the end)."""
+    pending = b''
+    with response:
+        for chunk in _iter_upstream_chunks(response, RESPONSE_READ_CHUNK_BYTES):
+            pending += chunk
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+    if pending.strip():
+        yield pending
+
+def _job_result(job: Dict[str, Any], line: bytes, fields: Optional[Tuple[str, ...]]) -> bytes:
+    """One NDJSON result: {"custom_id", "status": "succeeded"|"errored"|"canceled"|"expired", "body" | "error"}."""
+    provider = job['provider']
+    custom_ids = job['custom_ids']
+    entry = json.loads(line)
+    raw_id = entry.get('custom_id') or ''
+    index = int(raw_id[1:]) if raw_id[1:].isdigit() else -1
+    result: Dict[str, Any] = {'custom_id': custom_ids[index] if 0 <= index < len(custom_ids) else raw_id}
+    if provider == 'Claude':
+        outcome = entry.get('result') or {}
+        result['status'] = outcome.get('type') or 'errored'
+        body = outcome.get('message')
+        # Structured output items were sent with a forced tool named after their json_schema
+        tool_name = (job.get('tool_names') or {}).get(result['custom_id'])
+        if isinstance(body, dict):
+            if tool_name:
+                body = _anthropic_tool_output_to_text(body, tool_name)
+        elif outcome.get('error') is not None:
+            result['error'] = outcome['error']
+    else:
+        response = entry.get('response') or {}
+        body = response.get('body') if response.get('status_code') == 200 else None
+        result['status'] = 'succeeded' if body is not None else 'errored'
+        if body is None:
+            result['error'] = entry.get('error') or response.get('body')
+    if isinstance(body, dict):
+        result['body'] = _project_response(provider, body, fields) if fields else body
+    return json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def _iter_job_results(job: Dict[str, Any], api_key: str, fields: Optional[Tuple[str, ...]],
+                      telemetry: Dict[str, Any]) -> Iterator[bytes]:
+    """
+    Results of every batch that has ended so far, streamed batch by batch as NDJSON lines. The status line has
+    already been sent when a result file fails to download, so the failure is reported as a final error line.
+    """
+    provider = job['provider']
+    try:
+        for batch in job['batches']:
+            if batch['status'] != 'ended':
+                continue
+            if provider == 'Claude':
+                urls = [f"{ANTHROPIC_API_BASE}/v1/messages/batches/{batch['id']}/results"]
+            else:
+                urls = [f'{OPENAI_API_BASE}/v1/files/{file_id}/content'
+                        for file_id in (batch.get('output_file_id'), batch.get('error_file_id')) if file_id]
+            for url in urls:
+                for line in _iter_job_result_lines(_job_upstream('GET', url, provider, api_key, telemetry)):
+                    yield _job_result(job, line, fields)
+    except Exception as e:
+        _log(f"[Lambda] ERROR while reading {provider} batch results: {type(e).__name__}: {str(e)}")
+        yield json.dumps({'error': f'{provider} batch results interrupted: {str(e)}', 'error_type': type(e).__name__}).encode('utf-8') + b'\n'
+
+def _create_job(headers: Dict[str, Any], request_data: Any, api_key: str, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    items = request_data.get('requests') if isinstance(request_data, dict) else None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return _json_response(400, {'error': 'Expected a non-empty "requests" array of request bodies'})
+    if len(items) > JOB_MAX_REQUESTS:
+        return _json_response(413, {'error': f'Job has {len(items)} requests; the maximum is {JOB_MAX_REQUESTS}'})
+
+    provider_name = (_get_header(headers, 'X-Provider') or request_data.get('provider') or '')
+    provider = 'Claude' if str(provider_name).strip().lower() in ('claude', 'anthropic') else 'OpenAI'
+    model = request_data.get('model') if isinstance(request_data.get('model'), str) else PROVIDER_CONFIG[provider]['default_model']
+    custom_ids = [str(item.get('custom_id', index)) for index, item in enumerate(items)]
+    if len(set(custom_ids)) != len(custom_ids):
+        return _json_response(400, {'error': 'custom_id values must be unique within a job'})
+
+    namespace = _blob_namespace(api_key)
+    missing_refs: List[str] = []
+    requests = []
+    tool_names: Dict[str, str] = {}
+    for index, item in enumerate(items):
+        item = {k: v for k, v in item.items() if k != 'custom_id'}
+        missing_refs.extend(_expand_blob_refs(item, namespace))
+        item_model = item.get('model') if isinstance(item.get('model'), str) else model
+        structured_format = _structured_output_format(item)
+        if provider == 'Claude':
+            structured = {'format': structured_format, 'tool_name': None} if structured_format else None
+            body = _build_claude_request(item, item_model, False, structured, headers, api_key)
+            if structured and structured['tool_name']:
+                tool_names[custom_ids[index]] = structured['tool_name']
+        else:
+            body = _build_openai_request(item, item_model, False, structured_format, headers, api_key)
+            body.pop('stream', None)
+        # Provider custom_ids are positional ('r<index>'); the client's ids can be any string
+        requests.append((f'r{index}', body))
+    if missing_refs:
+        return _json_response(409, {
+            'error': 'Unknown blob_ref(s). Please resend the blob contents via POST /blobs and retry the request.',
+            'error_type': 'blob_not_found',
+            'missing_blob_refs': sorted(set(missing_refs))
+        })
+
+    job = {'id': f'job_{os.urandom(16).hex()}', 'provider': provider, 'model': model, 'created_at': int(time.time()),
+           'custom_ids': custom_ids, 'tool_names': tool_names, 'batches': []}
+    try:
+        for start in range(0, len(requests), max(1, JOB_BATCH_REQUESTS)):
+            chunk = requests[start:start + max(1, JOB_BATCH_REQUESTS)]
+            provider_batch = _submit_provider_batch(provider, api_key, chunk, telemetry)
+            batch = {'id': provider_batch['id'], 'requests': len(chunk)}
+            _job_batch_state(provider, batch, provider_batch)
+            job['batches'].append(batch)
+    except Exception:
+        # Don't leave a partial job running at the provider
+        for batch in job['batches']:
+            _cancel_provider_batch(provider, api_key, batch['id'], telemetry)
+        raise
+    _save_job(api_key, job)
+    telemetry.update({'provider': provider, 'model': model, 'job_requests': len(requests), 'job_batches': len(job['batches'])})
+    _log(f"[Lambda] Job {job['id']}: {len(requests)} request(s) submitted to {provider} in {len(job['batches'])} batch(es)")
+    return _json_response(202, _job_summary(job))
+
+def _cancel_provider_batch(provider: str, api_key: str, batch_id: str, telemetry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    url = (f'{ANTHROPIC_API_BASE}/v1/messages/batches/{batch_id}/cancel' if provider == 'Claude'
+           else f'{OPENAI_API_BASE}/v1/batches/{batch_id}/cancel')
+    try:
+        return _job_upstream_json('POST', url, provider, api_key, telemetry, {})
+    except Exception as e:
+        _log(f"[Lambda] WARNING: Could not cancel {provider} batch {batch_id}: {type(e).__name__}: {str(e)}")
+        return None
+
+def _upstream_api_error(e: urllib.error.HTTPError, api_name: str, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """Error response for a failed provider call of the /jobs, /embed and /search routes."""
+    telemetry.update({'error_type': 'HTTPError', 'upstream_status': e.code})
+    try:
+        error_body = e.read().decode('utf-8', errors='replace')
+    except Exception:
+        error_body = ''
+    _log(f"[Lambda] ERROR: {api_name} returned {e.code}: {error_body[:500]}")
+    return _json_response(502 if e.code >= 500 else e.code, {
+        'error': f'{api_name} error ({e.code})',
+        'error_type': 'upstream_error',
+        'upstream_status': e.code,
+        'upstream_error': error_body[:2000]
+    })
+
+def _handle_jobs(event: Dict[str, Any], streaming_passthrough: bool, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Bulk jobs on the provider batch APIs (half price, no per-call timeouts, results within 24h):
+    POST /jobs with {"provider", "model", "requests": [{"custom_id": ..., <suggest body>}, ...]} submits a job,
+    GET /jobs/{id} reports its status, GET /jobs/{id}/results returns NDJSON results of the batches that have
+    ended so far, and POST /jobs/{id}/cancel cancels it.
+    """
+    event = normalize_event(event)
+    headers = event.get('headers', {}) or {}
+    telemetry['route'] = 'jobs'
+    api_key, auth_header = _extract_api_key(headers)
+    if not api_key:
+        return _missing_api_key_response(headers, auth_header)
+    method = (event.get('httpMethod') or 'POST').upper()
+    job_id, action = _JOB_PATH.search((event.get('path') or '').rstrip('/')).groups()
+
+    try:
+        if job_id is None:
+            if method != 'POST':
+                return _json_response(405, {'error': 'Use POST /jobs to submit a job'})
+            request_data, error_response = _parse_request_body(event, headers)
+            if error_response:
+                return error_response
+            return _create_job(headers, request_data, api_key, telemetry)
+
+        raw = get_job_store().get(_job_key(api_key, job_id)) if _JOB_ID.match(job_id) else None
+        if raw is None:
+            return _json_response(404, {'error': f'Unknown job {job_id}', 'error_type': 'job_not_found'})
+        job = json.loads(raw)
+        telemetry.update({'provider': job['provider'], 'job_id': job_id})
+        if action == 'cancel':
+            if method != 'POST':
+                return _json_response(405, {'error': f'Use POST /jobs/{job_id}/cancel'})
+            for batch in job['batches']:
+                if batch['status'] == 'in_progress':
+                    provider_batch = _cancel_provider_batch(job['provider'], api_key, batch['id'], telemetry)
+                    if provider_batch:
+                        _job_batch_state(job['provider'], batch, provider_batch)
+        elif method != 'GET':
+            return _json_response(405, {'error': f'Use GET /jobs/{job_id}' + ('/results' if action else '')})
+        _refresh_job(job, api_key, telemetry)
+        _save_job(api_key, job)
+        summary = _job_summary(job)
+        if action != 'results':
+            return _json_response(200, summary)
+
+        fields, fields_error = _response_fields(headers, {})
+        if fields_error:
+            return _json_response(400, {'error': fields_error, 'error_type': 'invalid_response_fields'})
+        ended = sum(1 for batch in job['batches'] if batch['status'] == 'ended')
+        results = _iter_job_results(job, api_key, fields, telemetry)
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/x-ndjson',
+                'Access-Control-Allow-Origin': '*',
+                'X-Proxy-Job-Status': summary['status'],
+                'X-Proxy-Job-Batches-Ended': f"{ended}/{len(job['batches'])}"
+            },
+            # Streamed as the provider result files are read; buffered mode collects them into one body
+            'body': results if streaming_passthrough else b''.join(results).decode('utf-8'),
+            'isBase64Encoded': False
+        }
+    except urllib.error.HTTPError as e:
+        return _upstream_api_error(e, f"{telemetry.get('provider')} batch API", telemetry)
+
+def _lambda_deadline(context: Any) -> Optional[float]:
+    """time.monotonic() based deadline before the Lambda timeout, or None outside Lambda."""
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - LAMBDA_DEADLINE_MARGIN_SECONDS
+    return None
+
+_embed_store: Optional[BlobStore] = None
+
+def set_embed_store(store: BlobStore) -> None:
+    """Install a custom embedding cache backend (values are base64 float32 vectors)."""
+    global _embed_store
+    _embed_store = store
+
+def get_embed_store() -> BlobStore:
+    global _embed_store
+    if _embed_store is None:
+        if EMBED_STORE_BACKEND in ('', 'memory'):
+            _embed_store = TieredBlobStore(EMBED_MEMORY_MAX_BYTES, EMBED_DISK_MAX_BYTES, EMBED_DIR)
+        else:
+            import importlib
+            module_name, _, class_name = EMBED_STORE_BACKEND.partition(':')
+            _embed_store = getattr(importlib.import_module(module_name), class_name)()
+    return _embed_store
+
+def _embed_cache_key(namespace: str, model: str, dimensions: Optional[int], text: str) -> str:
+    digest = hashlib.sha256(f'{model}\x00{dimensions or 0}\x00'.encode('utf-8') + text.encode('utf-8')).hexdigest()
+    return f'{namespace}/{digest}'
+
+def _embed_options(request_data: Dict[str, Any], default_model: str = EMBED_DEFAULT_MODEL) -> Tuple[str, Optional[int], Optional[str]]:
+    """Returns (model, dimensions, error message) from the 'model' and 'dimensions' body fields."""
+    model = request_data.get('model') or default_model
+    dimensions = request_data.get('dimensions')
+    if not isinstance(model, str):
+        return model, dimensions, '"model" must be a string'
+    if dimensions is not None and (isinstance(dimensions, bool) or not isinstance(dimensions, int) or dimensions <= 0):
+        return model, None, '"dimensions" must be a positive integer'
+    return model, dimensions, None
+
+def _is_openai_only_request(headers: Dict[str, Any], api_key: str) -> bool:
+    return api_key.startswith('sk-ant-') or _get_header(headers, 'X-Provider').strip().lower() in ('claude', 'anthropic')
+
+class _EmbeddingResponseError(ValueError):
+    """The embeddings API answered 200 but without a usable vector for every input."""
+
+def _invalid_embeddings_response(e: _EmbeddingResponseError, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    telemetry['error_type'] = 'invalid_upstream_response'
+    _log(f"[Lambda] ERROR: OpenAI embeddings API returned an invalid response: {str(e)}")
+    return _json_response(502, {
+        'error': 'OpenAI embeddings API returned an invalid response',
+        'error_type': 'invalid_upstream_response',
+        'error_details': str(e)
+    })
+
+def _embed_texts(texts: List[str], model: str, dimensions: Optional[int], api_key: str, deadline: Optional[float],
+                 telemetry: Dict[str, Any]) -> Tuple[List[bytes], Dict[str, int]]:
+    """
+    float32 vectors (raw bytes) for 'texts', in order. Cached vectors are keyed by content hash; the misses are
+    de-duplicated and sent to /v1/embeddings in batches of EMBED_BATCH_TEXTS texts / EMBED_BATCH_CHARS characters.
+    Returns (vectors, {"cached", "embedded", "tokens"}). Raises _EmbeddingResponseError when the response lacks
+    a vector or has vectors of the wrong size.
+    """
+    import base64
+    namespace = _blob_namespace(api_key)
+    store = get_embed_store()
+    keys = [_embed_cache_key(namespace, model, dimensions, text) for text in texts]
+    vectors: Dict[str, bytes] = {}
+    misses: 'OrderedDict[str, str]' = OrderedDict()
+    for key, text in zip(keys, texts):
+        if key in vectors or key in misses:
+            continue
+        cached = store.get(key)
+        if cached is not None:
+            vectors[key] = base64.b64decode(cached)
+        else:
+            misses[key] = text
+
+    batches: List[List[Tuple[str, str]]] = []
+    chars = 0
+    for key, text in misses.items():
+        if not batches or len(batches[-1]) >= EMBED_BATCH_TEXTS or chars + len(text) > EMBED_BATCH_CHARS:
+            batches.append([])
+            chars = 0
+        batches[-1].append((key, text))
+        chars += len(text)
+
+    headers = _provider_request_headers('OpenAI', api_key)
+    tokens = 0
+    for batch in batches:
+        # base64 is the raw float32 vector: no float parsing, and it is what the cache stores
+        payload: Dict[str, Any] = {'model': model, 'input': [text for _, text in batch], 'encoding_format': 'base64'}
+        if dimensions:
+            payload['dimensions'] = dimensions
+        timeout = EMBED_TIMEOUT_SECONDS if deadline is None else max(1, min(EMBED_TIMEOUT_SECONDS, int(deadline - time.monotonic())))
+        with _urlopen_with_retries(f'{OPENAI_API_BASE}/v1/embeddings', json.dumps(payload).encode('utf-8'),
+                                   headers, timeout, deadline, telemetry) as response:
+            result = json.loads(response.read())
+        expected_bytes = dimensions * 4 if dimensions else None
+        for item in result.get('data') or []:
+            index = item.get('index') if isinstance(item, dict) else None
+            if not isinstance(index, int) or not 0 <= index < len(batch) or not isinstance(item.get('embedding'), str):
+                raise _EmbeddingResponseError(f'Embeddings response has an invalid item (index {index!r})')
+            vector = base64.b64decode(item['embedding'])
+            expected_bytes = expected_bytes or len(vector)
+            if not vector or len(vector) != expected_bytes or len(vector) % 4:
+                raise _EmbeddingResponseError(f'Embeddings response has a {len(vector) // 4}-dimension vector; '
+                                              f'expected {expected_bytes // 4}')
+            key = batch[index][0]
+            vectors[key] = vector
+            store.put(key, item['embedding'])
+        tokens += (result.get('usage') or {}).get('total_tokens') or 0
+
+    stats = {'cached': sum(1 for key in keys if key not in misses), 'embedded': len(misses), 'tokens': tokens}
+    telemetry.update({'embed_texts': len(texts), 'embed_cached': stats['cached'], 'embed_calls': len(batches),
+                      'embed_tokens': tokens})
+    missing = [i for i, key in enumerate(keys) if key not in vectors]
+    if missing:
+        raise _EmbeddingResponseError(f'Embeddings response is missing {len(missing)} of {len(texts)} vectors')
+    return [vectors[key] for key in keys], stats
+
+def _handle_embed(event: Dict[str, Any], context: Any, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    POST /embed with {"texts": ["...", ...], "model": "text-embedding-3-small", "dimensions": 512,
+    "encoding_format": "float" | "base64"}. Responds with the vectors in input order; base64 vectors are
+    little-endian float32. Texts embedded before (same key, model and dimensions) come from the cache.
+    """
+    event = normalize_event(event)
+    headers = event.get('headers', {}) or {}
+    telemetry['route'] = 'embed'
+    api_key, auth_header = _extract_api_key(headers)
+    if not api_key:
+        return _missing_api_key_response(headers, auth_header)
+    if _is_openai_only_request(headers, api_key):
+        return _json_response(400, {'error': 'Embeddings require an OpenAI API key (Anthropic has no embeddings API)'})
+    request_data, error_response = _parse_request_body(event, headers)
+    if error_response:
+        return error_response
+
+    texts = (request_data.get('texts') or request_data.get('input')) if isinstance(request_data, dict) else None
+    if not isinstance(texts, list) or not texts or not all(isinstance(t, str) and t for t in texts):
+        return _json_response(400, {'error': 'Expected a non-empty "texts" array of non-empty strings'})
+    if len(texts) > EMBED_MAX_TEXTS:
+        return _json_response(413, {'error': f'Request has {len(texts)} texts; the maximum is {EMBED_MAX_TEXTS}'})
+    model, dimensions, options_error = _embed_options(request_data)
+    encoding_format = request_data.get('encoding_format') or 'float'
+    if options_error or encoding_format not in ('float', 'base64'):
+        return _json_response(400, {'error': options_error or '"encoding_format" must be "float" or "base64"'})
+    telemetry.update({'provider': 'OpenAI', 'model': model})
+
+    try:
+        vectors, stats = _embed_texts(texts, model, dimensions, api_key, _lambda_deadline(context), telemetry)
+    except urllib.error.HTTPError as e:
+        return _upstream_api_error(e, 'OpenAI embeddings API', telemetry)
+    except _EmbeddingResponseError as e:
+        return _invalid_embeddings_response(e, telemetry)
+    if encoding_format == 'base64':
+        import base64
+        embeddings: List[Any] = [base64.b64encode(vector).decode('ascii') for vector in vectors]
+    else:
+        from array import array
+        embeddings = [array('f', vector).tolist() for vector in vectors]
+    return _json_response(200, {
+        'model': model,
+        'dimensions': len(vectors[0]) // 4,
+        'embeddings': embeddings,
+        'usage': {'cached': stats['cached'], 'embedded': stats['embedded'], 'total_tokens': stats['tokens']}
+    }, {'X-Proxy-Embed-Cached': f"{stats['cached']}/{len(texts)}"})
+
+_numpy_warned = False
+
+def _numpy_module() -> Any:
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+def _search_backend() -> str:
+    """'numpy', or 'python' for the pure Python scan (logged once per instance: it is ~100x slower)."""
+    global _numpy_warned
+    if _numpy_module() is not None:
+        return 'numpy'
+    if not _numpy_warned:
+        _numpy_warned = True
+        _log("[Lambda] WARNING: NumPy is not installed; /search queries use the pure Python scan (~100x slower)")
+    return 'python'
+
+def _unit_vector(vector: bytes) -> Optional[bytes]:
+    """The float32 vector scaled to length 1 (cosine similarity becomes a dot product); None for a zero vector."""
+    import math
+    from array import array
+    values = array('f', vector)
+    norm = math.sqrt(sum(x * x for x in values))
+    if not norm:
+        return None
+    return array('f', (x / norm for x in values)).tobytes()
+
+class _VectorIndex:
+    """
+    One /search index on local disk. 'vectors.f32' is a memory-mapped matrix of unit-length float32 rows whose
+    capacity doubles as it grows; 'index.json' holds [id, content hash, metadata] per row. Deleted rows are zeroed
+    and reused by later upserts. Callers hold 'lock' and check 'closed' (an index evicted from the open-index
+    LRU is closed).
+    """
+
+    def __init__(self, directory: str, state: Dict[str, Any]):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.closed = False
+        self.model: str = state['model']
+        self.dimensions: int = state['dimensions']
+        self.requested_dimensions: Optional[int] = state.get('requested_dimensions')
+        self.entries: List[Optional[List[Any]]] = state['entries']
+        self.rows = {entry[0]: row for row, entry in enumerate(self.entries) if entry is not None}
+        self.free = [row for row, entry in enumerate(self.entries) if entry is None]
+        self._file = open(os.path.join(directory, 'vectors.f32'), 'r+b')
+        self._map: Any = None
+
+    def _mapped(self) -> Any:
+        import mmap
+        needed = max(1, len(self.entries)) * self.dimensions * 4
+        if self._map is None or len(self._map) < needed:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < needed:
+                size = max(needed, 2 * size, SEARCH_INITIAL_ROWS * self.dimensions * 4)
+                self._file.truncate(size)
+            self._close_map()
+            self._map = mmap.mmap(self._file.fileno(), size)
+        return self._map
+
+    def _close_map(self) -> None:
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # A NumPy view is still alive; the map is released with it
+            self._map = None
+
+    def _write_row(self, row: int, vector: bytes) -> None:
+        stride = self.dimensions * 4
+        self._mapped()[row * stride:(row + 1) * stride] = vector
+
+    def upsert(self, item_id: str, content_hash: str, metadata: Any, vector: bytes) -> None:
+        row = self.rows.get(item_id)
+        if row is None:
+            row = self.free.pop() if self.free else len(self.entries)
+            if row == len(self.entries):
+                self.entries.append(None)
+            self.rows[item_id] = row
+        self.entries[row] = [item_id, content_hash, metadata]
+        self._write_row(row, vector)
+
+    def delete(self, item_id: str) -> bool:
+        row = self.rows.pop(item_id, None)
+        if row is None:
+            return False
+        self.entries[row] = None
+        self.free.append(row)
+        self._write_row(row, bytes(self.dimensions * 4))
+        return True
+
+    def query(self, vector: bytes, top_k: int) -> List[Tuple[int, float]]:
+        """(row, cosine score) of the top_k rows, best first."""
+        k = min(top_k, len(self.rows))
+        if k <= 0:
+            return []
+        mapped = self._mapped()
+        numpy = _numpy_module()
+        if numpy is not None:
+            matrix = numpy.frombuffer(mapped, dtype=numpy.float32, count=len(self.entries) * self.dimensions)
+            scores = matrix.reshape(len(self.entries), self.dimensions) @ numpy.frombuffer(vector, dtype=numpy.float32)
+            del matrix
+            if self.free:
+                scores[self.free] = -numpy.inf
+            top = numpy.argpartition(-scores, k - 1)[:k]
+            top = top[numpy.argsort(-scores[top])]
+            return [(int(row), float(scores[row])) for row in top]
+
+        import heapq
+        import operator
+        from array import array
+        query = array('f', vector)
+        dims = self.dimensions
+        with memoryview(mapped) as raw, raw.cast('f') as values:
+            scored = ((sum(map(operator.mul, values[row * dims:(row + 1) * dims], query)), row) for row in self.rows.values())
+            return [(row, score) for score, row in heapq.nlargest(k, scored)]
+
+    def save(self) -> None:
+        if self._map is not None:
+            self._map.flush()
+        path = os.path.join(self.directory, 'index.json')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model, 'dimensions': self.dimensions, 'requested_dimensions': self.requested_dimensions,
+                       'entries': self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        self.closed = True
+        self._close_map()
+        self._file.close()
+
+_SEARCH_INDEX_NAME = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+_search_indexes: 'OrderedDict[str, _VectorIndex]' = OrderedDict()
+_search_indexes_lock = threading.Lock()
+
+def _search_index_dir(api_key: str, name: str) -> str:
+    return os.path.join(SEARCH_DIR, f"{_blob_namespace(api_key)}_{hashlib.sha256(name.encode('utf-8')).hexdigest()[:32]}")
+
+def _open_search_index(directory: str, create: Optional[Dict[str, Any]] = None) -> Optional[_VectorIndex]:
+    """
+    The index stored in 'directory' (None if there is none), or a new empty index from the 'create' state.
+    Open indexes stay mapped in a small LRU across warm invocations.
+    """
+    with _search_indexes_lock:
+        index = _search_indexes.get(directory)
+        if index is not None:
+            _search_indexes.move_to_end(directory)
+            return index
+        try:
+            with open(os.path.join(directory, 'index.json'), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            if create is None:
+                return None
+            os.makedirs(directory, exist_ok=True)
+            open(os.path.join(directory, 'vectors.f32'), 'wb').close()
+            state = dict(create, entries=[])
+        index = _VectorIndex(directory, state)
+        _search_indexes[directory] = index
+        while len(_search_indexes) > max(1, SEARCH_OPEN_INDEXES):
+            _, evicted = _search_indexes.popitem(last=False)
+            with evicted.lock:
+                evicted.close()
+        return index
+
+def _drop_search_index(directory: str) -> None:
+    import shutil
+    with _search_indexes_lock:
+        index = _search_indexes.pop(directory, None)
+    if index is not None:
+        with index.lock:
+            index.close()
+    shutil.rmtree(directory, ignore_errors=True)
 
-    instructions = "\n\n".join([p for p in instructions_parts if p])
-    return (instructions if instructions else None), non_system
+def _search_upserts(items: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Validate 'upsert': [{"id", "text" | "vector", "metadata"?}, ...]. Returns (items, error message)."""
+    if items is None:
+        return [], None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return [], '"upsert" must be an array of {"id", "text" | "vector", "metadata"} objects'
+    seen = set()
+    for i, item in enumerate(items):
+        if not isinstance(item.get('id'), str) or not item['id']:
+            return [], f'upsert[{i}].id must be a non-empty string'
+        if item['id'] in seen:
+            return [], f'Duplicate upsert id: {item["id"]}'
+        seen.add(item['id'])
+        text, vector = item.get('text'), item.get('vector')
+        if not (isinstance(text, str) and text) and not _is_number_list(vector):
+            return [], f'upsert[{i}] needs a non-empty "text" or a "vector" of numbers'
+    return items, None
 
-def _openai_messages_to_responses_input(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def _is_number_list(value: Any) -> bool:
+    return (isinstance(value, list) and bool(value)
+            and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in value))
+
+def _handle_search(event: Dict[str, Any], context: Any, telemetry: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Convert chat-completions style messages into Responses API 'input' items.
-    This uses the canonical content-part format for compatibility.
+    POST /search on a named per-project vector index:
+    {"index": "MyProject", "upsert": [{"id": "Assets/Player.cs", "text": "...", "metadata": {...}}],
+     "delete": ["Assets/Old.cs"], "delete_prefixes": ["Assets/Legacy/"], "query": "player movement", "top_k": 10}
+    Every part is optional; deletes, then upserts are applied before the query. Upserts whose text (or vector) is
+    unchanged are skipped without embedding; "reset": true drops the index first (e.g. to change models).
     """
-    items: List[Dict[str, Any]] = []
-    for msg in messages or []:
-        role = (msg.get('role') or '').strip().lower() or 'user'
-        content = msg.get('content', '')
-        if content is None:
-            content = ""
-        if not isinstance(content, str):
-            content = str(content)
+    from array import array
+    event = normalize_event(event)
+    headers = event.get('headers', {}) or {}
+    telemetry['route'] = 'search'
+    api_key, auth_header = _extract_api_key(headers)
+    if not api_key:
+        return _missing_api_key_response(headers, auth_header)
+    request_data, error_response = _parse_request_body(event, headers)
+    if error_response:
+        return error_response
+    if not isinstance(request_data, dict):
+        return _json_response(400, {'error': 'Expected a JSON object in request body'})
 
-        # Use content parts; keep roles to preserve conversation shape.
-        # For Responses API, 'input' should use input_* parts even for assistant history items.
-        part_type = 'input_text'
+    name = request_data.get('index')
+    if not isinstance(name, str) or not _SEARCH_INDEX_NAME.match(name):
+        return _json_response(400, {'error': '"index" must be 1-128 characters of letters, digits and ._:-'})
+    upserts, upsert_error = _search_upserts(request_data.get('upsert'))
+    deletes = request_data.get('delete') or []
+    prefixes = request_data.get('delete_prefixes') or []
+    query, query_vector = request_data.get('query'), request_data.get('query_vector')
+    top_k = request_data.get('top_k', 10)
+    if upsert_error:
+        return _json_response(400, {'error': upsert_error})
+    if not isinstance(deletes, list) or not all(isinstance(x, str) for x in deletes) or \
+            not isinstance(prefixes, list) or not all(isinstance(x, str) and x for x in prefixes):
+        return _json_response(400, {'error': '"delete" and "delete_prefixes" must be arrays of strings'})
+    if (query is not None and not (isinstance(query, str) and query)) or (query_vector is not None and not _is_number_list(query_vector)):
+        return _json_response(400, {'error': '"query" must be a non-empty string and "query_vector" an array of numbers'})
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= SEARCH_MAX_TOP_K:
+        return _json_response(400, {'error': f'"top_k" must be an integer between 1 and {SEARCH_MAX_TOP_K}'})
+    if _is_openai_only_request(headers, api_key) and (query or any('text' in item for item in upserts)):
+        return _json_response(400, {'error': 'Embedding texts requires an OpenAI API key (Anthropic has no embeddings API)'})
 
-        items.append({
-            'role': role,
-            'content': [
-                {'type': part_type, 'text': content}
-            ]
-        })
-    return items
+    directory = _search_index_dir(api_key, name)
+    if request_data.get('reset'):
+        _drop_search_index(directory)
+    index = _open_search_index(directory)
+    if index is None and not upserts:
+        return _json_response(404, {'error': f'Unknown index {name}; upsert its items first', 'error_type': 'index_not_found'})
+    model, dimensions, options_error = _embed_options(request_data, index.model if index else EMBED_DEFAULT_MODEL)
+    if options_error:
+        return _json_response(400, {'error': options_error})
+    if index is not None:
+        if model != index.model or (dimensions is not None and dimensions != index.dimensions):
+            return _json_response(409, {
+                'error': f'Index {name} uses {index.model} with {index.dimensions} dimensions; send "reset": true to rebuild it',
+                'error_type': 'index_model_mismatch'
+            })
+        dimensions = index.requested_dimensions
+    telemetry.update({'provider': 'OpenAI', 'model': model})
 
-def _safe_len(x: Any) -> int:
-    try:
-        return len(x)
-    except Exception:
-        return 0
+    # Content hashes decide what has changed; only changed texts (and the query) are embedded
+    def content_hash(item: Dict[str, Any]) -> str:
+        data = item['text'].encode('utf-8') if isinstance(item.get('text'), str) else array('f', item['vector']).tobytes()
+        return hashlib.sha256(data).hexdigest()
+    known = {} if index is None else {entry[0]: entry[1] for entry in list(index.entries) if entry is not None}
+    changed: List[Tuple[Dict[str, Any], str]] = []
+    unchanged: List[Dict[str, Any]] = []
+    for item in upserts:
+        item_hash = content_hash(item)
+        if known.get(item['id']) == item_hash:
+            unchanged.append(item)
+        else:
+            changed.append((item, item_hash))
+    texts = [item['text'] for item, _ in changed if isinstance(item.get('text'), str)]
+    if query:
+        texts.append(query)
+    if len(texts) > EMBED_MAX_TEXTS:
+        return _json_response(413, {'error': f'Request needs {len(texts)} embeddings; the maximum is {EMBED_MAX_TEXTS}'})
+    stats = {'cached': 0, 'embedded': 0, 'tokens': 0}
+    embedded: List[bytes] = []
+    if texts:
+        try:
+            embedded, stats = _embed_texts(texts, model, dimensions, api_key, _lambda_deadline(context), telemetry)
+        except urllib.error.HTTPError as e:
+            return _upstream_api_error(e, 'OpenAI embeddings API', telemetry)
+        except _EmbeddingResponseError as e:
+            return _invalid_embeddings_response(e, telemetry)
+    pending = iter(embedded)
+    vectors = [next(pending) if isinstance(item.get('text'), str) else array('f', item['vector']).tobytes() for item, _ in changed]
+    query_bytes = next(pending) if query else (array('f', query_vector).tobytes() if query_vector else None)
 
-def _log_request_summary(provider_name: str, api_request: Dict[str, Any], is_streaming_request: bool) -> None:
-    model = api_request.get('model', '')
-    if provider_name == 'Claude':
-        msg_count = _safe_len(api_request.get('messages', []))
-        print(f"[Lambda] Request to Claude - stream: {is_streaming_request}, model: {model}, messages: {msg_count}")
-        return
+    expected_bytes = index.dimensions * 4 if index is not None else len((vectors or [query_bytes])[0])
+    if any(len(v) != expected_bytes for v in vectors + ([query_bytes] if query_bytes else [])):
+        return _json_response(400, {'error': f'All vectors must have {expected_bytes // 4} dimensions'})
+    unit_query = _unit_vector(query_bytes) if query_bytes else None
 
-    # OpenAI Responses: log using 'input' (not 'messages').
-    input_items = api_request.get('input', [])
-    input_count = _safe_len(input_items) if isinstance(input_items, list) else 0
-    print(f"[Lambda] Request to OpenAI - stream: {is_streaming_request}, model: {model}, input_items: {input_count}")
+    while True:
+        if index is None:
+            index = _open_search_index(directory, {'model': model, 'dimensions': expected_bytes // 4,
+                                                   'requested_dimensions': dimensions})
+        with index.lock:
+            if index.closed:
+                index = None
+                continue
+            deleted = sum(1 for item_id in deletes if index.delete(item_id))
+            if prefixes:
+                deleted += sum(1 for item_id in [i for i in index.rows if i.startswith(tuple(prefixes))] if index.delete(item_id))
+            new_ids = sum(1 for item, _ in changed if item['id'] not in index.rows)
+            if len(index.rows) + new_ids > SEARCH_MAX_ROWS:
+                if deleted:
+                    index.save()
+                return _json_response(413, {'error': f'Index {name} would exceed {SEARCH_MAX_ROWS} items'})
+            for (item, item_hash), vector in zip(changed, vectors):
+                unit = _unit_vector(vector)
+                index.upsert(item['id'], item_hash, item.get('metadata'), unit or bytes(len(vector)))
+            for item in unchanged:
+                if 'metadata' in item:
+                    index.entries[index.rows[item['id']]][2] = item['metadata']
+            if deleted or upserts:
+                index.save()
+            results = []
+            if unit_query:
+                for row, score in index.query(unit_query, top_k):
+                    item_id, _, metadata = index.entries[row]
+                    result: Dict[str, Any] = {'id': item_id, 'score': round(score, 6)}
+                    if metadata is not None:
+                        result['metadata'] = metadata
+                    results.append(result)
+            count = len(index.rows)
+        break
 
-def _log_user_message_sizes(provider_name: str, api_request: Dict[str, Any]) -> None:
+    backend = _search_backend()
+    telemetry.update({'search_items': count, 'search_upserted': len(changed), 'search_deleted': deleted,
+                      'search_backend': backend})
+    payload: Dict[str, Any] = {
+        'index': name, 'model': model, 'dimensions': expected_bytes // 4, 'count': count,
+        'upserted': len(changed), 'unchanged': len(unchanged), 'deleted': deleted,
+        'usage': {'cached': stats['cached'], 'embedded': stats['embedded'], 'total_tokens': stats['tokens']}
+    }
+    if query_bytes is not None:
+        payload['results'] = results
+    return _json_response(200, payload, {'X-Proxy-Search-Backend': backend})
+
+def _hedge_candidates(hedge: Any, headers: Dict[str, Any], api_key: str) -> Tuple[List[Dict[str, str]], Optional[str]]:
     """
-    Best-effort logging of user message text sizes without assuming a specific schema.
+    Validate the 'hedge' body field: {"candidates": [{"provider": "OpenAI", "model": "gpt-4o"}, ...], "delay_ms": 1500}.
+    Each candidate needs a key for its provider: X-OpenAI-Api-Key / X-Anthropic-Api-Key headers, or the
+    request's own key when it matches the provider. Returns (candidates, error message).
     """
-    if provider_name == 'Claude':
-        for i, msg in enumerate(api_request.get('messages', []) or []):
-            if msg.get('role') == 'user':
-                content_length = len(msg.get('content', '') or '')
-                print(f"[Lambda] User message {i+1} content length: {content_length} chars")
-        return
+    raw = hedge.get('candidates') if isinstance(hedge, dict) else None
+    if not isinstance(raw, list) or not raw or not all(isinstance(c, dict) for c in raw):
+        return [], 'hedge.candidates must be a non-empty array of {"provider", "model"} objects'
+    keys = {
+        'OpenAI': _get_header(headers, 'X-OpenAI-Api-Key') or (api_key if not api_key.startswith('sk-ant-') else ''),
+        'Claude': _get_header(headers, 'X-Anthropic-Api-Key') or (api_key if api_key.startswith('sk-ant-') else '')
+    }
+    candidates = []
+    for entry in raw[:HEDGE_MAX_CANDIDATES]:
+        provider = 'Claude' if str(entry.get('provider') or '').strip().lower() in ('claude', 'anthropic') else 'OpenAI'
+        if not keys[provider]:
+            return [], f'No API key for hedge candidate provider {provider} (send X-OpenAI-Api-Key / X-Anthropic-Api-Key)'
+        model = entry.get('model') if isinstance(entry.get('model'), str) and entry.get('model') else PROVIDER_CONFIG[provider]['default_model']
+        candidates.append({'provider': provider, 'model': model, 'api_key': keys[provider]})
+    return candidates, None
 
-    # OpenAI Responses: iterate 'input' items and sum text lengths from content parts.
-    input_items = api_request.get('input', []) or []
-    if not isinstance(input_items, list):
-        return
+def _hedge_delay(hedge: Dict[str, Any], candidate: Dict[str, str], is_streaming: bool, has_file_content: bool) -> float:
+    """Seconds to wait for a first byte before launching the next candidate."""
+    if isinstance(hedge.get('delay_ms'), (int, float)) and not isinstance(hedge.get('delay_ms'), bool):
+        return max(HEDGE_MIN_DELAY_SECONDS, hedge['delay_ms'] / 1000.0)
+    learned = _latency_percentile(candidate['model'], _latency_kind(is_streaming, has_file_content), HEDGE_PERCENTILE)
+    if learned is None or learned == float('inf'):
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return max(HEDGE_MIN_DELAY_SECONDS, learned)
 
-    user_idx = 0
-    for item in input_items:
-        if not isinstance(item, dict):
-            continue
-        if (item.get('role') or '').strip().lower() != 'user':
-            continue
+def _prepend_chunk(first: Any, body: Iterator[Any]) -> Iterator[Any]:
+    try:
+        yield first
+        yield from body
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
 
-        user_idx += 1
-        parts = item.get('content', [])
-        total = 0
-        if isinstance(parts, list):
-            for part in parts:
-                if isinstance(part, dict):
-                    total += len(part.get('text', '') or '')
-        else:
-            total = len(str(parts))
-        print(f"[Lambda] User input item {user_idx} content length: {total} chars")
+def _close_result_body(result: Optional[Dict[str, Any]]) -> None:
+    body = (result or {}).get('body')
+    close = getattr(body, 'close', None)
+    if close is not None and not isinstance(body, (str, bytes)):
+        close()
 
-def normalize_event(event: Dict[str, Any]) -> Dict[str, Any]:
+def _handle_hedged_suggest(event: Dict[str, Any], context: Any, streaming_passthrough: bool, telemetry: Dict[str, Any],
+                           request_data: Dict[str, Any], api_key: str) -> Dict[str, Any]:
     """
-    Normalize event format to support both API Gateway and Lambda Function URLs.
-    Function URLs use a different event structure than API Gateway.
+    Run the request against an ordered list of provider/model candidates. The primary starts immediately;
+    the next candidate starts when no first byte (streaming) or response (non-streaming) has arrived within
+    the hedge delay, or as soon as the running candidates have all failed. The first successful candidate
+    wins, the others are cancelled, and X-Proxy-Hedge-Winner reports which one won.
     """
-    # Check if this is a Function URL event (has requestContext.http)
-    if 'requestContext' in event and 'http' in event.get('requestContext', {}):
-        # Lambda Function URL event format
-        http_context = event['requestContext']['http']
-        normalized = {
-            'httpMethod': http_context.get('method', 'POST'),
-            'path': http_context.get('path', '/'),
-            'headers': event.get('headers', {}) or {},
-            'body': event.get('body', '{}'),
-            'isBase64Encoded': event.get('isBase64Encoded', False)
+    import queue
+
+    headers = event.get('headers', {}) or {}
+    hedge = request_data.get('hedge')
+    candidates, error = _hedge_candidates(hedge, headers, api_key)
+    if error:
+        return _json_response(400, {'error': error, 'error_type': 'invalid_hedge'})
+
+    is_streaming = bool(request_data.get('stream', True))
+    has_file_content = any(_FILE_CONTENT_MARKER in _message_text(m) for m in request_data.get('messages', []) if isinstance(m, dict))
+    delay = _hedge_delay(hedge, candidates[0], is_streaming, has_file_content)
+    # Candidates re-enter _handle_suggest with their own provider, model and key (and no 'hedge' field)
+    base_headers = {k: v for k, v in headers.items() if k.lower() not in (
+        'authorization', 'x-api-key', 'x-provider', 'x-provider-name', 'x-openai-api-key', 'x-anthropic-api-key',
+        'content-encoding', 'accept-encoding', 'content-length')}
+    base_body = {k: v for k, v in request_data.items() if k not in ('hedge', 'provider', 'model')}
+
+    completions: 'queue.Queue[Tuple[int, Dict[str, Any], Dict[str, Any]]]' = queue.Queue()
+    scopes: List[_CancelScope] = []
+
+    def run(index: int, candidate: Dict[str, str], scope: _CancelScope) -> None:
+        _hedge_local.scope = scope
+        candidate_telemetry: Dict[str, Any] = {}
+        candidate_event = {
+            'httpMethod': 'POST', 'path': '/suggest',
+            'headers': dict(base_headers, **{'Authorization': f"Bearer {candidate['api_key']}", 'X-Provider': candidate['provider']}),
+            'body': json.dumps(dict(base_body, model=candidate['model'])), 'isBase64Encoded': False
         }
-        return normalized
+        try:
+            # Always run in passthrough mode so a streaming candidate can be judged on its first event
+            result = _handle_suggest(candidate_event, context, True, candidate_telemetry)
+            body = result.get('body')
+            if result.get('statusCode') == 200 and body is not None and not isinstance(body, (str, bytes)):
+                first = next(body, None)
+                if first is None or scope.cancelled:
+                    _close_result_body(result)
+                    if first is None:
+                        result = _json_response(502, {'error': f"{candidate['provider']} stream ended without data"})
+                else:
+                    result['body'] = _prepend_chunk(first, body)
+        except Exception as e:
+            result = _json_response(500, {'error': f'Proxy error: {str(e)}', 'error_type': type(e).__name__})
+        finally:
+            _hedge_local.scope = None
+            scope.release()
+        completions.put((index, result, candidate_telemetry))
+
+    def launch(index: int) -> None:
+        scope = _CancelScope()
+        scopes.append(scope)
+        threading.Thread(target=run, args=(index, candidates[index], scope), daemon=True).start()
+
+    launch(0)
+    next_launch_at = time.monotonic() + delay
+    running = 1
+    winner: Optional[Tuple[int, Dict[str, Any], Dict[str, Any]]] = None
+    failures: List[Tuple[int, Dict[str, Any], Dict[str, Any]]] = []
+    while winner is None and (running or len(scopes) < len(candidates)):
+        if len(scopes) < len(candidates) and (running == 0 or time.monotonic() >= next_launch_at):
+            _debug_log(f"[Lambda] Hedging: launching candidate {len(scopes)} ({candidates[len(scopes)]['model']})")
+            launch(len(scopes))
+            next_launch_at = time.monotonic() + delay
+            running += 1
+            continue
+        wait = max(0.0, next_launch_at - time.monotonic()) if len(scopes) < len(candidates) else None
+        try:
+            completion = completions.get(timeout=wait)
+        except queue.Empty:
+            continue
+        running -= 1
+        if completion[1].get('statusCode') == 200:
+            winner = completion
+        else:
+            failures.append(completion)
+
+    # Cancel the losers; results that still arrive are closed by their threads or drained here
+    for index, scope in enumerate(scopes):
+        if winner is None or index != winner[0]:
+            scope.cancel()
+    while True:
+        try:
+            late = completions.get_nowait()
+        except queue.Empty:
+            break
+        _close_result_body(late[1])
+
+    outcome = winner or failures[0]
+    index, result, candidate_telemetry = outcome
+    outer_phases = telemetry.pop('phases', {})
+    telemetry.update(candidate_telemetry)
+    telemetry['phases'] = dict(outer_phases, **telemetry.get('phases', {}))
+    telemetry.update({'hedge_launched': len(scopes), 'hedge_winner': index if winner else None,
+                      'hedge_delay_ms': round(delay * 1000)})
+    result_headers = result.setdefault('headers', {})
+    result_headers['X-Proxy-Hedge-Launched'] = str(len(scopes))
+    if winner:
+        result_headers['X-Proxy-Hedge-Winner'] = f"{index}:{candidates[index]['provider']}:{candidates[index]['model']}"
+
+    # Buffered mode: collect the winning stream into a single body like the regular streaming path
+    body = result.get('body')
+    if not streaming_passthrough and body is not None and not isinstance(body, (str, bytes)):
+        result['body'] = b''.join(c if isinstance(c, bytes) else c.encode('utf-8') for c in body).decode('utf-8')
+    return result
+
+def _route_request(event: Dict[str, Any], context: Any, streaming_passthrough: bool, telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """Dispatch on the request path. Anything that isn't a known sub-route is a /suggest call."""
+    path = (normalize_event(event).get('path') or '').rstrip('/')
+    try:
+        if path.endswith('/blobs'):
+            return _handle_blob_upload(event, telemetry)
+        if path.endswith('/batch'):
+            return _handle_suggest_batch(event, context, telemetry)
+        if _JOB_PATH.search(path):
+            return _handle_jobs(event, streaming_passthrough, telemetry)
+        if path.endswith('/embed'):
+            return _handle_embed(event, context, telemetry)
+        if path.endswith('/search'):
+            return _handle_search(event, context, telemetry)
+    except Exception as e:
+        telemetry['error_type'] = type(e).__name__
+        _log(f"[Lambda] EXCEPTION in {path}: {type(e).__name__}: {str(e)}")
+        return _json_response(500, {'error': f'Proxy error: {str(e)}', 'error_type': type(e).__name__})
+    return _handle_suggest(event, context, streaming_passthrough, telemetry)
+
+_cold_start = True
+
+def _run_invocation(event: Dict[str, Any], context: Any, streaming_passthrough: bool) -> Dict[str, Any]:
+    global _cold_start
+    started = time.monotonic()
+    telemetry: Dict[str, Any] = {}
+    if _cold_start:
+        _cold_start = False
+        telemetry.update({'cold_start': True, 'init_ms': INIT_DURATION_MS})
+    if _is_warmup_event(event):
+        result = _handle_warmup(telemetry)
+        _log_invocation(telemetry, result['statusCode'], len(result['body']), started)
+        return result
+    capture = _capture_sampled()
+    result = _route_request(event, context, streaming_passthrough, telemetry)
+    accept_encoding = _get_header(event.get('headers') or {}, 'Accept-Encoding')
+    body = result.get('body')
+    if body is None or isinstance(body, (str, bytes)):
+        compress_started = time.perf_counter()
+        _compress_result(result, accept_encoding)
+        if result.get('headers', {}).get('Content-Encoding'):
+            _phase_done(telemetry, 'compress', compress_started)
+            telemetry['content_encoding'] = result['headers']['Content-Encoding']
+            telemetry['wire_bytes'] = len(result['body'])
+        _add_server_timing(result, telemetry, started)
+        _log_invocation(telemetry, result.get('statusCode', 0), len(body or ''), started)
+        if capture:
+            _capture_invocation(event, telemetry, result.get('statusCode', 0), len(body or ''), started,
+                                'streaming' if streaming_passthrough else 'buffered')
     else:
-        # API Gateway event format (already normalized)
-        return event
+        # Sent before the body: covers everything up to the upstream response headers
+        _add_server_timing(result, telemetry, started)
+        log_stream = _alog_invocation_after_stream if hasattr(body, '__aiter__') else _log_invocation_after_stream
+        result['body'] = log_stream(body, telemetry, result.get('statusCode', 0), started, event if capture else None)
+        _compress_result(result, accept_encoding)
+    return result
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -148,88 +4351,154 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Expects POST request with:
     - Headers: Authorization: Bearer {apiKey} or x-api-key: {apiKey}
     - Body: { model, messages, stream, temperature, max_output_tokens, provider }
+    Streaming requests are buffered into a single body (API Gateway compatible).
+    """
+    return _run_invocation(event, context, streaming_passthrough=False)
+
+def lambda_streaming_handler(event: Dict[str, Any], context: Any, upstream_opener: Any = None) -> Dict[str, Any]:
+    """
+    Handler for Function URLs in RESPONSE_STREAM mode.
+    Same request handling as lambda_handler, but for stream: true requests the returned 'body'
+    is an iterator of SSE event bytes forwarded as they arrive from the provider.
+    Non-streaming requests and errors return the regular buffered result.
+    upstream_opener (proxy_server) opens those streams instead of _pooled_urlopen, with the same arguments and
+    errors. The response it returns is read with 'async for', and 'body' is then an async iterator.
     """
+    _upstream_local.opener = upstream_opener
+    try:
+        return _run_invocation(event, context, streaming_passthrough=True)
+    finally:
+        _upstream_local.opener = None
+
+def _build_claude_request(request_data: Dict[str, Any], model_name: str, upstream_streaming: bool,
+                          structured: Optional[Dict[str, Any]], headers: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+    """Messages API request body for a /suggest body (sets structured['tool_name'] for structured output)."""
+    structured_format = structured['format'] if structured else None
+    # Claude API format
+    claude_request = {
+        'model': model_name,
+        'messages': request_data.get('messages', []),
+        'max_tokens': (
+            request_data.get('max_tokens') or 
+            request_data.get('max_output_tokens') or 
+            4096
+        )
+    }
+    
+    # Claude requires system prompt as top-level parameter (not in messages array)
+    # The C# client extracts system messages and sends them as 'system' field
+    if 'system' in request_data and request_data.get('system'):
+        claude_request['system'] = request_data.get('system')
+    
+    # Claude supports temperature
+    if 'temperature' in request_data:
+        claude_request['temperature'] = request_data.get('temperature', 0.7)
+    
+    # Claude supports streaming
+    if upstream_streaming:
+        claude_request['stream'] = True
+    
+    # Structured output: forced tool whose input is the JSON response
+    if structured:
+        structured['tool_name'] = _apply_anthropic_structured_output(claude_request, structured_format)
+    
+    # Prompt caching: mark the stable system prefix and conversation history as cacheable
+    if _prompt_cache_enabled(headers):
+        _apply_anthropic_prompt_cache(claude_request, f'{_blob_namespace(api_key)}:{model_name}')
+    return claude_request
+
+def _build_openai_request(request_data: Dict[str, Any], model_name: str, upstream_streaming: bool,
+                          structured_format: Optional[Dict[str, Any]], headers: Dict[str, Any], api_key: str,
+                          previous_response_id: Optional[str] = None) -> Dict[str, Any]:
+    """Responses API request body for a /suggest body."""
+    # OpenAI Responses API format
+    instructions, non_system_messages = _extract_system_instructions_and_non_system_messages(request_data)
+    
+    openai_request = {
+        'model': model_name,
+        'input': _openai_messages_to_responses_input(non_system_messages),
+        'stream': upstream_streaming
+    }
+    
+    if instructions:
+        openai_request['instructions'] = instructions
+    
+    # Session mode: only the new turn is sent; the provider keeps the earlier ones
+    if previous_response_id:
+        openai_request['previous_response_id'] = previous_response_id
+    
+    # Temperature is best-effort. Unity omits it when unsupported.
+    if request_data.get('temperature') is not None:
+        openai_request['temperature'] = request_data.get('temperature')
+    
+    # Use max_output_tokens for Responses API (fallback to other fields for backward compatibility).
+    max_output_tokens = (
+        request_data.get('max_output_tokens') or
+        request_data.get('max_completion_tokens') or
+        request_data.get('max_tokens') or
+        2000
+    )
+    openai_request['max_output_tokens'] = max_output_tokens
+    
+    # Structured output (agent mode): Chat Completions' response_format becomes Responses text.format
+    if structured_format:
+        openai_request['text'] = {'format': structured_format}
+    
+    # Optional reasoning controls (best-effort).
+    reasoning_effort = request_data.get('reasoning_effort')
+    if isinstance(reasoning_effort, str) and reasoning_effort.strip():
+        openai_request['reasoning'] = {'effort': reasoning_effort.strip()}
+    
+    # Prompt caching is automatic for OpenAI; a stable key improves cache routing
+    if _prompt_cache_enabled(headers):
+        openai_request['prompt_cache_key'] = _openai_prompt_cache_key(_blob_namespace(api_key), model_name, instructions)
+    return openai_request
+
+def _provider_request_headers(provider: str, api_key: str) -> Dict[str, str]:
+    if provider == 'Claude':
+        # Claude uses x-api-key header and anthropic-version header
+        return {
+            'x-api-key': api_key,
+            'anthropic-version': '2023-06-01',
+            'Content-Type': 'application/json',
+            'User-Agent': 'AiEditorAgent/1.0 (AWS Lambda)'
+        }
+    # OpenAI uses Authorization: Bearer header
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+        'User-Agent': 'AiEditorAgent/1.0 (AWS Lambda)'
+    }
+
+def _handle_suggest(event: Dict[str, Any], context: Any, streaming_passthrough: bool, telemetry: Dict[str, Any],
+                    max_timeout_seconds: Optional[float] = None) -> Dict[str, Any]:
     # Initialize variables for error handling
     provider = 'OpenAI'
     timeout_seconds = 90
+    admission_key = None
+    latency_kind = None
+    phase_started = time.perf_counter()
     
     # Normalize event to support both API Gateway and Function URLs
     event = normalize_event(event)
+    phase_started = _phase_done(telemetry, 'normalize', phase_started)
     
     # Log request details for debugging
-    print(f"[Lambda] Handler invoked. Event keys: {list(event.keys())}")
-    print(f"[Lambda] Event type: {type(event)}")
-    print(f"[Lambda] HTTP Method: {event.get('httpMethod', 'N/A')}")
-    print(f"[Lambda] Path: {event.get('path', 'N/A')}")
-    print(f"[Lambda] Headers: {list(event.get('headers', {}).keys())}")
+    _debug_log(f"[Lambda] Handler invoked. Event keys: {list(event.keys())}")
+    _debug_log(f"[Lambda] Event type: {type(event)}")
+    _debug_log(f"[Lambda] HTTP Method: {event.get('httpMethod', 'N/A')}")
+    _debug_log(f"[Lambda] Path: {event.get('path', 'N/A')}")
+    _debug_log(f"[Lambda] Headers: {list(event.get('headers', {}).keys())}")
     
     try:
-        # Extract Authorization header or fallback to X-API-Key custom header
-        # API Gateway may block Authorization header if AWS_IAM auth is enabled
         headers = event.get('headers', {}) or {}
-        
-        # Try Authorization header first
-        auth_header = headers.get('Authorization') or headers.get('authorization', '')
-        
-        # Fallback to custom header if Authorization is blocked by API Gateway
-        api_key = None
-        if auth_header:
-            if auth_header.startswith('Bearer '):
-                api_key = auth_header.replace('Bearer ', '').strip()
-            else:
-                # If Authorization header exists but doesn't start with Bearer, it might be malformed
-                # Try to extract anyway, or check if it's already just the key
-                api_key = auth_header.strip()
-        
-        # Fallback to X-API-Key header
-        if not api_key:
-            api_key = (
-                headers.get('X-API-Key') or 
-                headers.get('x-api-key') or 
-                headers.get('X-Api-Key') or
-                ''
-            ).strip()
-        
+        api_key, auth_header = _extract_api_key(headers)
         if not api_key:
-            return {
-                'statusCode': 401,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'Missing API key. Provide either Authorization: Bearer {key} or X-API-Key header',
-                    'debug': {
-                        'headers_available': list(headers.keys()),
-                        'auth_header_present': bool(auth_header)
-                    }
-                })
-            }
+            return _missing_api_key_response(headers, auth_header)
         
-        # Parse request body
-        # Handle base64 encoded body (API Gateway sometimes sends this)
-        body = event.get('body', '{}')
-        if isinstance(body, str):
-            # Check if body is base64 encoded
-            if event.get('isBase64Encoded', False):
-                import base64
-                body = base64.b64decode(body).decode('utf-8')
-            try:
-                request_data = json.loads(body)
-            except json.JSONDecodeError as e:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'error': f'Invalid JSON in request body: {str(e)}',
-                        'body_preview': body[:200] if len(body) > 200 else body
-                    })
-                }
-        else:
-            request_data = body
+        request_data, error_response = _parse_request_body(event, headers)
+        if error_response:
+            return error_response
         
         # Validate required fields
         if not isinstance(request_data.get('messages'), list) or len(request_data.get('messages', [])) == 0:
@@ -242,6 +4511,21 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'error': 'Missing or empty messages array in request body'})
             }
         
+        # Expand {"blob_ref": ...} placeholders before the request is translated for the provider
+        missing_refs = _expand_blob_refs(request_data, _blob_namespace(api_key))
+        if missing_refs:
+            telemetry['blob_misses'] = len(missing_refs)
+            return _json_response(409, {
+                'error': 'Unknown blob_ref(s). Please resend the blob contents via POST /blobs and retry the request.',
+                'error_type': 'blob_not_found',
+                'missing_blob_refs': missing_refs
+            })
+        phase_started = _phase_done(telemetry, 'parse', phase_started)
+
+        # Opt-in hedging across provider/model candidates
+        if request_data.get('hedge'):
+            return _handle_hedged_suggest(event, context, streaming_passthrough, telemetry, request_data, api_key)
+
         # Determine provider from X-Provider header or request body
         provider_header = (
             headers.get('X-Provider') or 
@@ -289,117 +4573,163 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Invalid API key format. Claude keys start with "sk-ant-"'})
                 }
         
-        # Determine API URL and endpoint based on provider
-        if provider == 'Claude':
-            api_url = 'https://api.anthropic.com/v1/messages'
-        else:
-            # OpenAI: migrate to Responses API
-            api_url = 'https://api.openai.com/v1/responses'
+        # OpenAI uses the Responses API, Claude the Messages API
+        provider_config = PROVIDER_CONFIG[provider]
+        api_url = provider_config['api_url']
         
         # Prepare request based on provider
         is_streaming_request = request_data.get('stream', True)
-        model_name = request_data.get('model', 'gpt-4' if provider == 'OpenAI' else 'claude-sonnet-4-20250514')
+        model_name = request_data.get('model', provider_config['default_model'])
+
+        # Session mode: the client sends only the new turn; OpenAI chains it onto the previous response,
+        # otherwise the earlier turns are put back in front of it from the session store
+        session = None
+        previous_response_id = None
+        session_id, session_reset, session_error = _session_request(headers, request_data)
+        if session_error:
+            return _json_response(400, {'error': session_error, 'error_type': 'invalid_session'})
+        if session_id:
+            session_key = _session_key(api_key, session_id)
+            session_record = None if session_reset else _load_session(session_key)
+            if session_record is None and not session_reset:
+                telemetry['session'] = 'expired'
+                return _json_response(409, {
+                    'error': 'Unknown or expired session. Please resend the full conversation with X-Proxy-Session-Reset: true.',
+                    'error_type': 'session_not_found',
+                    'session_id': session_id
+                })
+            history = session_record['messages'] if session_record else []
+            if session_record and provider == 'OpenAI' and session_record.get('provider') == 'OpenAI' and session_record.get('previous_response_id'):
+                previous_response_id = session_record['previous_response_id']
+                session_status = 'chained'
+            else:
+                messages = request_data.get('messages') or []
+                request_data['messages'] = ([m for m in messages if _is_system_message(m)] + history +
+                                            [m for m in messages if not _is_system_message(m)])
+                session_status = 'replayed' if session_record else 'started'
+            session = {'key': session_key, 'provider': provider, 'model': model_name, 'history': history}
+            telemetry['session'] = session_status
+
+        # Pre-flight context budgeting: trim older turns that won't fit instead of paying for a
+        # slow prefill or a "context length exceeded" round trip
+        token_family = 'anthropic' if provider == 'Claude' else 'openai'
+        requested_output_tokens = (
+            request_data.get('max_output_tokens') or
+            request_data.get('max_completion_tokens') or
+            request_data.get('max_tokens') or
+            (4096 if provider == 'Claude' else 2000)
+        )
+        context_budget = _context_budget_tokens(headers, request_data, model_name, requested_output_tokens)
+        estimated_input_tokens, dropped_messages, compacted_messages = _fit_context_budget(request_data, token_family, context_budget)
+        telemetry['estimated_input_tokens'] = estimated_input_tokens
+        if dropped_messages or compacted_messages:
+            telemetry.update({'trimmed_messages': dropped_messages, 'compacted_messages': compacted_messages})
+            _debug_log(f"[Lambda] Context budget {context_budget}: dropped {dropped_messages}, compacted {compacted_messages} message(s)")
+        if context_budget and estimated_input_tokens > context_budget:
+            _log(f"[Lambda] WARNING: Estimated input ({estimated_input_tokens} tokens) still exceeds the context budget ({context_budget})")
+        if session:
+            # What the session holds after this turn (trimmed like the request when the history was replayed)
+            session['messages'] = ((session['history'] if previous_response_id else []) +
+                                   [m for m in request_data.get('messages') or [] if not _is_system_message(m)])
+
+        # Structured output: non-streaming requests are streamed upstream (and reassembled) so that
+        # output which can no longer be valid JSON is caught mid-generation
+        structured_format = _structured_output_format(request_data)
+        structured = {'format': structured_format, 'tool_name': None} if structured_format else None
+        upstream_streaming = bool(is_streaming_request) or bool(
+            structured and STRUCTURED_OUTPUT_EARLY_ABORT and STRUCTURED_OUTPUT_VALIDATE)
         
         if provider == 'Claude':
-            # Claude API format
-            claude_request = {
-                'model': model_name,
-                'messages': request_data.get('messages', []),
-                'max_tokens': (
-                    request_data.get('max_tokens') or 
-                    request_data.get('max_output_tokens') or 
-                    4096
-                )
-            }
-            
-            # Claude requires system prompt as top-level parameter (not in messages array)
-            # The C# client extracts system messages and sends them as 'system' field
-            if 'system' in request_data and request_data.get('system'):
-                claude_request['system'] = request_data.get('system')
-            
-            # Claude supports temperature
-            if 'temperature' in request_data:
-                claude_request['temperature'] = request_data.get('temperature', 0.7)
-            
-            # Claude supports streaming
-            if is_streaming_request:
-                claude_request['stream'] = True
-            
-            api_request = claude_request
-            req_data_json = json.dumps(api_request)
-            req_data = req_data_json.encode('utf-8')
-            
-            # Claude uses x-api-key header and anthropic-version header
-            request_headers = {
-                'x-api-key': api_key,
-                'anthropic-version': '2023-06-01',
-                'Content-Type': 'application/json',
-                'User-Agent': 'AiEditorAgent/1.0 (AWS Lambda)'
-            }
-            
-            _log_request_summary(provider, api_request, is_streaming_request)
+            api_request = _build_claude_request(request_data, model_name, upstream_streaming, structured, headers, api_key)
         else:
-            # OpenAI Responses API format
-            instructions, non_system_messages = _extract_system_instructions_and_non_system_messages(request_data)
-
-            openai_request = {
-                'model': model_name,
-                'input': _openai_messages_to_responses_input(non_system_messages),
-                'stream': is_streaming_request
-            }
-
-            if instructions:
-                openai_request['instructions'] = instructions
-
-            # Temperature is best-effort. Unity omits it when unsupported.
-            if request_data.get('temperature') is not None:
-                openai_request['temperature'] = request_data.get('temperature')
-
-            # Use max_output_tokens for Responses API (fallback to other fields for backward compatibility).
-            max_output_tokens = (
-                request_data.get('max_output_tokens') or
-                request_data.get('max_completion_tokens') or
-                request_data.get('max_tokens') or
-                2000
-            )
-            openai_request['max_output_tokens'] = max_output_tokens
-
-            # Structured output (agent mode): Responses API doesn't support response_format.
-            # The Unity client may send it for compatibility, but we skip it for Responses API.
-            # If needed in the future, OpenAI may add support via text.format or output fields.
-            # For now, we rely on instructions to request JSON format.
-
-            # Optional reasoning controls (best-effort).
-            reasoning_effort = request_data.get('reasoning_effort')
-            if isinstance(reasoning_effort, str) and reasoning_effort.strip():
-                openai_request['reasoning'] = {'effort': reasoning_effort.strip()}
-            
-            api_request = openai_request
-            req_data_json = json.dumps(api_request)
-            req_data = req_data_json.encode('utf-8')
-            
-            # OpenAI uses Authorization: Bearer header
-            request_headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json',
-                'User-Agent': 'AiEditorAgent/1.0 (AWS Lambda)'
-            }
-            
+            api_request = _build_openai_request(request_data, model_name, upstream_streaming, structured_format,
+                                                headers, api_key, previous_response_id)
+        req_data_json = json.dumps(api_request)
+        req_data = req_data_json.encode('utf-8')
+        request_headers = _provider_request_headers(provider, api_key)
+        if DEBUG_DIAGNOSTICS:
             _log_request_summary(provider, api_request, is_streaming_request)
         
-        # Calculate total request size for logging
-        print(f"[Lambda] Request size: {len(req_data)} bytes, JSON length: {len(req_data_json)} chars")
-        
-        # Log user message size if present
-        _log_user_message_sizes(provider, api_request)
-        
-        # Create HTTP request
-        req = urllib.request.Request(
-            api_url,
-            data=req_data,
-            headers=request_headers
-        )
+        telemetry.update({'provider': provider, 'model': model_name, 'stream': bool(is_streaming_request),
+                          'request_bytes': len(req_data)})
+        if structured:
+            telemetry['structured_output'] = structured_format['type']
+        phase_started = _phase_done(telemetry, 'translate', phase_started)
+
+        if DEBUG_DIAGNOSTICS:
+            # Calculate total request size for logging
+            _debug_log(f"[Lambda] Request size: {len(req_data)} bytes, JSON length: {len(req_data_json)} chars")
+            
+            # Log user message size if present
+            _log_user_message_sizes(provider, api_request)
+
+        stream_format = _stream_format(headers, request_data) if is_streaming_request else 'raw'
+        if stream_format != 'raw':
+            telemetry['stream_format'] = stream_format
+
+        # Buffered streams can be coalesced into a few merged events (nothing to gain when passing through)
+        coalesce_mode = _coalesce_mode(headers, request_data) if is_streaming_request and not streaming_passthrough else None
+        if coalesce_mode:
+            telemetry['coalesce'] = coalesce_mode
+
+        # Opt-in projection of non-streaming bodies down to the fields the client reads
+        response_fields = None
+        if not is_streaming_request:
+            response_fields, fields_error = _response_fields(headers, request_data)
+            if fields_error:
+                return _json_response(400, {'error': fields_error, 'error_type': 'invalid_response_fields'})
+
+        # Opt-in response cache (non-streaming only; bypassed for sampled requests unless forced)
+        cache_key = None
+        cache_status = None
+        prompt_cache_usage: Dict[str, int] = {}
+        cache_mode = _response_cache_mode(headers, request_data)
+        if cache_mode and not is_streaming_request and not session:
+            if cache_mode == 'force' or _is_deterministic_request(api_request):
+                cache_key = _response_cache_key(api_url, api_key, api_request)
+                cached_body, cache_tier = _response_cache_get(cache_key)
+                if cached_body is not None:
+                    telemetry['cache'] = f'HIT-{cache_tier.upper()}'
+                    _debug_log(f"[Lambda] Response cache hit ({cache_tier}): {cache_key[:12]}")
+                    cache_hit_headers = {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Expose-Headers': 'X-Proxy-Cache',
+                        'X-Proxy-Cache': f'HIT-{cache_tier.upper()}'
+                    }
+                    # The cache holds full provider bodies; projection is applied per request
+                    if response_fields:
+                        cached_body = json.dumps(_project_response(provider, json.loads(cached_body), response_fields), ensure_ascii=False)
+                        cache_hit_headers['X-Proxy-Response-Fields'] = ','.join(response_fields)
+                    return {
+                        'statusCode': 200,
+                        'headers': cache_hit_headers,
+                        'body': cached_body,
+                        'isBase64Encoded': False
+                    }
+                cache_status = 'MISS'
+            else:
+                cache_status = 'BYPASS'
+            telemetry['cache'] = cache_status
+            phase_started = _phase_done(telemetry, 'cache', phase_started)
         
+        # Admission control: wait (fairly, bounded) for rate limit budget instead of bursting into provider 429s
+        rate_limit_rates = _rate_limit_rates()
+        if rate_limit_rates:
+            admission_key = _blob_namespace(api_key)
+            max_wait = ADMISSION_MAX_WAIT_SECONDS
+            if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+                max_wait = max(0.0, min(max_wait, context.get_remaining_time_in_millis() / 1000.0 - TIMEOUT_MIN_SECONDS))
+            costs = {'requests': 1.0, 'tokens': float(estimated_input_tokens + requested_output_tokens)}
+            admitted, waited, retry_after = _admission_queue.admit(
+                get_rate_limit_backend(), admission_key, _admission_client(event, headers), costs, rate_limit_rates, max_wait)
+            if waited:
+                telemetry['admission_wait_ms'] = round(waited * 1000, 1)
+            phase_started = _phase_done(telemetry, 'admission', phase_started)
+            if not admitted:
+                telemetry['admission'] = 'rejected'
+                return _rate_limited_response(retry_after)
+
         # Check if streaming is enabled
         is_streaming = is_streaming_request
         
@@ -414,68 +4744,157 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     has_file_content = True
                     break
         
-        # Use longer timeout for non-streaming requests with file content
-        # APIs can take longer to process large requests
-        # GPT-5 models are slower and need more time
-        if is_streaming:
-            timeout_seconds = 290  # Streaming requests get longer timeout
-        else:
-            # GPT-5 models need more time (they're slower)
-            is_gpt5_model = model_name.startswith('gpt-5')
-            if has_file_content:
-                timeout_seconds = 180  # 3 minutes for file editing requests
-                print(f"[Lambda] Detected file content in request, using extended timeout: {timeout_seconds}s")
-            elif is_gpt5_model:
-                timeout_seconds = 120  # 2 minutes for GPT-5 (slower model)
-                print(f"[Lambda] GPT-5 model detected, using extended timeout: {timeout_seconds}s")
-            else:
-                timeout_seconds = 90  # 90 seconds default for other models
-        print(f"[Lambda] Calling {provider} API with timeout: {timeout_seconds}s, streaming: {is_streaming}")
-        print(f"[Lambda] Request URL: {api_url}")
-        # Log headers but mask API key for security
-        safe_headers = {}
-        for k, v in req.headers.items():
-            if k.lower() == 'authorization' or k.lower() == 'x-api-key':
-                safe_headers[k] = v[:10] + '...' if len(v) > 10 else '...'
-            else:
-                safe_headers[k] = v
-        print(f"[Lambda] Request headers: {safe_headers}")
+        # Timeouts: catalog defaults until enough latencies are observed for this model,
+        # then derived from the observed p99. Never past the remaining Lambda time.
+        timeout_seconds, timeout_source = _select_timeout(model_name, upstream_streaming, has_file_content)
+        timeout_seconds = int(timeout_seconds)
+        _debug_log(f"[Lambda] Using {timeout_source} timeout for {model_name}: {timeout_seconds}s")
+        deadline = None
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - LAMBDA_DEADLINE_MARGIN_SECONDS
+            timeout_seconds = max(1, min(timeout_seconds, int(deadline - time.monotonic())))
+        if max_timeout_seconds is not None and timeout_seconds > max_timeout_seconds:
+            timeout_seconds = max(1, int(max_timeout_seconds))
+        _debug_log(f"[Lambda] Calling {provider} API with timeout: {timeout_seconds}s, streaming: {is_streaming}")
+        _debug_log(f"[Lambda] Request URL: {api_url}")
+        if DEBUG_DIAGNOSTICS:
+            # Log headers but mask API key for security
+            safe_headers = {}
+            for k, v in request_headers.items():
+                if k.lower() == 'authorization' or k.lower() == 'x-api-key':
+                    safe_headers[k] = v[:10] + '...' if len(v) > 10 else '...'
+                else:
+                    safe_headers[k] = v
+            _debug_log(f"[Lambda] Request headers: {safe_headers}")
         
+        upstream_started = time.monotonic()
+        latency_kind = _latency_kind(upstream_streaming, has_file_content)
+        # Streams passed through to the caller may be opened (and read) by its own opener
+        urlopen = getattr(_upstream_local, 'opener', None) if is_streaming and streaming_passthrough else None
         try:
-            response = urllib.request.urlopen(req, timeout=timeout_seconds)
+            try:
+                response = _urlopen_with_retries(api_url, req_data, request_headers, timeout_seconds, deadline, telemetry,
+                                                 urlopen=urlopen)
+            except urllib.error.HTTPError as e:
+                if not previous_response_id or e.code not in (400, 404):
+                    raise
+                error_body = e.read()
+                if b'previous_response' not in error_body:
+                    raise urllib.error.HTTPError(e.filename, e.code, e.reason, e.headers, io.BytesIO(error_body))
+                # The provider no longer has the previous response: resend the stored history instead
+                _log("[Lambda] WARNING: previous_response_id was rejected; resending the session history")
+                fallback = {'system': request_data.get('system'), 'messages': list(session['messages'])}
+                _fit_context_budget(fallback, token_family, context_budget)
+                fallback_request = {k: v for k, v in api_request.items() if k != 'previous_response_id'}
+                fallback_request['input'] = _openai_messages_to_responses_input(fallback['messages'])
+                req_data = json.dumps(fallback_request).encode('utf-8')
+                telemetry['session'] = 'replayed'
+                response = _urlopen_with_retries(api_url, req_data, request_headers, timeout_seconds, deadline, telemetry,
+                                                 urlopen=urlopen)
         except Exception as req_e:
-            print(f"[Lambda] ERROR during urlopen: {type(req_e).__name__}: {str(req_e)}")
+            _log(f"[Lambda] ERROR during urlopen: {type(req_e).__name__}: {str(req_e)}")
             raise
-        
+        phase_started = time.perf_counter()
+
+        # RESPONSE_STREAM mode: hand the open upstream response to a generator body.
+        # The generator closes the response once the client has consumed the stream.
+        if upstream_streaming:
+            _record_latency(model_name, latency_kind, time.monotonic() - upstream_started)
+
+        if is_streaming and streaming_passthrough:
+            _debug_log(f"[Lambda] Response status: {response.status}, streaming passthrough enabled")
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'text/event-stream',
+                    'Access-Control-Allow-Origin': '*',
+                    'Cache-Control': 'no-cache',
+                    'Connection': 'keep-alive',
+                    'X-Proxy-Stream-Format': stream_format,
+                    'X-Proxy-Estimated-Input-Tokens': str(estimated_input_tokens),
+                    **({'X-Proxy-Session': telemetry['session']} if session else {})
+                },
+                'body': (_astream_upstream_response if hasattr(response, '__aiter__') else _stream_upstream_response)(
+                    response, provider, stream_format, structured, telemetry, session=session),
+                'isBase64Encoded': False
+            }
+
         with response:
             # Log response status and headers
-            print(f"[Lambda] Response status: {response.status}, reason: {response.reason}")
-            print(f"[Lambda] Response headers: {dict(response.headers)}")
+            _debug_log(f"[Lambda] Response status: {response.status}, reason: {response.reason}")
+            _debug_log(f"[Lambda] Response headers: {dict(response.headers)}")
             
-            response_body = response.read().decode('utf-8')
+            if is_streaming and (structured or coalesce_mode or session):
+                response_body = b''.join(_stream_upstream_response(
+                    response, provider, stream_format, structured, telemetry, coalesce_mode, session)).decode('utf-8')
+            elif is_streaming and stream_format == 'compact':
+                response_body = b''.join(_iter_compact_events(_iter_sse_events(_iter_upstream_chunks(response)), provider)).decode('utf-8')
+            elif upstream_streaming and not is_streaming:
+                response_body = _collect_structured_stream(response, provider, structured)
+            else:
+                # Fixed-size chunked reads into one owned copy; large non-streaming bodies stay spilled in /tmp
+                body_buffer = _read_upstream_body(response)
+                response_body = None if body_buffer.spilled and not is_streaming else body_buffer.decode()
+            if not upstream_streaming:
+                _record_latency(model_name, latency_kind, time.monotonic() - upstream_started)
+            phase_started = _phase_done(telemetry, 'transfer', phase_started)
             
             # Log response size for debugging (only for non-streaming to avoid log spam)
+            parsed_body = None
             if not is_streaming:
-                print(f"[Lambda] Non-streaming response received: {len(response_body)} bytes")
-                # Validate response is valid JSON for non-streaming
-                try:
-                    json.loads(response_body)
-                    print("[Lambda] Response is valid JSON")
-                except json.JSONDecodeError as je:
-                    print(f"[Lambda] ERROR: Response is not valid JSON: {str(je)}")
-                    # Return error instead of invalid response
-                    return {
-                        'statusCode': 502,
-                        'headers': {
-                            'Content-Type': 'application/json',
-                            'Access-Control-Allow-Origin': '*'
-                        },
-                        'body': json.dumps({
+                if response_body is None and (response_fields or structured or session):
+                    # Projection, structured output validation and sessions need the parsed body
+                    response_body = body_buffer.decode()
+                if response_body is None:
+                    # Spilled: don't materialize a parsed copy; check the framing and read usage from the tail
+                    telemetry['spilled_bytes'] = body_buffer.size
+                    _debug_log(f"[Lambda] Non-streaming response received: {body_buffer.size} bytes (spilled to disk)")
+                    if not body_buffer.head(64).lstrip().startswith(b'{') or not body_buffer.tail(64).rstrip().endswith(b'}'):
+                        _log("[Lambda] ERROR: Response is not valid JSON: body is not a JSON object")
+                        preview = body_buffer.head(500).decode('utf-8', errors='replace')
+                        body_buffer.close()
+                        return _json_response(502, {
+                            'error': f'{provider} API returned invalid JSON response',
+                            'error_details': 'Response body is not a JSON object',
+                            'response_preview': preview
+                        })
+                    usage = _usage_from_tail(body_buffer.tail(_USAGE_TAIL_BYTES))
+                else:
+                    _debug_log(f"[Lambda] Non-streaming response received: {len(response_body)} bytes")
+                    # Validate response is valid JSON for non-streaming
+                    try:
+                        parsed_body = json.loads(response_body)
+                    except json.JSONDecodeError as je:
+                        _log(f"[Lambda] ERROR: Response is not valid JSON: {str(je)}")
+                        # Return error instead of invalid response
+                        return _json_response(502, {
                             'error': f'{provider} API returned invalid JSON response',
                             'error_details': str(je),
                             'response_preview': response_body[:500]
                         })
-                    }
+                    _debug_log("[Lambda] Response is valid JSON")
+                    usage = parsed_body.get('usage') if isinstance(parsed_body, dict) else None
+                prompt_cache_usage = _prompt_cache_usage(provider, usage)
+                actual_input_tokens = _actual_input_tokens(provider, usage)
+                if actual_input_tokens is not None:
+                    telemetry['input_tokens'] = actual_input_tokens
+                if isinstance(usage, dict) and isinstance(usage.get('output_tokens'), int):
+                    telemetry['output_tokens'] = usage['output_tokens']
+                    _record_token_calibration(token_family, estimated_input_tokens, actual_input_tokens)
+                if structured and not upstream_streaming and isinstance(parsed_body, dict):
+                    # Plain non-streaming call (early abort off): same rewrite and validation, after the fact
+                    if structured['tool_name']:
+                        parsed_body = _anthropic_tool_output_to_text(parsed_body, structured['tool_name'])
+                        response_body = json.dumps(parsed_body)
+                    validator = _structured_output_validator(structured)
+                    if validator:
+                        validator.feed(_response_output_text(provider, parsed_body))
+                        validator.finish()
+                if session and isinstance(parsed_body, dict):
+                    _save_session(session, _response_output_text(provider, parsed_body),
+                                  parsed_body.get('id') if provider == 'OpenAI' else None)
+                if not response_fields:
+                    parsed_body = None  # Only the body text is returned; drop the parsed copy before building the result
             
             # Set appropriate Content-Type based on streaming mode
             if is_streaming:
@@ -485,8 +4904,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Content-Type': content_type,
                     'Access-Control-Allow-Origin': '*',
                     'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive'
+                    'Connection': 'keep-alive',
+                    'X-Proxy-Stream-Format': stream_format,
+                    'X-Proxy-Estimated-Input-Tokens': str(estimated_input_tokens)
                 }
+                if coalesce_mode:
+                    response_headers['X-Proxy-Coalesce'] = coalesce_mode
+                if session:
+                    response_headers['X-Proxy-Session'] = telemetry['session']
             else:
                 content_type = 'application/json'
                 # Headers for non-streaming response (no Connection header)
@@ -494,88 +4919,67 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Content-Type': content_type,
                     'Access-Control-Allow-Origin': '*'
                 }
+                if cache_status:
+                    response_headers['Access-Control-Expose-Headers'] = 'X-Proxy-Cache'
+                    response_headers['X-Proxy-Cache'] = cache_status
+                if cache_key and response_body is not None:
+                    _response_cache_put(cache_key, response_body)
+                if response_fields and isinstance(parsed_body, dict):
+                    projected_body = json.dumps(_project_response(provider, parsed_body, response_fields), ensure_ascii=False)
+                    telemetry['projected_bytes_saved'] = len(response_body) - len(projected_body)
+                    response_body = projected_body
+                    response_headers['X-Proxy-Response-Fields'] = ','.join(response_fields)
+                response_headers['X-Proxy-Estimated-Input-Tokens'] = str(estimated_input_tokens)
+                if session:
+                    response_headers['X-Proxy-Session'] = telemetry['session']
+                if 'input_tokens' in telemetry:
+                    response_headers['X-Proxy-Input-Tokens'] = str(telemetry['input_tokens'])
+                if dropped_messages or compacted_messages:
+                    response_headers['X-Proxy-Context-Trimmed'] = f'dropped={dropped_messages}; compacted={compacted_messages}'
+                if prompt_cache_usage:
+                    telemetry.update(prompt_cache_usage)
+                    response_headers['X-Proxy-Prompt-Cache-Read-Tokens'] = str(prompt_cache_usage['cache_read_tokens'])
+                    response_headers['X-Proxy-Prompt-Cache-Write-Tokens'] = str(prompt_cache_usage['cache_write_tokens'])
             
-            # Return response with appropriate Content-Type
-            print(f"[Lambda] Preparing response - Content-Type: {response_headers['Content-Type']}, Body length: {len(response_body)}")
-            
-            # Ensure response_body is a string (not bytes)
-            if isinstance(response_body, bytes):
-                response_body = response_body.decode('utf-8')
-            elif not isinstance(response_body, str):
-                response_body = str(response_body)
-            
-            # Validate response format for API Gateway
-            # API Gateway requires headers to be strings (not bytes) and body to be a string
-            # Ensure all header values are strings
-            validated_headers = {}
-            for key, value in response_headers.items():
-                if isinstance(value, bytes):
-                    validated_headers[key] = value.decode('utf-8')
-                elif not isinstance(value, str):
-                    validated_headers[key] = str(value)
-                else:
-                    validated_headers[key] = value
-            
-            # Ensure body is a string and doesn't contain problematic characters
-            if isinstance(response_body, bytes):
-                validated_body = response_body.decode('utf-8')
-            elif not isinstance(response_body, str):
-                validated_body = str(response_body)
+            if response_body is None:
+                # Spilled body: RESPONSE_STREAM sends it from the file in chunks; buffered mode needs the one str copy
+                response_body = body_buffer.iter_chunks() if streaming_passthrough else body_buffer.decode()
+                body_length = body_buffer.size
             else:
-                validated_body = response_body
-            
-            # Validate JSON format if it's supposed to be JSON
-            if not is_streaming:
-                try:
-                    # Validate it's valid JSON by parsing it
-                    json.loads(validated_body)
-                    print("[Lambda] Response body is valid JSON")
-                except json.JSONDecodeError as je:
-                    print(f"[Lambda] WARNING: Response body is not valid JSON: {str(je)}")
-                    # Don't fail here, just log - maybe API returned non-JSON for some reason
+                body_length = len(response_body)
+
+            # Return response with appropriate Content-Type
+            _debug_log(f"[Lambda] Preparing response - Content-Type: {response_headers['Content-Type']}, Body length: {body_length}")
             
             result = {
                 'statusCode': 200,
-                'headers': validated_headers,
-                'body': validated_body,
+                'headers': response_headers,
+                'body': response_body,
                 'isBase64Encoded': False
             }
+
+            if DEBUG_DIAGNOSTICS and isinstance(response_body, str):
+                _debug_validate_result(result, is_streaming)
+
+            # API Gateway rejects bodies over 10MB
+            if body_length > 10 * 1024 * 1024:  # 10MB
+                _log(f"[Lambda] WARNING: Response body is very large: {body_length} bytes")
             
-            # Validate all required fields are present and correct types
-            if not isinstance(result['statusCode'], int):
-                raise ValueError(f"statusCode must be int, got {type(result['statusCode'])}")
-            if not isinstance(result['headers'], dict):
-                raise ValueError(f"headers must be dict, got {type(result['headers'])}")
-            if not isinstance(result['body'], str):
-                raise ValueError(f"body must be str, got {type(result['body'])}")
-            
-            # Additional validation: ensure headers dict values are all strings
-            for key, value in result['headers'].items():
-                if not isinstance(value, str):
-                    raise ValueError(f"Header '{key}' value must be str, got {type(value)}")
-            
-            print(f"[Lambda] Returning response with statusCode: {result['statusCode']}, body type: {type(result['body'])}, body length: {len(result['body'])}")
-            print(f"[Lambda] Response headers: {list(result['headers'].keys())}")
-            
-            # Try to serialize the response to ensure it's valid for API Gateway
-            try:
-                json.dumps(result, default=str)
-                print("[Lambda] Response serializes correctly")
-            except Exception as ser_e:
-                print(f"[Lambda] WARNING: Response serialization test failed: {str(ser_e)}")
-                # Continue anyway - API Gateway might handle it differently
-            
-            # Final check: ensure body doesn't exceed API Gateway limits (10MB)
-            # But more importantly, ensure it's a valid string
-            if len(result['body']) > 10 * 1024 * 1024:  # 10MB
-                print(f"[Lambda] WARNING: Response body is very large: {len(result['body'])} bytes")
-            
-            # Log first 200 chars of body for debugging
-            body_preview = result['body'][:200] if len(result['body']) > 200 else result['body']
-            print(f"[Lambda] Response body preview: {body_preview}")
-            
+            _phase_done(telemetry, 'serialize', phase_started)
             return result
+    except StructuredOutputError as e:
+        # Raised while the response was still being generated (or on the final body); the upstream is closed
+        _log(f"[Lambda] WARNING: Structured output from {provider} rejected: {str(e)}")
+        telemetry.update({'error_type': 'StructuredOutputError', 'structured_output': 'invalid'})
+        return _json_response(502, {
+            'error': str(e),
+            'error_type': 'invalid_json',
+            'position': e.position,
+            'output_preview': e.preview
+        })
     except urllib.error.HTTPError as e:
+        telemetry['error_type'] = 'HTTPError'
+        telemetry['upstream_status'] = e.code
         try:
             error_body_raw = e.read().decode('utf-8')
         except:
@@ -597,8 +5001,8 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         if is_html_response:
             # Extract meaningful error info from HTML or provide generic message
-            print(f"[Lambda] Received HTML error response (likely Cloudflare): HTTP {e.code}")
-            print(f"[Lambda] HTML preview: {error_body_raw[:500]}")
+            _log(f"[Lambda] Received HTML error response (likely Cloudflare): HTTP {e.code}")
+            _debug_log(f"[Lambda] HTML preview: {error_body_raw[:500]}")
             
             # Try to extract error message from HTML
             error_message = f'Gateway error (HTTP {e.code})'
@@ -630,20 +5034,32 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'response_body': error_body_raw[:1000] if len(error_body_raw) > 1000 else error_body_raw
                 })
         
+        error_headers = {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        }
+        # Pass the provider's back-off hint through so the client doesn't retry blindly
+        retry_after = _retry_after_seconds(e.headers)
+        if e.code == 429 and admission_key is not None:
+            # Queue this key's next requests locally instead of letting them hit the provider's limit too
+            get_rate_limit_backend().block(admission_key, retry_after if retry_after is not None else 1.0)
+        if retry_after is not None:
+            error_headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
         return {
             'statusCode': 502 if e.code >= 500 else e.code,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
+            'headers': error_headers,
             'body': error_body,
             'isBase64Encoded': False
         }
     except urllib.error.URLError as e:
+        telemetry['error_type'] = type(e).__name__
         import traceback
         error_msg = str(e)
         # Check if it's a timeout error
         if 'timed out' in error_msg.lower() or 'timeout' in error_msg.lower():
+            if latency_kind:
+                # A timeout is a latency sample of at least timeout_seconds; leaving it out would hide slow replies
+                _record_latency(model_name, latency_kind, timeout_seconds)
             error_details = {
                 'error': f'Request timed out after {timeout_seconds}s. The request may be too large or {provider} API is taking longer than expected.',
                 'error_type': type(e).__name__,
@@ -656,13 +5072,13 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'error_type': type(e).__name__,
                 'traceback': traceback.format_exc()
             }
-        print(f"[Lambda] URLError: {error_details}")
+        _log(f"[Lambda] URLError: {error_details}")
         
         # Ensure error body is a valid JSON string
         try:
             error_body_str = json.dumps(error_details)
         except Exception as json_err:
-            print(f"[Lambda] Failed to serialize error details: {str(json_err)}")
+            _log(f"[Lambda] Failed to serialize error details: {str(json_err)}")
             error_body_str = json.dumps({
                 'error': f'Network error: {error_msg}',
                 'error_type': type(e).__name__
@@ -678,10 +5094,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     except Exception as e:
+        telemetry['error_type'] = type(e).__name__
+        if latency_kind and 'timed out' in str(e).lower():
+            # Read timeouts while receiving the body (socket.timeout) are latency samples too
+            _record_latency(model_name, latency_kind, timeout_seconds)
         import traceback
         error_traceback = traceback.format_exc()
-        print(f"[Lambda] EXCEPTION: {type(e).__name__}: {str(e)}")
-        print(f"[Lambda] TRACEBACK:\n{error_traceback}")
+        _log(f"[Lambda] EXCEPTION: {type(e).__name__}: {str(e)}")
+        _log(f"[Lambda] TRACEBACK:\n{error_traceback}")
         
         error_details = {
             'error': f'Proxy error: {str(e)}',
@@ -694,7 +5114,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         try:
             error_body_str = json.dumps(error_details)
         except Exception as json_err:
-            print(f"[Lambda] Failed to serialize error details: {str(json_err)}")
+            _log(f"[Lambda] Failed to serialize error details: {str(json_err)}")
             error_body_str = json.dumps({
                 'error': f'Proxy error: {str(e)}',
                 'error_type': type(e).__name__
@@ -721,6 +5141,17 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if not isinstance(error_response['body'], str):
             error_response['body'] = json.dumps({'error': 'Unknown error occurred'})
         
-        print(f"[Lambda] Returning error response: {error_response['statusCode']}")
+        _debug_log(f"[Lambda] Returning error response: {error_response['statusCode']}")
         return error_response
 
+# Lambda's init phase runs at full CPU: build the TLS context (CA bundle load) here instead of on the
+# first request, and optionally open the provider connections too (useful with provisioned concurrency).
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    _get_ssl_context()
+    if WARMUP_ON_INIT:
+        warm_upstream_connections()
+
+INIT_DURATION_MS = round((time.perf_counter() - _MODULE_LOAD_STARTED) * 1000, 1)
+
+if __name__ == '__main__':
+    run_streaming_runtime()
@@ -0,0 +1,630 @@
+"""
+Local stand-in for the OpenAI Responses and Anthropic Messages APIs.
+
+Serves POST /v1/responses and POST /v1/messages with configurable latency, time-to-first-byte,
+SSE chunk cadence, payload sizes and error injection, so the proxy can be exercised and
+benchmarked without calling real providers:
+
+    python provider_stub.py --port 8787 --ttfb-ms 300 --chunk-interval-ms 20
+    PROXY_OPENAI_API_BASE=http://127.0.0.1:8787 PROXY_ANTHROPIC_API_BASE=http://127.0.0.1:8787 ...
+
+OpenAI responses are remembered so requests can chain onto them with previous_response_id
+(unknown ids get the API's 400 previous_response_not_found error).
+The OpenAI Batch (/v1/files, /v1/batches) and Anthropic Message Batches (/v1/messages/batches)
+endpoints are served too; a batch ends batch_delay_ms after it was created.
+POST /v1/embeddings returns deterministic hashed bag-of-words vectors, so texts sharing words are
+similar under cosine similarity.
+
+The configuration can be changed at runtime with POST /__stub/config (JSON object of the fields
+in DEFAULT_STUB_CONFIG); GET /__stub/stats returns request counters. A single request can override
+numeric fields with a '[[stub ttfb_ms=300 output_chars=2000]]' directive anywhere in its body
+(replay_traffic.py uses this to reproduce recorded upstream timing per request).
+Standard library only.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+
+DEFAULT_STUB_CONFIG: Dict[str, Any] = {
+    # Non-streaming: total time before the response is sent
+    'latency_ms': 0,
+    # Streaming: time before the first SSE event, then one text delta every chunk_interval_ms
+    'ttfb_ms': 0,
+    'chunk_interval_ms': 0,
+    # Size of the generated output text; split into output_chars / chunk_chars deltas when streaming
+    'output_chars': 400,
+    'chunk_chars': 16,
+    # Fixed output text instead of generated filler (e.g. a JSON document for structured output runs).
+    # Anthropic requests with a forced tool_choice get it back as the tool's input (input_json_delta when streaming).
+    'output_text': '',
+    # Fraction of requests answered with error_status (429 responses carry Retry-After: retry_after_seconds)
+    'error_rate': 0.0,
+    'error_status': 500,
+    'retry_after_seconds': 1,
+    # Streaming: close the connection after this many deltas (0 = never) to simulate a dropped stream
+    'drop_after_chunks': 0,
+    # Streaming: SSE events written per HTTP chunk (one network read then carries several events)
+    'events_per_chunk': 1,
+    # Batch APIs: time from batch creation until it has ended and its results are available
+    'batch_delay_ms': 0
+}
+
+_LOREM = ('The quick brown fox jumps over the lazy dog while the compiler rebuilds the scene graph. ')
+
+def _output_text(length: int) -> str:
+    return (_LOREM * (length // len(_LOREM) + 1))[:length]
+
+def _estimated_input_tokens(body: bytes) -> int:
+    return max(1, len(body) // 4)
+
+def _openai_response(model: str, text: str, input_tokens: int, response_id: Optional[str] = None,
+                     incomplete: bool = False) -> Dict[str, Any]:
+    return {
+        'id': response_id or f'resp_{uuid.uuid4().hex}',
+        'object': 'response',
+        'created_at': int(time.time()),
+        'status': 'incomplete' if incomplete else 'completed',
+        'incomplete_details': {'reason': 'max_output_tokens'} if incomplete else None,
+        'model': model,
+        'output': [{
+            'id': f'msg_{uuid.uuid4().hex}',
+            'type': 'message',
+            'role': 'assistant',
+            'status': 'completed',
+            'content': [{'type': 'output_text', 'text': text, 'annotations': []}]
+        }],
+        'usage': {
+            'input_tokens': input_tokens,
+            'input_tokens_details': {'cached_tokens': 0},
+            'output_tokens': len(text) // 4,
+            'total_tokens': input_tokens + len(text) // 4
+        }
+    }
+
+def _forced_tool_name(request: Dict[str, Any]) -> Optional[str]:
+    tool_choice = request.get('tool_choice')
+    return tool_choice.get('name') if isinstance(tool_choice, dict) and tool_choice.get('type') == 'tool' else None
+
+def _tool_input(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {'output': text}
+
+def _anthropic_message(model: str, text: str, input_tokens: int, tool_name: Optional[str] = None) -> Dict[str, Any]:
+    if tool_name:
+        content = [{'type': 'tool_use', 'id': f'toolu_{uuid.uuid4().hex}', 'name': tool_name, 'input': _tool_input(text)}]
+    else:
+        content = [{'type': 'text', 'text': text}]
+    return {
+        'id': f'msg_{uuid.uuid4().hex}',
+        'type': 'message',
+        'role': 'assistant',
+        'model': model,
+        'content': content,
+        'stop_reason': 'tool_use' if tool_name else 'end_turn',
+        'stop_sequence': None,
+        'usage': {
+            'input_tokens': input_tokens,
+            'cache_read_input_tokens': 0,
+            'cache_creation_input_tokens': 0,
+            'output_tokens': len(text) // 4
+        }
+    }
+
+def _sse(event: str, data: Dict[str, Any]) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+def _openai_stream_events(model: str, deltas: List[str], input_tokens: int, response_id: Optional[str] = None,
+                          incomplete: bool = False) -> List[bytes]:
+    response = _openai_response(model, ''.join(deltas), input_tokens, response_id, incomplete)
+    in_progress = dict(response, status='in_progress', incomplete_details=None, output=[], usage=None)
+    events = [_sse('response.created', {'type': 'response.created', 'response': in_progress})]
+    for delta in deltas:
+        events.append(_sse('response.output_text.delta', {
+            'type': 'response.output_text.delta', 'item_id': response['output'][0]['id'],
+            'output_index': 0, 'content_index': 0, 'delta': delta
+        }))
+    final_event = 'response.incomplete' if incomplete else 'response.completed'
+    events.append(_sse(final_event, {'type': final_event, 'response': response}))
+    return events
+
+def _anthropic_stream_events(model: str, deltas: List[str], input_tokens: int, tool_name: Optional[str] = None) -> List[bytes]:
+    message = _anthropic_message(model, '', input_tokens)
+    message['content'] = []
+    message['stop_reason'] = None
+    if tool_name:
+        content_block = {'type': 'tool_use', 'id': f'toolu_{uuid.uuid4().hex}', 'name': tool_name, 'input': {}}
+    else:
+        content_block = {'type': 'text', 'text': ''}
+    events = [
+        _sse('message_start', {'type': 'message_start', 'message': message}),
+        _sse('content_block_start', {'type': 'content_block_start', 'index': 0, 'content_block': content_block})
+    ]
+    for delta in deltas:
+        delta_body = {'type': 'input_json_delta', 'partial_json': delta} if tool_name else {'type': 'text_delta', 'text': delta}
+        events.append(_sse('content_block_delta', {'type': 'content_block_delta', 'index': 0, 'delta': delta_body}))
+    events.append(_sse('content_block_stop', {'type': 'content_block_stop', 'index': 0}))
+    events.append(_sse('message_delta', {
+        'type': 'message_delta', 'delta': {'stop_reason': 'tool_use' if tool_name else 'end_turn', 'stop_sequence': None},
+        'usage': {'output_tokens': sum(len(d) for d in deltas) // 4}
+    }))
+    events.append(_sse('message_stop', {'type': 'message_stop'}))
+    return events
+
+def _multipart_file(body: bytes, content_type: str) -> Optional[bytes]:
+    """Content of the 'file' field of a multipart/form-data body."""
+    boundary = content_type.partition('boundary=')[2].strip().strip('"').encode('utf-8')
+    if not boundary:
+        return None
+    for part in body.split(b'--' + boundary):
+        head, _, content = part.partition(b'\r\n\r\n')
+        if b'name="file"' in head:
+            return content[:-2] if content.endswith(b'\r\n') else content
+    return None
+
+def _batch_results(batch: Dict[str, Any], config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One result line per request of an ended batch (error_rate applies per request)."""
+    text = config['output_text'] or _output_text(int(config['output_chars']))
+    lines = []
+    for custom_id, body in batch['requests']:
+        model = body.get('model') or 'stub-model'
+        input_tokens = _estimated_input_tokens(json.dumps(body).encode('utf-8'))
+        failed = config['error_rate'] > 0 and random.random() < config['error_rate']
+        if batch['provider'] == 'anthropic':
+            if batch['cancelled']:
+                result = {'type': 'canceled'}
+            elif failed:
+                result = {'type': 'errored', 'error': _error_body('anthropic', int(config['error_status']))}
+            else:
+                result = {'type': 'succeeded', 'message': _anthropic_message(model, text, input_tokens, _forced_tool_name(body))}
+            lines.append({'custom_id': custom_id, 'result': result})
+        elif failed:
+            lines.append({'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': custom_id, 'error': None, 'response': {
+                'status_code': int(config['error_status']), 'request_id': uuid.uuid4().hex,
+                'body': _error_body('openai', int(config['error_status']))}})
+        else:
+            lines.append({'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': custom_id, 'error': None, 'response': {
+                'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': _openai_response(model, text, input_tokens)}})
+    return lines
+
+def _embedding(text: str, dimensions: int) -> List[float]:
+    """Unit vector of hashed word counts (signed feature hashing)."""
+    vector = [0.0] * dimensions
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        digest = hashlib.sha256(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+_DIRECTIVE = re.compile(rb'\[\[stub ((?:[a-z_]+=[0-9.]+ ?)+)\]\]')
+
+def _directive_config(body: bytes) -> Dict[str, Any]:
+    """Per-request config overrides from a '[[stub name=value ...]]' directive in the request body."""
+    match = _DIRECTIVE.search(body)
+    if not match:
+        return {}
+    overrides: Dict[str, Any] = {}
+    for pair in match.group(1).decode('ascii').split():
+        name, _, value = pair.partition('=')
+        default = DEFAULT_STUB_CONFIG.get(name)
+        if isinstance(default, float):
+            overrides[name] = float(value)
+        elif isinstance(default, int):
+            overrides[name] = int(float(value))
+    return overrides
+
+def _error_body(provider: str, status: int) -> Dict[str, Any]:
+    if provider == 'anthropic':
+        error_type = {429: 'rate_limit_error', 529: 'overloaded_error'}.get(status, 'api_error')
+        return {'type': 'error', 'error': {'type': error_type, 'message': f'Injected stub error ({status})'}}
+    error_type = 'rate_limit_exceeded' if status == 429 else 'server_error'
+    return {'error': {'message': f'Injected stub error ({status})', 'type': error_type, 'code': error_type}}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; without TCP_NODELAY, delayed ACKs add ~40ms per request
+    disable_nagle_algorithm = True
+    server: 'ProviderStubServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: Dict[str, Any], extra_headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_bytes(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == '/__stub/stats':
+            self._send_json(200, self.server.stats_snapshot())
+            return
+        parts = self.path.strip('/').split('/')
+        if parts[:2] == ['v1', 'batches'] and len(parts) == 3:
+            batch = self.server.batch(parts[2], 'openai')
+            if batch is None:
+                self._send_json(404, _error_body('openai', 404))
+            else:
+                self._send_json(200, self.server.openai_batch_object(batch))
+        elif parts[:2] == ['v1', 'files'] and len(parts) == 4 and parts[3] == 'content':
+            content = self.server.file_content(parts[2])
+            if content is None:
+                self._send_json(404, _error_body('openai', 404))
+            else:
+                self._send_bytes(200, content, 'application/jsonl')
+        elif parts[:3] == ['v1', 'messages', 'batches'] and len(parts) in (4, 5):
+            batch = self.server.batch(parts[3], 'anthropic')
+            if batch is None or (len(parts) == 5 and (parts[4] != 'results' or not self.server.batch_ended(batch))):
+                self._send_json(404, _error_body('anthropic', 404))
+            elif len(parts) == 5:
+                lines = self.server.batch_results(batch)
+                self._send_bytes(200, b''.join(json.dumps(line).encode('utf-8') + b'\n' for line in lines), 'application/binary')
+            else:
+                self._send_json(200, self.server.anthropic_batch_object(batch, self.headers.get('Host') or ''))
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _handle_batch_post(self, body: bytes) -> bool:
+        """Batch API POSTs; returns False for anything else."""
+        parts = self.path.strip('/').split('/')
+        if parts == ['v1', 'files']:
+            content = _multipart_file(body, self.headers.get('Content-Type') or '')
+            if content is None:
+                self._send_json(400, _error_body('openai', 400))
+            else:
+                self._send_json(200, {'id': self.server.store_file(content), 'object': 'file', 'bytes': len(content),
+                                      'purpose': 'batch', 'filename': 'batch.jsonl'})
+        elif parts == ['v1', 'batches']:
+            request = json.loads(body or b'{}')
+            content = self.server.file_content(request.get('input_file_id') or '')
+            if content is None:
+                self._send_json(400, _error_body('openai', 400))
+                return True
+            requests = [(line['custom_id'], line['body']) for line in map(json.loads, content.splitlines()) if line]
+            self._send_json(200, self.server.openai_batch_object(self.server.create_batch('openai', requests)))
+        elif parts == ['v1', 'messages', 'batches']:
+            requests = [(r.get('custom_id'), r.get('params') or {}) for r in json.loads(body or b'{}').get('requests') or []]
+            if not requests or not all(isinstance(c, str) and re.match(r'^[a-zA-Z0-9_-]{1,64}$', c) for c, _ in requests):
+                self._send_json(400, _error_body('anthropic', 400))
+                return True
+            batch = self.server.create_batch('anthropic', requests)
+            self._send_json(200, self.server.anthropic_batch_object(batch, self.headers.get('Host') or ''))
+        elif len(parts) in (4, 5) and parts[-1] == 'cancel' and parts[:-2] in (['v1', 'batches'], ['v1', 'messages', 'batches']):
+            provider = 'openai' if parts[1] == 'batches' else 'anthropic'
+            batch = self.server.batch(parts[-2], provider)
+            if batch is None:
+                self._send_json(404, _error_body(provider, 404))
+                return True
+            self.server.cancel_batch(batch)
+            if provider == 'openai':
+                self._send_json(200, self.server.openai_batch_object(batch))
+            else:
+                self._send_json(200, self.server.anthropic_batch_object(batch, self.headers.get('Host') or ''))
+        else:
+            return False
+        return True
+
+    def _handle_embeddings(self, body: bytes) -> None:
+        started = time.perf_counter()
+        config = dict(self.server.config)
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        texts = request.get('input') if isinstance(request, dict) else None
+        texts = [texts] if isinstance(texts, str) else texts
+        if not isinstance(texts, list) or not texts or not all(isinstance(t, str) and t for t in texts):
+            self._send_json(400, _error_body('openai', 400))
+            self.server.record('openai', 400, time.perf_counter() - started)
+            return
+        time.sleep(config['latency_ms'] / 1000.0)
+        if config['error_rate'] > 0 and random.random() < config['error_rate']:
+            status = int(config['error_status'])
+            headers = {'Retry-After': str(config['retry_after_seconds'])} if status == 429 else None
+            self._send_json(status, _error_body('openai', status), headers)
+            self.server.record('openai', status, time.perf_counter() - started)
+            return
+        dimensions = int(request.get('dimensions') or 1536)
+        data = []
+        for index, text in enumerate(texts):
+            vector = _embedding(text, dimensions)
+            if request.get('encoding_format') == 'base64':
+                embedding: Any = base64.b64encode(struct.pack(f'<{dimensions}f', *vector)).decode('ascii')
+            else:
+                embedding = vector
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        self._send_json(200, {'object': 'list', 'data': data, 'model': request.get('model') or 'text-embedding-3-small',
+                              'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+        self.server.record('openai', 200, time.perf_counter() - started)
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/__stub/config':
+            try:
+                self.server.update_config(json.loads(body or b'{}'))
+            except (ValueError, TypeError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(200, self.server.config)
+            return
+        if self._handle_batch_post(body):
+            return
+        if self.path.endswith('/v1/embeddings'):
+            self._handle_embeddings(body)
+            return
+        if self.path.endswith('/v1/responses'):
+            provider = 'openai'
+        elif self.path.endswith('/v1/messages'):
+            provider = 'anthropic'
+        else:
+            self._send_json(404, {'error': f'Unknown path: {self.path}'})
+            return
+
+        started = time.perf_counter()
+        config = dict(self.server.config, **_directive_config(body))
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self._send_json(400, _error_body(provider, 400))
+            return
+        model = request.get('model') or 'stub-model'
+        input_tokens = _estimated_input_tokens(body)
+
+        # Responses are "stored" so later requests can chain onto them with previous_response_id
+        response_id = f'resp_{uuid.uuid4().hex}' if provider == 'openai' else None
+        previous_response_id = request.get('previous_response_id') if provider == 'openai' else None
+        if previous_response_id and not self.server.has_response(previous_response_id):
+            self._send_json(400, {'error': {
+                'message': f"Previous response with id '{previous_response_id}' not found.",
+                'type': 'invalid_request_error', 'param': 'previous_response_id', 'code': 'previous_response_not_found'
+            }})
+            self.server.record(provider, 400, time.perf_counter() - started)
+            return
+
+        if config['error_rate'] > 0 and random.random() < config['error_rate']:
+            status = int(config['error_status'])
+            headers = {'Retry-After': str(config['retry_after_seconds'])} if status == 429 else None
+            time.sleep(config['latency_ms'] / 1000.0)
+            self._send_json(status, _error_body(provider, status), headers)
+            self.server.record(provider, status, time.perf_counter() - started)
+            return
+
+        text = config['output_text'] or _output_text(int(config['output_chars']))
+        tool_name = _forced_tool_name(request) if provider == 'anthropic' else None
+        # OpenAI output past max_output_tokens (4 characters a token) is cut off and the response is incomplete
+        max_output_tokens = request.get('max_output_tokens') if provider == 'openai' else None
+        incomplete = isinstance(max_output_tokens, int) and len(text) > max_output_tokens * 4
+        if incomplete:
+            text = text[:max_output_tokens * 4]
+        if not request.get('stream'):
+            time.sleep(config['latency_ms'] / 1000.0)
+            if provider == 'openai':
+                self.server.store_response(response_id)
+                self._send_json(200, _openai_response(model, text, input_tokens, response_id, incomplete))
+            else:
+                self._send_json(200, _anthropic_message(model, text, input_tokens, tool_name))
+            self.server.record(provider, 200, time.perf_counter() - started)
+            return
+
+        chunk_chars = max(1, int(config['chunk_chars']))
+        deltas = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        if provider == 'openai':
+            self.server.store_response(response_id)
+            events = _openai_stream_events(model, deltas, input_tokens, response_id, incomplete)
+        else:
+            events = _anthropic_stream_events(model, deltas, input_tokens, tool_name)
+
+        time.sleep(config['ttfb_ms'] / 1000.0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        interval = config['chunk_interval_ms'] / 1000.0
+        drop_after = int(config['drop_after_chunks'])
+        events_per_chunk = max(1, int(config['events_per_chunk']))
+        pending = b''
+        # The first event(s) before the deltas go out immediately; deltas follow the configured cadence
+        lead_events = 1 if provider == 'openai' else 2
+        for index, event in enumerate(events):
+            delta_index = index - lead_events
+            if 0 < delta_index < len(deltas) and interval:
+                time.sleep(interval)
+            if drop_after and delta_index >= drop_after:
+                if pending:
+                    self._write_chunk(pending)
+                self.close_connection = True
+                self.server.record(provider, 0, time.perf_counter() - started)
+                return
+            pending += event
+            if (index + 1) % events_per_chunk == 0:
+                self._write_chunk(pending)
+                pending = b''
+        if pending:
+            self._write_chunk(pending)
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+        self.server.record(provider, 200, time.perf_counter() - started)
+
+class ProviderStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog (5) drops connections under replayed load; a dropped SYN costs a 1s retransmit
+    request_queue_size = 256
+
+    def __init__(self, address: Any, config: Optional[Dict[str, Any]] = None, verbose: bool = False):
+        super().__init__(address, StubHandler)
+        self.config: Dict[str, Any] = dict(DEFAULT_STUB_CONFIG)
+        self.update_config(config or {})
+        self.verbose = verbose
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Any] = {'requests': 0, 'by_status': {}, 'service_seconds': []}
+        self._response_ids: 'OrderedDict[str, None]' = OrderedDict()
+        self._files: Dict[str, bytes] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients hanging up mid-stream (cancelled hedges, aborted structured output) are expected
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def update_config(self, changes: Dict[str, Any]) -> None:
+        unknown = set(changes) - set(DEFAULT_STUB_CONFIG)
+        if unknown:
+            raise ValueError(f'Unknown stub config field(s): {sorted(unknown)}')
+        for name, value in changes.items():
+            self.config[name] = type(DEFAULT_STUB_CONFIG[name])(value)
+
+    def record(self, provider: str, status: int, service_seconds: float) -> None:
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            key = f'{provider}:{status}'
+            self._stats['by_status'][key] = self._stats['by_status'].get(key, 0) + 1
+            self._stats['service_seconds'].append(service_seconds)
+
+    def store_response(self, response_id: str) -> None:
+        with self._stats_lock:
+            self._response_ids[response_id] = None
+            while len(self._response_ids) > 10000:
+                self._response_ids.popitem(last=False)
+
+    def has_response(self, response_id: str) -> bool:
+        with self._stats_lock:
+            return response_id in self._response_ids
+
+    def store_file(self, content: bytes) -> str:
+        file_id = f'file-{uuid.uuid4().hex}'
+        with self._stats_lock:
+            self._files[file_id] = content
+        return file_id
+
+    def file_content(self, file_id: str) -> Optional[bytes]:
+        with self._stats_lock:
+            return self._files.get(file_id)
+
+    def create_batch(self, provider: str, requests: List[Any]) -> Dict[str, Any]:
+        prefix = 'msgbatch_' if provider == 'anthropic' else 'batch_'
+        batch = {'id': f'{prefix}{uuid.uuid4().hex}', 'provider': provider, 'requests': requests,
+                 'created_at': int(time.time()), 'created': time.monotonic(), 'cancelled': False, 'results': None}
+        with self._stats_lock:
+            self._batches[batch['id']] = batch
+        return batch
+
+    def batch(self, batch_id: str, provider: str) -> Optional[Dict[str, Any]]:
+        with self._stats_lock:
+            batch = self._batches.get(batch_id)
+        return batch if batch and batch['provider'] == provider else None
+
+    def cancel_batch(self, batch: Dict[str, Any]) -> None:
+        if not self.batch_ended(batch):
+            batch['cancelled'] = True
+
+    def batch_ended(self, batch: Dict[str, Any]) -> bool:
+        return batch['cancelled'] or (time.monotonic() - batch['created']) * 1000 >= self.config['batch_delay_ms']
+
+    def batch_results(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with self._stats_lock:
+            if batch['results'] is None:
+                batch['results'] = _batch_results(batch, self.config)
+            return batch['results']
+
+    def openai_batch_object(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        ended = self.batch_ended(batch)
+        obj = {'id': batch['id'], 'object': 'batch', 'endpoint': '/v1/responses', 'completion_window': '24h',
+               'status': 'cancelled' if batch['cancelled'] else ('completed' if ended else 'in_progress'),
+               'created_at': batch['created_at'], 'output_file_id': None, 'error_file_id': None,
+               'request_counts': {'total': len(batch['requests']), 'completed': 0, 'failed': 0}}
+        if ended and not batch['cancelled']:
+            lines = self.batch_results(batch)
+            succeeded = [line for line in lines if line['response']['status_code'] == 200]
+            failed = [line for line in lines if line['response']['status_code'] != 200]
+            if 'output_file_id' not in batch:
+                batch['output_file_id'] = self.store_file(b''.join(json.dumps(line).encode('utf-8') + b'\n' for line in succeeded))
+                batch['error_file_id'] = self.store_file(b''.join(json.dumps(line).encode('utf-8') + b'\n' for line in failed)) if failed else None
+            obj.update({'output_file_id': batch['output_file_id'], 'error_file_id': batch['error_file_id'],
+                        'request_counts': {'total': len(lines), 'completed': len(succeeded), 'failed': len(failed)}})
+        return obj
+
+    def anthropic_batch_object(self, batch: Dict[str, Any], host: str) -> Dict[str, Any]:
+        ended = self.batch_ended(batch)
+        counts = {'processing': 0 if ended else len(batch['requests']), 'succeeded': 0, 'errored': 0, 'canceled': 0, 'expired': 0}
+        if ended:
+            for line in self.batch_results(batch):
+                counts[line['result']['type']] += 1
+        return {'id': batch['id'], 'type': 'message_batch', 'processing_status': 'ended' if ended else 'in_progress',
+                'request_counts': counts, 'created_at': batch['created_at'], 'ended_at': None, 'cancel_initiated_at': None,
+                'results_url': f"http://{host}/v1/messages/batches/{batch['id']}/results" if ended else None}
+
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {'requests': self._stats['requests'], 'by_status': dict(self._stats['by_status'])}
+
+    def service_seconds(self) -> List[float]:
+        """Server-side time of every completed request, in completion order."""
+        with self._stats_lock:
+            return list(self._stats['service_seconds'])
+
+def start_stub_server(port: int = 0, config: Optional[Dict[str, Any]] = None, host: str = '127.0.0.1') -> ProviderStubServer:
+    """Start the stub on a background thread (port 0 picks a free port); stop it with server.shutdown()."""
+    server = ProviderStubServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local OpenAI Responses / Anthropic Messages stub for the proxy')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    for name, default in DEFAULT_STUB_CONFIG.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in DEFAULT_STUB_CONFIG}
+    server = ProviderStubServer((args.host, args.port), config, verbose=args.verbose)
+    print(f'Provider stub listening on {server.base_url} (/v1/responses, /v1/messages)')
+    print(f'Config: {json.dumps(config)}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+"""
+Self-hosted HTTP server for the proxy (on-prem alternative to AWS Lambda).
+
+Runs lambda_function's request handling behind an asyncio HTTP/1.1 server so one box can serve many
+Unity editors:
+
+    python proxy_server.py --host 0.0.0.0 --port 8080 --max-concurrency 256 --workers 32
+
+- Every request is turned into a Function URL style event and handled by lambda_streaming_handler,
+  so routing, request shaping, caching and error responses are identical to the Lambda deployment.
+- Streaming responses are written to the client as each SSE event arrives (chunked transfer encoding).
+- Provider streams cost no thread. The handler runs on a worker thread (--workers) to shape the request, and
+  opens the stream through this server's upstream opener: the connection, request and response are handled on
+  the event loop with asyncio.open_connection, and the worker thread is released once the response headers
+  are in. The body is then re-framed and translated by lambda_function's stream stages as it is read here.
+  Client connections, keep-alive and queued requests also live on the event loop. Buffered (non-streaming)
+  and hedged requests use blocking provider I/O and hold a worker thread for their whole duration.
+- Backpressure: at most --max-concurrency requests run at once and at most --max-queue wait for a
+  slot (up to --queue-timeout seconds); beyond that clients get 503 with Retry-After. A stream is only
+  read from the provider as fast as the client drains it.
+
+Standard library only. Configuration is the same PROXY_* environment variables as the Lambda function.
+"""
+
+import argparse
+import asyncio
+import base64
+import http.client
+import io
+import json
+import os
+import socket
+import sys
+import time
+import urllib.error
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple, List, AsyncIterator, Iterator
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lambda_function  # noqa: E402
+
+MAX_HEADER_BYTES = 64 * 1024
+KEEP_ALIVE_TIMEOUT_SECONDS = 75
+
+_REASONS = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+    409: 'Conflict', 413: 'Payload Too Large', 415: 'Unsupported Media Type', 429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 502: 'Bad Gateway',
+    503: 'Service Unavailable', 504: 'Gateway Timeout'
+}
+
+_END_OF_STREAM = object()
+
+class _RequestContext:
+    """Stands in for the Lambda context: a fixed time budget per request."""
+
+    def __init__(self, budget_seconds: float):
+        self.aws_request_id = f'local-{time.monotonic_ns()}'
+        self._deadline = time.monotonic() + budget_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+class _BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class _UpstreamResponse:
+    """
+    A provider response read on the event loop: status, reason and headers as on http.client responses, and the
+    decoded body with 'async for' (what lambda_streaming_handler expects from an upstream_opener).
+    Closing a fully-read response returns its connection to the server's pool; otherwise the connection is dropped.
+    """
+
+    def __init__(self, server: 'ProxyServer', key: Tuple[str, str, int], reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, status: int, reason: str, headers: http.client.HTTPMessage, timeout: float):
+        self._server = server
+        self._key = key
+        self._reader = reader
+        self._writer: Optional[asyncio.StreamWriter] = writer
+        self._timeout = timeout
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._chunked = 'chunked' in (headers.get('Transfer-Encoding') or '').lower()
+        length = headers.get('Content-Length')
+        self._length = int(length) if length and length.strip().isdigit() and not self._chunked else None
+        self._will_close = (headers.get('Connection') or '').lower() == 'close' or (not self._chunked and self._length is None)
+        self._complete = False
+        # Upstream is asked for gzip; decode incrementally so streamed events aren't held back.
+        encoding = (headers.get('Content-Encoding') or '').strip().lower()
+        self._decoder = zlib.decompressobj(zlib.MAX_WBITS | 32) if encoding in ('gzip', 'deflate') else None
+
+    def getheader(self, name: str, default: Any = None) -> Any:
+        return self.headers.get(name, default)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._chunks()
+
+    async def _read(self, pending: Any) -> bytes:
+        """One read of the body, failing like http.client does on a blocking socket."""
+        try:
+            return await asyncio.wait_for(pending, self._timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+        except asyncio.IncompleteReadError as e:
+            raise http.client.IncompleteRead(e.partial)
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        reader = self._reader
+        chunk_size = lambda_function.STREAM_READ_CHUNK_BYTES
+        remaining = self._length
+        while True:
+            if self._chunked and not remaining:
+                if remaining == 0:
+                    await self._read(reader.readexactly(2))  # CRLF after the chunk data
+                remaining = int((await self._read(reader.readuntil(b'\r\n'))).split(b';', 1)[0], 16)
+                if remaining == 0:
+                    # Last chunk: skip any trailers up to the blank line
+                    while await self._read(reader.readuntil(b'\r\n')) != b'\r\n':
+                        pass
+                    break
+            elif remaining == 0:
+                break
+            data = await self._read(reader.read(chunk_size if remaining is None else min(remaining, chunk_size)))
+            if not data:
+                if remaining is not None:
+                    raise http.client.IncompleteRead(b'')
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            if self._decoder is not None:
+                data = self._decoder.decompress(data)
+            if data:
+                yield data
+        self._complete = True
+        if self._decoder is not None:
+            tail = self._decoder.flush()
+            if tail:
+                yield tail
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        if self._complete and not self._will_close:
+            self._server._release_upstream(self._key, self._reader, writer)
+        else:
+            writer.close()
+
+class ProxyServer:
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float, request_budget: float, workers: int = 32):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.request_budget = request_budget
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='proxy-worker')
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+        self.active = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # (scheme, host, port) -> idle keep-alive provider connections of the event loop: [(reader, writer, last_used)]
+        self._upstream_idle: Dict[Tuple[str, str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]]] = {}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT_SECONDS)
+                except _BadRequest as e:
+                    await self._write_simple(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    return
+                if request is None:
+                    return
+                method, path, version, headers, body = request
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                keep_alive = await self._dispatch(writer, method, path, headers, body, keep_alive)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise _BadRequest(400, 'Incomplete request')
+            return None
+        except asyncio.LimitOverrunError:
+            raise _BadRequest(431, 'Request headers too large')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            raise _BadRequest(400, 'Malformed request line')
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise _BadRequest(400, 'Chunked request bodies are not supported; send Content-Length')
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise _BadRequest(400, 'Invalid Content-Length')
+        if length > lambda_function.MAX_REQUEST_BODY_BYTES:
+            raise _BadRequest(413, 'Request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target, version.strip(), headers, body
+
+    def _event(self, method: str, target: str, headers: Dict[str, str], body: bytes, peer: Any) -> Dict[str, Any]:
+        path, _, query = target.partition('?')
+        try:
+            text = body.decode('utf-8')
+            is_base64 = 'content-encoding' in headers
+        except UnicodeDecodeError:
+            is_base64 = True
+        return {
+            'version': '2.0',
+            'rawPath': path,
+            'rawQueryString': query,
+            'headers': headers,
+            'requestContext': {'http': {'method': method, 'path': path, 'sourceIp': peer[0] if peer else None}},
+            'body': base64.b64encode(body).decode('ascii') if is_base64 else text,
+            'isBase64Encoded': is_base64
+        }
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, method: str, target: str, headers: Dict[str, str],
+                        body: bytes, keep_alive: bool) -> bool:
+        if method == 'OPTIONS':
+            await self._write_head(writer, 204, {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': '*',
+                'Content-Length': '0'
+            }, keep_alive)
+            return keep_alive
+        if target.split('?')[0].rstrip('/') == '/health':
+            await self._write_simple(writer, 200, {'status': 'ok', 'active': self.active, 'waiting': self._waiting}, keep_alive)
+            return keep_alive
+        # GET is only used to poll bulk jobs (/jobs/{id}, /jobs/{id}/results)
+        if method != 'POST' and not (method == 'GET' and '/jobs/' in target.split('?')[0]):
+            await self._write_simple(writer, 405, {'error': 'Only POST is supported'}, keep_alive)
+            return keep_alive
+
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            await self._write_overloaded(writer, keep_alive)
+            return keep_alive
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            await self._write_overloaded(writer, keep_alive)
+            return keep_alive
+        finally:
+            self._waiting -= 1
+
+        self.active += 1
+        try:
+            return await self._run_handler(writer, self._event(method, target, headers, body, writer.get_extra_info('peername')), keep_alive)
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    async def _run_handler(self, writer: asyncio.StreamWriter, event: Dict[str, Any], keep_alive: bool) -> bool:
+        loop = asyncio.get_running_loop()
+        context = _RequestContext(self.request_budget)
+        result = await loop.run_in_executor(self.executor, lambda_function.lambda_streaming_handler, event, context, self._urlopen)
+        status = int(result.get('statusCode') or 200)
+        headers = dict(result.get('headers') or {})
+        body = result.get('body')
+
+        if body is None or isinstance(body, (str, bytes)):
+            if isinstance(body, str):
+                payload = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode('utf-8')
+            else:
+                payload = body or b''
+            headers['Content-Length'] = str(len(payload))
+            await self._write_head(writer, status, headers, keep_alive)
+            writer.write(payload)
+            await writer.drain()
+            return keep_alive
+
+        # Streamed body: provider streams opened by _urlopen are read right here on the event loop; other streamed
+        # bodies (hedged streams, job results) are pulled one chunk at a time on the worker pool. Either way the
+        # next chunk is only read once the client has drained the previous one, so a slow client slows the
+        # provider read instead of growing buffers.
+        chunks = body if hasattr(body, '__aiter__') else self._iter_on_workers(iter(body))
+        headers.pop('Content-Length', None)
+        headers['Transfer-Encoding'] = 'chunked'
+        try:
+            await self._write_head(writer, status, headers, keep_alive)
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    await writer.drain()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            # Closes the upstream response if the client went away mid-stream
+            await chunks.aclose()
+        return keep_alive
+
+    async def _iter_on_workers(self, iterator: Iterator[Any]) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, _END_OF_STREAM)
+                if chunk is _END_OF_STREAM:
+                    return
+                yield chunk
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+    def _urlopen(self, url: str, data: Optional[bytes], headers: Dict[str, str], timeout: float,
+                 telemetry: Optional[Dict[str, Any]] = None, method: str = 'POST') -> _UpstreamResponse:
+        """The handler's upstream_opener: called on a worker thread, which waits only until the response headers are in."""
+        return asyncio.run_coroutine_threadsafe(self._open_upstream(url, data, headers, timeout, telemetry, method), self.loop).result()
+
+    async def _open_upstream(self, url: str, data: Optional[bytes], headers: Dict[str, str], timeout: float,
+                             telemetry: Optional[Dict[str, Any]], method: str) -> _UpstreamResponse:
+        """
+        lambda_function._pooled_urlopen on the event loop, with the same error semantics (HTTPError for statuses
+        >= 400, URLError for connect failures, _RequestSentError after the request was sent), so the handler's
+        retries and error responses apply unchanged. Records the 'connect' and 'ttfb' phases.
+        """
+        key, path = lambda_function._upstream_target(url)
+        scheme, host, port = key
+        data = data or b''
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}' if port == (443 if scheme == 'https' else 80) else f'Host: {host}:{port}']
+        if not any(name.lower() == 'accept-encoding' for name in headers):
+            lines.append('Accept-Encoding: gzip')
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        lines.append(f'Content-Length: {len(data)}')
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + data
+
+        while True:
+            phase_started = time.perf_counter()
+            connection = self._acquire_upstream(key)
+            reused = connection is not None
+            if connection is None:
+                try:
+                    connection = await asyncio.wait_for(asyncio.open_connection(
+                        host, port, ssl=lambda_function._get_ssl_context() if scheme == 'https' else None), timeout)
+                except asyncio.TimeoutError:
+                    raise urllib.error.URLError(socket.timeout('timed out'))
+                except OSError as e:
+                    raise urllib.error.URLError(e)
+                phase_started = lambda_function._phase_done(telemetry, 'connect', phase_started)
+            reader, writer = connection
+            try:
+                writer.write(request)
+                await writer.drain()
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                lambda_function._phase_done(telemetry, 'ttfb', phase_started)
+            except asyncio.TimeoutError:
+                writer.close()
+                raise lambda_function._RequestSentError(socket.timeout('timed out'))
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                writer.close()
+                if reused and isinstance(e, (ConnectionError, asyncio.IncompleteReadError)):
+                    # A kept-alive connection the server had already closed: the request never reached it
+                    lambda_function._debug_log(f"[Lambda] Pooled connection to {host} was stale ({type(e).__name__}), reconnecting")
+                    continue
+                raise lambda_function._RequestSentError(e)
+            break
+
+        status_line, _, header_block = head.partition(b'\r\n')
+        parts = status_line.decode('latin-1').split(' ', 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            writer.close()
+            raise lambda_function._RequestSentError(http.client.BadStatusLine(status_line.decode('latin-1')))
+        response = _UpstreamResponse(self, key, reader, writer, int(parts[1]), parts[2] if len(parts) > 2 else '',
+                                     http.client.parse_headers(io.BytesIO(header_block)), timeout)
+        if response.status >= 400:
+            try:
+                error_body = b''.join([chunk async for chunk in response])
+            finally:
+                response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+        return response
+
+    def _acquire_upstream(self, key: Tuple[str, str, int]) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        """An idle pooled connection that is recent and not closed by the provider, or None."""
+        idle = self._upstream_idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if time.monotonic() - last_used <= lambda_function.POOL_MAX_IDLE_SECONDS and not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release_upstream(self, key: Tuple[str, str, int], reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        idle = self._upstream_idle.setdefault(key, [])
+        if len(idle) < lambda_function.POOL_MAX_CONNECTIONS_PER_HOST and not reader.at_eof():
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def warm_upstream(self, timeout: float) -> Dict[str, Any]:
+        """warm_upstream_connections for the event loop pool that provider streams use."""
+        keys = []
+        for config in lambda_function.PROVIDER_CONFIG.values():
+            key = lambda_function._upstream_target(config['api_url'])[0]
+            if key not in keys:
+                keys.append(key)
+        count = max(1, min(lambda_function.WARMUP_CONNECTIONS_PER_HOST, lambda_function.POOL_MAX_CONNECTIONS_PER_HOST))
+
+        async def connect(key: Tuple[str, str, int]) -> Dict[str, Any]:
+            started = time.monotonic()
+            scheme, host, port = key
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                    host, port, ssl=lambda_function._get_ssl_context() if scheme == 'https' else None), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                return {'ok': False, 'error': f'{type(e).__name__}: {str(e)}', 'ms': round((time.monotonic() - started) * 1000, 1)}
+            self._release_upstream(key, reader, writer)
+            return {'ok': True, 'ms': round((time.monotonic() - started) * 1000, 1)}
+
+        results = await asyncio.gather(*(connect(key) for key in keys for _ in range(count)))
+        return {f'{key[1]}:{key[2]}': list(results[i * count:(i + 1) * count]) for i, key in enumerate(keys)}
+
+    async def _write_head(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str], keep_alive: bool) -> None:
+        lines = [f'HTTP/1.1 {status} {_REASONS.get(status, "Unknown")}']
+        headers = dict(headers)
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def _write_simple(self, writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any], keep_alive: bool) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        await self._write_head(writer, status, {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Content-Length': str(len(body))
+        }, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    async def _write_overloaded(self, writer: asyncio.StreamWriter, keep_alive: bool) -> None:
+        body = json.dumps({'error': 'Proxy is at capacity, retry shortly', 'error_type': 'overloaded'}).encode('utf-8')
+        await self._write_head(writer, 503, {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Retry-After': str(max(1, int(self.queue_timeout))),
+            'Content-Length': str(len(body))
+        }, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+async def serve(host: str, port: int, server: ProxyServer, warmup: bool) -> None:
+    server.loop = asyncio.get_running_loop()
+    if warmup:
+        # Buffered requests use lambda_function's blocking pool, streams the event loop pool
+        connections = await server.loop.run_in_executor(server.executor, lambda_function.warm_upstream_connections)
+        streams = await server.warm_upstream(lambda_function.WARMUP_TIMEOUT_SECONDS)
+        print(f'Warmup: {json.dumps(connections)}, streams: {json.dumps(streams)}')
+    listener = await asyncio.start_server(server.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    addresses = ', '.join(f'{sock.getsockname()[0]}:{sock.getsockname()[1]}' for sock in listener.sockets)
+    print(f'Proxy listening on {addresses} (max concurrency {server.max_concurrency}, queue {server.max_queue}, '
+          f'workers {server.workers})')
+    async with listener:
+        await listener.serve_forever()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Self-hosted asyncio server for the AI Editor Agent proxy')
+    parser.add_argument('--host', default=os.environ.get('PROXY_SERVER_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=lambda_function._env_int('PROXY_SERVER_PORT', 8080))
+    parser.add_argument('--max-concurrency', type=int, default=lambda_function._env_int('PROXY_SERVER_MAX_CONCURRENCY', 64),
+                        help='Requests handled at once, including open streams')
+    parser.add_argument('--workers', type=int, default=lambda_function._env_int('PROXY_SERVER_WORKERS', 32),
+                        help='Worker threads for request shaping and buffered provider calls (open streams hold none)')
+    parser.add_argument('--max-queue', type=int, default=lambda_function._env_int('PROXY_SERVER_MAX_QUEUE', 256),
+                        help='Requests allowed to wait for a slot before new ones get 503')
+    parser.add_argument('--queue-timeout', type=float, default=lambda_function._env_int('PROXY_SERVER_QUEUE_TIMEOUT_SECONDS', 30),
+                        help='Seconds a request may wait for a slot')
+    parser.add_argument('--request-budget', type=float, default=lambda_function._env_int('PROXY_SERVER_REQUEST_BUDGET_SECONDS', 300),
+                        help='Time budget per request (plays the role of the Lambda timeout)')
+    parser.add_argument('--warmup', action='store_true', help='Open provider connections before accepting requests')
+    args = parser.parse_args()
+
+    server = ProxyServer(max(1, args.max_concurrency), max(0, args.max_queue), args.queue_timeout, args.request_budget,
+                         max(1, args.workers))
+    try:
+        asyncio.run(serve(args.host, args.port, server, args.warmup))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Replays captured traffic against the proxy handler and the local provider stub (provider_stub.py).
+
+Capture records come from PROXY_CAPTURE_RATE (see lambda_function.py): redacted request shapes plus upstream
+timing. Each record becomes a synthetic /suggest request of the same shape (provider, model, stream flag,
+message roles and sizes, system prompt and file content sizes, max tokens). A stub directive in the request
+reproduces the recorded TTFB, transfer time, output size and upstream error. Requests arrive with the
+recorded spacing, and the per request kind report has latency, overhead (latency minus the scripted upstream
+time) and scheduling lag:
+
+    python replay_traffic.py capture.jsonl                            # original arrival times
+    python replay_traffic.py capture.jsonl --speed 4 --scale 3        # 4x faster, every record 3 times
+    python replay_traffic.py capture.jsonl --speed 0 --concurrency 32 # closed loop, as fast as possible
+    python replay_traffic.py capture.jsonl --proxy-dir ../../old/Proxy --output old.json
+    python replay_traffic.py capture.jsonl --baseline old.json --max-regression 0.25   # exit 1 on regression
+
+Input is JSONL of capture records. CloudWatch exports of PROXY_CAPTURE_PATH=log work too: anything before the
+first '{' of a line is ignored, as are records other than {"msg": "capture"}.
+Standard library only.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
+
+PROXY_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROXY_DIR)
+
+from benchmark_proxy import OPENAI_KEY, ANTHROPIC_KEY, _percentile, peak_rss_mb  # noqa: E402
+from provider_stub import start_stub_server  # noqa: E402
+
+_ROLES = {'u': 'user', 'a': 'assistant', 's': 'system', 'd': 'developer', 't': 'tool'}
+_FILLER_LINE = '    transform.position += Vector3.up * speed * Time.deltaTime; // keep moving\n'
+# Events of a raw stream around the text deltas (created/completed vs. message/content block start/stop/delta)
+_STREAM_FRAME_EVENTS = {'OpenAI': 2, 'Claude': 5}
+_STUB_CHUNK_CHARS = 16
+
+def load_records(paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                start = line.find('{')
+                if start < 0:
+                    continue
+                try:
+                    record = json.loads(line[start:])
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and record.get('msg') == 'capture' and isinstance(record.get('message_chars'), list):
+                    records.append(record)
+    records.sort(key=lambda r: r.get('ts') or 0)
+    return records
+
+def _filler(chars: int) -> str:
+    return (_FILLER_LINE * (chars // len(_FILLER_LINE) + 1))[:chars]
+
+def record_kind(record: Dict[str, Any]) -> str:
+    kind = 'agent' if record.get('file_content_chars') or record.get('structured_output') else 'chat'
+    return f"{kind}/{'stream' if record.get('stream') else 'buffered'}"
+
+def _output_chars(record: Dict[str, Any]) -> int:
+    """Approximate output text size: usage when recorded, else derived from the stream events or body size."""
+    if record.get('output_tokens'):
+        return int(record['output_tokens']) * 4
+    if record.get('stream') and record.get('chunks'):
+        deltas = record['chunks'] - _STREAM_FRAME_EVENTS.get(record.get('provider'), 2)
+        return max(1, deltas) * _STUB_CHUNK_CHARS
+    if record.get('stream'):
+        return max(_STUB_CHUNK_CHARS, (record.get('response_bytes') or 0) // 10)
+    return max(1, (record.get('response_bytes') or 0) - 600)
+
+def stub_directive(record: Dict[str, Any]) -> Tuple[str, float]:
+    """The '[[stub ...]]' directive reproducing the record's upstream behaviour, and the scripted upstream seconds."""
+    ttfb_ms = float(record.get('ttfb_ms') or 0)
+    transfer_ms = float(record.get('transfer_ms') or 0)
+    output_chars = _output_chars(record)
+    settings: Dict[str, Any] = {'output_chars': output_chars, 'chunk_chars': _STUB_CHUNK_CHARS}
+    if record.get('stream'):
+        deltas = max(1, -(-output_chars // _STUB_CHUNK_CHARS))
+        settings.update({'ttfb_ms': int(ttfb_ms), 'chunk_interval_ms': int(transfer_ms / deltas)})
+        scripted = ttfb_ms + settings['chunk_interval_ms'] * (deltas - 1)
+    else:
+        settings['latency_ms'] = int(ttfb_ms)
+        scripted = ttfb_ms
+    if record.get('upstream_status'):
+        settings.update({'error_rate': 1, 'error_status': int(record['upstream_status'])})
+    return '[[stub ' + ' '.join(f'{name}={value}' for name, value in settings.items()) + ']]', scripted / 1000.0
+
+def build_event(record: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
+    """Synthetic /suggest event with the record's shape; returns (event, scripted upstream seconds)."""
+    provider = 'Claude' if record.get('provider') == 'Claude' else 'OpenAI'
+    directive, scripted = stub_directive(record)
+    messages = [{'role': _ROLES.get(role, 'user'), 'content': _filler(int(chars))}
+                for role, chars in zip(record.get('roles') or '', record['message_chars'])]
+    last_user = next((m for m in reversed(messages) if m['role'] == 'user'), None)
+    if last_user is None:
+        last_user = {'role': 'user', 'content': ''}
+        messages.append(last_user)
+    file_chars = int(record.get('file_content_chars') or 0)
+    if file_chars:
+        # The file content lives in the last user message; keep that message's recorded size where possible
+        header = 'Current File Content (Assets/Scripts/Replay.cs):\n```csharp\n'
+        last_user['content'] = header + _filler(max(0, file_chars - len(header)))
+    last_user['content'] = directive + '\n' + last_user['content']
+    body: Dict[str, Any] = {
+        'model': record.get('model') or ('claude-sonnet-4-20250514' if provider == 'Claude' else 'gpt-4o-mini'),
+        'messages': messages,
+        'stream': bool(record.get('stream'))
+    }
+    if record.get('system_chars'):
+        body['system'] = _filler(int(record['system_chars']))
+    if record.get('max_tokens'):
+        body['max_tokens'] = int(record['max_tokens'])
+    headers = {'Authorization': f"Bearer {ANTHROPIC_KEY if provider == 'Claude' else OPENAI_KEY}",
+               'Content-Type': 'application/json', 'X-Provider': provider}
+    if record.get('stream_format'):
+        headers['X-Proxy-Stream-Format'] = record['stream_format']
+    if record.get('coalesce'):
+        headers['X-Proxy-Coalesce'] = record['coalesce']
+    event = {'httpMethod': 'POST', 'path': '/suggest', 'headers': headers, 'body': json.dumps(body), 'isBase64Encoded': False}
+    return event, scripted
+
+def schedule(records: List[Dict[str, Any]], speed: float, scale: int) -> List[Tuple[float, Dict[str, Any]]]:
+    """(offset seconds, record) pairs. Copies of a record (scale > 1) are spread over the mean arrival gap."""
+    if not records:
+        return []
+    first = records[0].get('ts') or 0
+    span = (records[-1].get('ts') or 0) - first
+    gap = span / max(1, len(records) - 1)
+    planned = []
+    for record in records:
+        offset = (record.get('ts') or 0) - first
+        for copy in range(scale):
+            planned.append((offset + gap * copy / scale, record))
+    planned.sort(key=lambda item: item[0])
+    return [((offset / speed) if speed > 0 else 0.0, record) for offset, record in planned]
+
+def _invoke(lf: Any, event: Dict[str, Any], streaming: bool) -> int:
+    if streaming:
+        result = lf.lambda_streaming_handler(event, None)
+        body = result.get('body')
+        if not isinstance(body, (str, bytes)):
+            for _ in body:
+                pass
+    else:
+        result = lf.lambda_handler(event, None)
+    return result.get('statusCode', 0)
+
+def replay(lf: Any, planned: List[Tuple[float, Dict[str, Any]]], concurrency: int) -> Tuple[List[Dict[str, Any]], float, int]:
+    """Drive the planned requests; returns (per-request samples, wall seconds, peak requests in flight)."""
+    samples: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, peak
+
+    def run(due: float, record: Dict[str, Any], event: Dict[str, Any], scripted: float) -> None:
+        started = time.perf_counter()
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        try:
+            status = _invoke(lf, event, record.get('handler') == 'streaming')
+        except Exception as e:
+            print(f'request failed: {type(e).__name__}: {e}', file=sys.stderr)
+            status = 0
+        latency = time.perf_counter() - started
+        with lock:
+            in_flight[0] -= 1
+            samples.append({'kind': record_kind(record), 'status': status, 'expected_status': record.get('status'),
+                            'latency': latency, 'overhead': max(0.0, latency - scripted), 'lag': max(0.0, started - due)})
+
+    events = [(offset, record) + build_event(record) for offset, record in planned]
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset, record, event, scripted in events:
+            delay = begin + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, begin + offset, record, event, scripted)
+    return samples, time.perf_counter() - begin, in_flight[1]
+
+def summarize(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    latencies = [s['latency'] for s in samples]
+    overheads = [s['overhead'] for s in samples]
+    lags = [s['lag'] for s in samples]
+    return {
+        'requests': len(samples),
+        # Recorded upstream failures are replayed too; only a status differing from the recording is an error
+        'errors': sum(1 for s in samples if s['status'] != (s['expected_status'] or 200)),
+        'latency_p50_ms': round(_percentile(latencies, 0.5) * 1000, 3),
+        'latency_p90_ms': round(_percentile(latencies, 0.9) * 1000, 3),
+        'latency_p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+        'overhead_p50_ms': round(_percentile(overheads, 0.5) * 1000, 3),
+        'overhead_p99_ms': round(_percentile(overheads, 0.99) * 1000, 3),
+        'lag_p99_ms': round(_percentile(lags, 0.99) * 1000, 3)
+    }
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Regressions of p99 overhead per request kind beyond max_regression (fraction)."""
+    regressions = []
+    for kind, current in results['by_kind'].items():
+        before = baseline.get('by_kind', {}).get(kind)
+        # Ignore sub-millisecond noise
+        if before and current['overhead_p99_ms'] > max(before['overhead_p99_ms'] * (1 + max_regression), before['overhead_p99_ms'] + 1.0):
+            regressions.append(f"{kind}: p99 overhead {before['overhead_p99_ms']}ms -> {current['overhead_p99_ms']}ms")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay captured proxy traffic against the local provider stub')
+    parser.add_argument('captures', nargs='+', help='Capture JSONL files (or CloudWatch exports of capture records)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Arrival time compression (2 = twice as fast, 0 = closed loop)')
+    parser.add_argument('--scale', type=int, default=1, help='Replay every record this many times')
+    parser.add_argument('--concurrency', type=int, default=64, help='Maximum requests in flight')
+    parser.add_argument('--limit', type=int, default=0, help='Only replay the first N records')
+    parser.add_argument('--proxy-dir', help='Folder of the lambda_function.py to drive (default: this one)')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare against a previous --output file')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Allowed slowdown vs baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    records = load_records(args.captures)
+    # Client errors never reached the provider and replay as valid requests; they'd only distort the mix
+    replayable = [r for r in records if r.get('status') == 200 or r.get('upstream_status')]
+    skipped = len(records) - len(replayable)
+    records = replayable
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        parser.error('No replayable capture records found')
+
+    stub = start_stub_server()
+    # Must be set before lambda_function is imported; logging and capture off so they don't skew timings
+    os.environ['PROXY_OPENAI_API_BASE'] = stub.base_url
+    os.environ['PROXY_ANTHROPIC_API_BASE'] = stub.base_url
+    os.environ['PROXY_DIAGNOSTICS'] = 'off'
+    os.environ['PROXY_CAPTURE_RATE'] = '0'
+    if args.proxy_dir:
+        sys.path.insert(0, os.path.abspath(args.proxy_dir))
+    import lambda_function as lf
+    print(f'Replaying {len(records)} record(s) x{args.scale} from {os.path.dirname(os.path.abspath(lf.__file__))} '
+          f'(speed {args.speed}, concurrency {args.concurrency}, {skipped} client error record(s) skipped)')
+
+    samples, wall, peak_in_flight = replay(lf, schedule(records, args.speed, args.scale), args.concurrency)
+    stub.shutdown()
+
+    kinds = sorted({s['kind'] for s in samples})
+    results: Dict[str, Any] = {
+        'python': sys.version.split()[0],
+        'records': len(records),
+        'skipped': skipped,
+        'speed': args.speed,
+        'scale': args.scale,
+        'concurrency': args.concurrency,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(samples) / wall, 1) if wall > 0 else 0.0,
+        'peak_in_flight': peak_in_flight,
+        'overall': summarize(samples),
+        'by_kind': {kind: summarize([s for s in samples if s['kind'] == kind]) for kind in kinds},
+        'peak_rss_mb': peak_rss_mb()
+    }
+    for name, stats in [('overall', results['overall'])] + list(results['by_kind'].items()):
+        print(f"{name:<16} {stats['requests']:>6} req  latency p50 {stats['latency_p50_ms']:>9}ms p99 {stats['latency_p99_ms']:>9}ms  "
+              f"overhead p50 {stats['overhead_p50_ms']:>8}ms p99 {stats['overhead_p99_ms']:>8}ms  "
+              f"lag p99 {stats['lag_p99_ms']:>8}ms  errors {stats['errors']}")
+    print(f"{results['throughput_rps']} rps over {results['wall_seconds']}s, peak {peak_in_flight} in flight, "
+          f"peak RSS {results['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.max_regression)
+        if regressions:
+            print('REGRESSIONS:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('No regressions against baseline')
+
+if __name__ == '__main__':
+    main()